@@ -1,10 +1,39 @@
 String serial_InBytes;
 
+/*
+  Framed serial protocol (device -> host), one frame per line:
+    @<seq>,<event>,<micros>*<checksum>
+
+    seq      : sequence number of the frame (0-255, wraps around)
+    event    : READY (after boot), ACK (start received), TRIG (TTL start set high),
+               FIN (TTL finished received), ERR (unknown command)
+    micros   : device time in microseconds when the event occurred (wraps around after ~71 min)
+    checksum : XOR of all characters between @ and *, as 2-digit hex
+
+  Commands (host -> device): "start"
+*/
 
 // Define pins
 int TTL_start_OUT = 12;
 int TTL_finished_IN = 10;
-int val_TTL_finished_IN;
+
+byte seq = 0;
+
+void send_frame(String event, unsigned long t_us) {
+  String payload = String(seq) + "," + event + "," + String(t_us);
+
+  byte checksum = 0;
+  for (unsigned int i = 0; i < payload.length(); i++) {
+    checksum ^= payload[i];
+  }
+
+  Serial.print("@");
+  Serial.print(payload);
+  Serial.print("*");
+  if (checksum < 16) Serial.print("0");
+  Serial.println(checksum, HEX);
+  seq++;
+}
 
 void setup() {
   pinMode(LED_BUILTIN, OUTPUT);
@@ -13,59 +42,48 @@ void setup() {
 
   Serial.begin(9600);
   Serial.setTimeout(1000);
-  
+
   // TTL signal for debugging
   pinMode(7, OUTPUT);
   pinMode(8, OUTPUT);
 
+  send_frame("READY", micros());
 }
+
 void loop() {
-  
+
   // TTL signal for debugging (pin 8 can be used to simulate incoming TTL)
-  digitalWrite(7, HIGH); 
-  digitalWrite(8, LOW); 
-  
+  digitalWrite(7, HIGH);
+  digitalWrite(8, LOW);
 
-  if (Serial.available() > 0){
 
-    /*
-    // DEBUGGIN : print TTL signal
-    val_TTL_in = digitalRead(TTL_in);   // read the input pin
-    Serial.println(val_TTL_in);
-    delay(10);
-    */
+  if (Serial.available() > 0){
 
     // Read from serial port
     serial_InBytes = Serial.readStringUntil('\n');
-    //Serial.println(InBytes);
-    
+
     // Start acquisition
     if (serial_InBytes == "start"){
-      Serial.println("Sending TTL trigger to launch acquisition");
-      digitalWrite(TTL_start_OUT, HIGH); 
+      send_frame("ACK", micros());
+
+      digitalWrite(TTL_start_OUT, HIGH);
       digitalWrite(LED_BUILTIN, HIGH);
+      send_frame("TRIG", micros());
 
-      // Wait for trigger that acquisition is done
-      val_TTL_finished_IN = 0;
-      while (val_TTL_finished_IN==0) {
-        val_TTL_finished_IN = digitalRead(TTL_finished_IN);   // read the input pin
-        Serial.println(val_TTL_finished_IN);
-        delay(500);
+      // Wait for trigger that acquisition is done (polled without delay to time-stamp the edge)
+      while (digitalRead(TTL_finished_IN) == LOW) {
       }
+      unsigned long t_finished = micros();
 
       // Signal received that acquisition is finished
-      Serial.println("finished");
       digitalWrite(TTL_start_OUT, LOW);
       digitalWrite(LED_BUILTIN, LOW);
+      send_frame("FIN", t_finished);
     }
 
     // Unknown command
     else{
-      Serial.println("Unknown command: " + serial_InBytes);
+      send_frame("ERR", micros());
     }
-  
-  delay(500);
-  
   }
 }
-
@@ -1,8 +1,7 @@
-#from autofish.automator  import Robot
-from autofish import autofish_gui
-
-def main():    
-    autofish_gui.main()
+def main():
+    # The GUI (and PySimpleGUI) is only imported when no headless command is given
+    from autofish.cli import main as main_cli
+    main_cli()
 
 if __name__ == '__main__':   
-    main()
\ No newline at end of file
+    main()
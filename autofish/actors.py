@@ -0,0 +1,184 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import itertools
+import logging
+import queue
+import time
+from threading import Thread, Event
+
+from autofish.metrics import METRICS
+
+
+# ---------------------------------------------------------------------------
+# Device actors
+# ---------------------------------------------------------------------------
+
+class deviceTimeout(Exception):
+    """ A device did not answer a request before its deadline.
+    """
+
+
+class _request():
+
+    def __init__(self, method, args, kwargs, deadline):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.deadline = deadline
+        self.done = Event()
+        self.result = None
+        self.exception = None
+
+
+class deviceActor():
+    """ Runs a device controller (pump, valve, plate robot, flow sensor) in its own worker thread.
+
+    Requests are put in a queue and executed one after the other by the worker, which is the only
+    thread talking to the device. The caller waits until the deadline of the request: a hung device
+    (e.g. a readline() that never returns) then only blocks its own worker. Requests that reached
+    their deadline before the worker picked them up are not executed.
+
+    When a request times out, the actor is restarted (new worker and new device from restart_fn,
+    e.g. re-opening the serial port) and the request is retried up to retries times. Motion commands
+    (e.g. moves of the plate robot) are not retried, the position after an interrupted move is not
+    known: recover_fn is called instead (e.g. to home the plate robot).
+    """
+
+    def __init__(self, device, name, timeout=30, restart_fn=None, retries=1, motion=(), recover_fn=None, logger=None):
+        """__init__ _summary_
+
+        Args:
+            device (object): device controller, e.g. GRBLrobot.
+            name (str): name of the device, e.g. 'plate'.
+            timeout (float, optional): default deadline of requests in seconds. Defaults to 30.
+            restart_fn (callable, optional): returns a new device controller. Defaults to None (no restart).
+            retries (int, optional): retries of a request after a restart. Defaults to 1.
+            motion (tuple, optional): methods that are not retried after a timeout. Defaults to ().
+            recover_fn (callable, optional): called after a timeout of a motion method. Defaults to None.
+            logger (logging.Logger, optional): logger. Defaults to None.
+        """
+        if isinstance(logger, type(None)):
+            self.logger = logging.getLogger('AUTOMATOR-Actor')
+            self.logger.setLevel(100)
+        else:
+            self.logger = logger
+
+        self.device = device
+        self.name = name
+        self.timeout = timeout
+        self.restart_fn = restart_fn
+        self.retries = retries
+        self.motion = motion
+        self.recover_fn = recover_fn
+        self.generation = itertools.count()
+        self.n_restarts = 0
+
+        self._start_worker()
+
+    def _start_worker(self):
+        self.queue = queue.Queue()
+        self.stop = Event()
+        self.worker = Thread(target=self._run, args=(self.queue, self.stop, self.device),
+                             name=f'actor-{self.name}-{next(self.generation)}', daemon=True)
+        self.worker.start()
+
+    def _run(self, requests, stop, device):
+        while not stop.is_set():
+            try:
+                request = requests.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            if time.monotonic() > request.deadline:
+                self.logger.warning(f'{self.name}: request {request.method} reached deadline before execution, dropped.')
+                request.exception = deviceTimeout(f'{self.name}.{request.method} not executed before deadline')
+                request.done.set()
+                continue
+
+            try:
+                request.result = getattr(device, request.method)(*request.args, **request.kwargs)
+            except BaseException as e:  # SystemExit of the drivers is passed to the caller
+                request.exception = e
+            request.done.set()
+
+    def call(self, method, *args, timeout=None, **kwargs):
+        """ Execute a method of the device in the worker and wait for the result.
+
+        Args:
+            method (str): name of method.
+            timeout (float, optional): deadline in seconds. Defaults to timeout of actor.
+
+        Raises:
+            deviceTimeout: no answer before the deadline (after all retries).
+
+        Returns:
+            result of the method.
+        """
+        timeout = self.timeout if timeout is None else timeout
+
+        for attempt in range(self.retries + 1):
+            request = _request(method, args, kwargs, time.monotonic() + timeout)
+            self.queue.put(request)
+
+            if request.done.wait(timeout):
+                if request.exception is not None:
+                    raise request.exception
+                return request.result
+
+            METRICS.increment(f'actor_timeout_{self.name}')
+            self.logger.error(f'{self.name}: no answer to {method} within {timeout}s.')
+
+            # State of the device is not known anymore (see autofish.devicestate)
+            state = getattr(self.device, 'state', None)
+            if state is not None:
+                state.invalidate()
+
+            if method in self.motion:
+                self.logger.error(f'{self.name}: {method} is not repeated, position is not known.')
+                if self.recover_fn is not None:
+                    self.recover_fn()
+                break
+
+            if self.restart_fn is None or attempt == self.retries:
+                break
+            self.restart()
+
+        raise deviceTimeout(f'{self.name}.{method} did not answer within {timeout}s')
+
+    def restart(self):
+        """ Abandon the current worker (it may be blocked in the device) and start a new one with a
+        new device from restart_fn.
+        """
+        self.logger.warning(f'{self.name}: restarting device.')
+        self.stop.set()
+        if self.restart_fn is not None:
+            self.device = self.restart_fn()
+        self._start_worker()
+        self.n_restarts += 1
+        METRICS.increment(f'actor_restart_{self.name}')
+
+    def close(self):
+        self.stop.set()
+
+
+class actorProxy():
+    """ Stand-in for a device controller: method calls are executed by the actor, other
+    attributes are read from the device. Can replace the device in the Robot (e.g. Robot.plate).
+    """
+
+    def __init__(self, actor):
+        self._actor = actor
+
+    def __getattr__(self, name):
+        attr = getattr(self._actor.device, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._actor.call(name, *args, **kwargs)
+        return call
+
+    def _type(self):
+        return self._actor.device._type()
@@ -0,0 +1,123 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import numpy as np
+
+
+# ---------------------------------------------------------------------------
+# Detection of flow anomalies while pumping
+# ---------------------------------------------------------------------------
+
+class flowAnomalyDetector():
+    """ Streaming detection of anomalies in the live flow trace of the flow sensor.
+
+    New samples are pushed into a ring buffer with update(). Rolling statistics are computed
+    on the ring buffer, and the following anomalies are reported:
+        zero_flow : the last zero_samples samples are all below flow_min (empty well, occlusion).
+        flow_drop : mean of the last drop_samples samples is below drop_fraction of the
+                    rolling median (partial occlusion, well running empty).
+        bubble    : a sample exceeds the rolling median by more than spike_sigma robust
+                    standard deviations (median absolute deviation).
+
+    Samples of the first warmup seconds after the pump started are ignored (ramp-up of the flow).
+
+    Configuration in the system config, flow_sensor -> anomaly, e.g.
+        "anomaly": {"action": "reprime", "window": 50, "warmup": 3}
+    with action 'abort' (stop pump and run), 'reprime' (move again to the well and restart
+    the pump), or 'pause' (stop pump and wait for the operator).
+    """
+
+    ACTIONS = ('abort', 'reprime', 'pause')
+
+    def __init__(self, action='pause', window=50, warmup=3, flow_min=20,
+                 zero_samples=10, drop_samples=5, drop_fraction=0.5, spike_sigma=8,
+                 max_reprime=1, poll_interval=0.5):
+        """__init__ _summary_
+
+        Args:
+            action (str, optional): action when an anomaly is detected. Defaults to 'pause'.
+            window (int, optional): number of samples in the ring buffer. Defaults to 50.
+            warmup (float, optional): time (s) after pump start without detection. Defaults to 3.
+            flow_min (float, optional): flow below this value is considered zero. Defaults to 20.
+            zero_samples (int, optional): consecutive samples below flow_min for zero_flow. Defaults to 10.
+            drop_samples (int, optional): samples averaged to detect a flow_drop. Defaults to 5.
+            drop_fraction (float, optional): fraction of rolling median for a flow_drop. Defaults to 0.5.
+            spike_sigma (float, optional): threshold for bubble spikes (robust standard deviations). Defaults to 8.
+            max_reprime (int, optional): number of re-primes per pump step before pausing. Defaults to 1.
+            poll_interval (float, optional): time (s) between two reads of the flow sensor. Defaults to 0.5.
+        """
+        if action not in self.ACTIONS:
+            raise ValueError(f'Unknown action for flow anomalies: {action}, has to be one of {self.ACTIONS}')
+
+        self.action = action
+        self.window = int(window)
+        self.warmup = warmup
+        self.flow_min = flow_min
+        self.zero_samples = int(zero_samples)
+        self.drop_samples = int(drop_samples)
+        self.drop_fraction = drop_fraction
+        self.spike_sigma = spike_sigma
+        self.max_reprime = max_reprime
+        self.poll_interval = poll_interval
+
+        self.reset()
+
+    def reset(self):
+        """ Empty the ring buffer, call when the pump is (re)started.
+        """
+        self.buffer = np.full(self.window, np.nan)
+        self.n_samples = 0
+        self.t_first = None
+
+    def update(self, t_flow, flow):
+        """ Add new samples and check for anomalies.
+
+        Args:
+            t_flow (np.array): time of the samples in seconds.
+            flow (np.array): flow rate of the samples.
+
+        Returns:
+            str: name of the detected anomaly, None if the flow is normal.
+        """
+        t_flow = np.asarray(t_flow, dtype=float)
+        flow = np.asarray(flow, dtype=float)
+        if flow.size == 0:
+            return None
+
+        # Ignore ramp-up of the flow
+        if self.t_first is None:
+            self.t_first = t_flow[0]
+        flow = flow[t_flow - self.t_first >= self.warmup]
+        if flow.size == 0:
+            return None
+
+        # Rolling statistics of the samples before the new ones
+        n_history = min(self.n_samples, self.window)
+        history = self.buffer[self.window - n_history:]
+        if n_history >= self.drop_samples:
+            median = np.median(history)
+            mad = 1.4826 * np.median(np.abs(history - median))
+        else:
+            median = None
+
+        # Push new samples into ring buffer
+        flow_keep = flow[-self.window:]
+        self.buffer = np.roll(self.buffer, -flow_keep.size)
+        self.buffer[-flow_keep.size:] = flow_keep
+        self.n_samples += flow.size
+        n_filled = min(self.n_samples, self.window)
+
+        if n_filled >= self.zero_samples and np.all(self.buffer[-self.zero_samples:] < self.flow_min):
+            return 'zero_flow'
+
+        if median is None or median < self.flow_min:
+            return None
+
+        if n_filled >= self.drop_samples and np.mean(self.buffer[-self.drop_samples:]) < self.drop_fraction * median:
+            return 'flow_drop'
+
+        if mad > 0 and np.any(flow - median > self.spike_sigma * mad):
+            return 'bubble'
+
+        return None
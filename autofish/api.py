@@ -0,0 +1,466 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import base64
+import hashlib
+import itertools
+import json
+import logging
+import queue
+import socket
+import struct
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import urlparse, parse_qs
+
+from autofish.memory import MEMORY
+from autofish.metrics import METRICS
+from autofish.supervisor import remoteOperator
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+# ---------------------------------------------------------------------------
+# Control and status API
+# ---------------------------------------------------------------------------
+
+class controlAPI():
+    """ Local HTTP API to supervise a run, e.g. several rigs from one screen.
+
+    Questions to the operator (wait steps, volume verification, failed acquisitions) are answered
+    with commands instead of input() at the console. Endpoints (JSON):
+
+        GET  /status            : round, step, buffer, remaining rounds, pending question of the run.
+        GET  /timeline?since=N  : progress events (steps, volumes, questions, commands) with seq > N.
+        GET  /flow?n=N          : last N measurements of the flow sensor (time, flow).
+        GET  /metrics           : step timing metrics (Prometheus text format).
+        GET  /memory?top=N      : memory samples of the run, and the N largest Python allocations (when tracemalloc is on).
+        GET  /events            : WebSocket, pushes every new timeline event.
+        POST /command           : {"command": name, ...} with the commands
+                                  continue, again (repeat acquisition), stop,
+                                  skip_round (round), requeue_round (round, e.g. a failed round),
+                                  add_round (round, optional priority), move_to_buffer (buffer, refused while a run
+                                  uses the hardware, see Robot.run_lock).
+
+    The server only listens on localhost by default.
+    """
+
+    COMMANDS = ('continue', 'again', 'stop', 'skip_round', 'requeue_round', 'add_round', 'move_to_buffer')
+
+    def __init__(self, R, host='127.0.0.1', port=8765, busy=None, n_keep=1000, logger=None):
+        """__init__ _summary_
+
+        Args:
+            R (Robot): robot of the run.
+            host (str, optional): host to listen on. Defaults to '127.0.0.1'.
+            port (int, optional): port, 0 to pick a free port. Defaults to 8765.
+            busy (callable, optional): returns True while the robot can not be moved, in addition to a running
+                run (see Robot.run_lock). Defaults to None.
+            n_keep (int, optional): number of events kept for the timeline. Defaults to 1000.
+            logger (logging.Logger, optional): logger. Defaults to None.
+        """
+        if isinstance(logger, type(None)):
+            self.logger = logging.getLogger('AUTOMATOR-API')
+            self.logger.setLevel(100)
+        else:
+            self.logger = logger
+
+        self.R = R
+        self.host = host
+        self.port = port
+        self.busy_fn = busy
+
+        self.lock = Lock()
+        self.events = deque(maxlen=n_keep)
+        self.seq = itertools.count(1)
+        self.progress_last = {}
+        self.websockets = []
+
+        self.server = None
+        self.thread = None
+        self.operator = None
+        self.progress_fn = None
+
+    # >>> Connection to the robot
+    def attach(self):
+        """ Questions to the operator and progress of the robot go through the API.
+        """
+        self.operator = remoteOperator(on_prompt=lambda prompt: self.publish('prompt', **prompt))
+        self.R.operator = self.operator
+        self.progress_fn = self.R.progress_fn
+        self.R.progress_fn = self.progress
+        return self
+
+    def progress(self, **info):
+        """ Progress callback of the robot: record, and forward to previous callback.
+        """
+        self.progress_last = info
+        self.publish('progress', **info)
+        if self.progress_fn is not None:
+            self.progress_fn(**info)
+
+    def publish(self, event, **info):
+        """ Add event to the timeline and push it to WebSocket clients.
+        """
+        with self.lock:
+            entry = {'seq': next(self.seq), 'time': round(time.time(), 3), 'event': event, **info}
+            self.events.append(entry)
+            websockets = list(self.websockets)
+
+        # Only queued, a slow client is dropped (see _websocket)
+        message = json.dumps(entry, default=str).encode('utf-8')
+        for ws in websockets:
+            if not ws.send(message):
+                self._remove_websocket(ws)
+
+    def _remove_websocket(self, ws):
+        with self.lock:
+            if ws in self.websockets:
+                self.websockets.remove(ws)
+
+    def busy(self):
+        """ True while the robot is used by a run (or the busy predicate is True).
+        """
+        return self.R.is_running() or (self.busy_fn is not None and bool(self.busy_fn()))
+
+    # >>> Queries
+    def status(self):
+        R = self.R
+        return {'round': R.current_round,
+                'step': R.current_step,
+                'buffer': R.current_buffer,
+                'rounds_available': R.rounds_available,
+                'rounds': R.scheduler.summary(),
+                'stop_requested': R.stop.is_set(),
+                'busy': bool(self.busy()),
+                'progress': self.progress_last,
+                'prompt': self.operator.pending() if self.operator is not None else None}
+
+    def timeline(self, since=0):
+        with self.lock:
+            return [entry for entry in self.events if entry['seq'] > since]
+
+    def flow(self, n=500):
+        """ Last n measurements of the flow sensor (available while pumping with flow monitoring,
+        and after each pump step).
+        """
+        data = getattr(self.R.sensor, 'data', None) or []
+        data = data[-n:]
+        return {'time': [row[1] for row in data], 'flow': [row[2] for row in data]}
+
+    # >>> Commands
+    def command(self, name, **params):
+        """ Execute a command.
+
+        Returns:
+            tuple: (bool, str) if the command was accepted, and a message.
+        """
+        if name not in self.COMMANDS:
+            return False, f'Unknown command {name}, has to be one of {self.COMMANDS}'
+
+        self.publish('command', command=name, **params)
+        R = self.R
+
+        if name in ('continue', 'again'):
+            if self.operator is None or not self.operator.answer(name, params.get('prompt')):
+                return False, f'No pending question with answer {name}'
+            return True, f'Answered {name}'
+
+        elif name == 'stop':
+            R.stop.set()
+            if self.operator is not None:
+                self.operator.answer('stop')
+            return True, 'Stop requested, the run will stop after the current step'
+
+        elif name == 'skip_round':
+            round_id = params.get('round')
+            if round_id not in R.scheduler:
+                return False, f'Round {round_id} is not available'
+            R.scheduler.skip(round_id)
+            return True, f'Round {round_id} will be skipped'
+
+        elif name in ('requeue_round', 'add_round'):
+            round_id = params.get('round')
+            state = R.scheduler.state(round_id)
+            if state == 'running':
+                return False, f'Round {round_id} is running'
+            if name == 'requeue_round' and state is None:
+                return False, f'Round {round_id} is not known'
+            if not R.add_round(round_id, params.get('priority')):
+                return False, f'Round {round_id} can not be added, see log'
+            return True, f'Round {round_id} is {R.scheduler.state(round_id)}'
+
+        elif name == 'move_to_buffer':
+            buffer = params.get('buffer')
+            if buffer not in R.buffer_names:
+                return False, f'Unknown buffer {buffer}'
+
+            # The run lock is held during the move, a run can not start meanwhile
+            if (self.busy_fn is not None and self.busy_fn()) or not R.run_lock.acquire(blocking=False):
+                return False, 'Robot is busy'
+            try:
+                R.select_buffer(buffer)
+            except SystemExit:
+                return False, f'Could not move to buffer {buffer}'
+            finally:
+                R.run_lock.release()
+            return True, f'Moved to buffer {buffer}'
+
+    # >>> Server
+    def start(self):
+        """ Start HTTP server in a background thread.
+        """
+        self.server = ThreadingHTTPServer((self.host, self.port), _make_handler(self))
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.logger.info(f'Control API on http://{self.host}:{self.port}')
+        return self
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for ws in list(self.websockets):
+            ws.close()
+
+
+def _make_handler(api):
+
+    class apiHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Required for the WebSocket upgrade
+
+        def log_message(self, format, *args):
+            api.logger.debug('API: ' + format, *args)
+
+        def _reply(self, code, data, content_type='application/json'):
+            body = data.encode('utf-8') if isinstance(data, str) else json.dumps(data, default=str).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+            if url.path == '/status':
+                self._reply(200, api.status())
+            elif url.path == '/timeline':
+                self._reply(200, api.timeline(int(query.get('since', 0))))
+            elif url.path == '/flow':
+                self._reply(200, api.flow(int(query.get('n', 500))))
+            elif url.path == '/metrics':
+                self._reply(200, METRICS.to_prometheus(), content_type='text/plain; version=0.0.4')
+            elif url.path == '/memory':
+                self._reply(200, {'samples': MEMORY.recent(100), 'trend_mb_h': MEMORY.trend(),
+                                  'heap': MEMORY.snapshot(int(query.get('top', 10)))})
+            elif url.path == '/events' and self.headers.get('Upgrade', '').lower() == 'websocket':
+                self._websocket()
+            else:
+                self._reply(404, {'error': f'Unknown endpoint {url.path}'})
+
+        def do_POST(self):
+            if urlparse(self.path).path != '/command':
+                self._reply(404, {'error': f'Unknown endpoint {self.path}'})
+                return
+            try:
+                params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                name = params.pop('command')
+            except (ValueError, KeyError, AttributeError):
+                self._reply(400, {'error': 'Body has to be JSON with key "command"'})
+                return
+            ok, message = api.command(name, **params)
+            self._reply(200 if ok else 409, {'ok': ok, 'message': message})
+
+        def _websocket(self):
+            key = self.headers.get('Sec-WebSocket-Key', '')
+            accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+            self.send_response(101, 'Switching Protocols')
+            self.send_header('Upgrade', 'websocket')
+            self.send_header('Connection', 'Upgrade')
+            self.send_header('Sec-WebSocket-Accept', accept)
+            self.end_headers()
+            self.wfile.flush()
+
+            ws = _websocket(self.connection)
+            with api.lock:
+                api.websockets.append(ws)
+
+            # Only server push: wait until client closes the connection
+            ws.wait_close(self.rfile)
+            api._remove_websocket(ws)
+            ws.close()
+            ws.thread.join(ws.timeout)
+            self.close_connection = True
+
+    return apiHandler
+
+
+class _websocket():
+    """ Server side of a WebSocket connection, sends text frames.
+
+    Frames are queued (bounded) and sent by a sender thread, so that a slow client never blocks the
+    thread publishing the events (e.g. the fluidics). A client that falls behind (queue full, or a
+    frame not sent within timeout) is dropped.
+    """
+
+    def __init__(self, sock, queue_size=256, timeout=5):
+        self.sock = sock
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.t_send = None    # Start of the frame being sent
+        self.closed = False
+        self.thread = Thread(target=self._send_frames, daemon=True)
+        self.thread.start()
+
+    def send(self, payload, opcode=0x1):
+        """ Queue a frame.
+
+        Returns:
+            bool: False if the client was dropped (falls behind, or connection closed).
+        """
+        if self.closed:
+            return False
+        t_send = self.t_send
+        if t_send is not None and time.monotonic() - t_send > self.timeout:
+            self.drop()
+            return False
+        try:
+            self.queue.put_nowait(self._frame(payload, opcode))
+        except queue.Full:
+            self.drop()
+            return False
+        return True
+
+    @staticmethod
+    def _frame(payload, opcode):
+        n = len(payload)
+        if n < 126:
+            header = struct.pack('!BB', 0x80 | opcode, n)
+        elif n < 2**16:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, n)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, n)
+        return header + payload
+
+    def _send_frames(self):
+        while (frame := self.queue.get()) is not None:
+            self.t_send = time.monotonic()
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                self.drop()
+                return
+            self.t_send = None
+
+    def drop(self):
+        """ Close the connection without closing handshake, unblocks the sender and the reader.
+        """
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def wait_close(self, rfile):
+        """ Read (and ignore) frames of the client until it closes the connection.
+        """
+        try:
+            while True:
+                header = rfile.read(2)
+                if len(header) < 2:
+                    return
+                opcode, n = header[0] & 0x0F, header[1] & 0x7F
+                if n == 126:
+                    n = struct.unpack('!H', rfile.read(2))[0]
+                elif n == 127:
+                    n = struct.unpack('!Q', rfile.read(8))[0]
+                rfile.read((4 if header[1] & 0x80 else 0) + n)
+                if opcode == 0x8:
+                    self.close()
+                    return
+        except OSError:
+            return
+
+    def close(self):
+        """ Send the close frame (after the queued frames) and stop the sender.
+        """
+        if self.send(b'', opcode=0x8):
+            self.closed = True
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                self.drop()
+
+
+# ---------------------------------------------------------------------------
+# Clients
+# ---------------------------------------------------------------------------
+
+class apiClient():
+    """ Client of the control API over HTTP.
+    """
+
+    def __init__(self, url='http://127.0.0.1:8765', timeout=10):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _get(self, path):
+        with urllib.request.urlopen(self.url + path, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def status(self):
+        return self._get('/status')
+
+    def timeline(self, since=0):
+        return self._get(f'/timeline?since={since}')
+
+    def flow(self, n=500):
+        return self._get(f'/flow?n={n}')
+
+    def command(self, name, **params):
+        """ Send command.
+
+        Returns:
+            tuple: (bool, str) if the command was accepted, and a message.
+        """
+        request = urllib.request.Request(self.url + '/command', data=json.dumps({'command': name, **params}).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                reply = json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            reply = json.loads(e.read())
+        return reply.get('ok', False), reply.get('message', reply.get('error'))
+
+
+class localClient():
+    """ Stand-in for apiClient, calls the API in the same process (without HTTP server), e.g. for tests.
+    """
+
+    def __init__(self, api):
+        self.api = api
+
+    def status(self):
+        return json.loads(json.dumps(self.api.status(), default=str))
+
+    def timeline(self, since=0):
+        return json.loads(json.dumps(self.api.timeline(since), default=str))
+
+    def flow(self, n=500):
+        return self.api.flow(n)
+
+    def command(self, name, **params):
+        return self.api.command(name, **params)
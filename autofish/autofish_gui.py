@@ -6,14 +6,15 @@ autoFISH GUI
 # Imports
 # ---------------------------------------------------------------------------
 import PySimpleGUI as sg
-import logging
-import threading
 from datetime import datetime
 import pathlib
 import autofish
 from autofish.automator import Robot
 from autofish.imager import pycroManager, fileSync_write, fileSync_create, TTL_sync
 from autofish.coordinator import Controller
+from autofish.jobs import jobExecutor
+from autofish.logs import setup_logging
+from autofish.metrics import METRICS, prometheusWriter
 from importlib.metadata import version
 # ---------------------------------------------------------------------------
 # Functions
@@ -30,6 +31,13 @@ def name(name):
     return sg.Text(name + ' ' + '•'*dots, size=(NAME_SIZE, 1), justification='r', pad=(0, 0), font='Courier 10')
 
 
+def update_round_list(window, R):
+    """ Rounds that can be run: runnable rounds in the order they will be run, then failed rounds.
+    """
+    rounds = R.rounds_available + R.scheduler.rounds('failed')
+    window['-SEQ_LIST-'].update(values=rounds, value=rounds[0] if rounds else '')
+
+
 # Window for launch pad
 def make_window_control():
     layout = [[sg.Text('Specify fluidics & acquisition system!')],
@@ -38,10 +46,17 @@ def make_window_control():
               [sg.HorizontalSeparator()],
               [sg.Button('Initiate controller', key='-INITIATE_CONTROL-', disabled=True)],
               [sg.HorizontalSeparator()],
-              [sg.Button('RUN all ROUNDS!', key='-RUN_ALL_ROUNDS-', disabled=True)
-               #sg.Button('STOP sequential RUN', key='-STOP_SEQ-', disabled=True)
+              [sg.Button('RUN all ROUNDS!', key='-RUN_ALL_ROUNDS-', disabled=True),
+               sg.Button('STOP sequential RUN', key='-STOP_SEQ-', disabled=True)
                ],
               [sg.Text(''),      sg.Text('                                 ', key='-OUTPUT_DIR_SAVE_IMGS-')],
+              [sg.Text('', size=(60, 1), key='-JOB_STATUS-')],
+              [sg.HorizontalSeparator()],
+              [sg.Text('Resume from journal:'),
+               sg.FileBrowse(file_types=(("journal", 'journal__*.jsonl'),), target='-JOURNAL_FILE-'),
+               sg.InputText('specify-journal-file', key='-JOURNAL_FILE-', size=(30, 1)),
+               sg.Button('RESUME run', key='-RESUME_RUN-', disabled=True)],
+              [sg.Button('Show step timing', key='-SHOW_METRICS-')],
               ]
 
     return sg.Window('Automator - automate sequential FISH', layout, location=(800, 600), finalize=True)
@@ -163,14 +178,18 @@ def make_window_fluidics():
         [sg.Checkbox('Verify flow', default=False, key='-FLOW_verify-'),
          sg.Text('Expected flow [ml/min]'), sg.InputText(size=(4, None), key='-FLOW_expected-', default_text='0.45'),
          sg.Text('Tolerance'), sg.InputText(size=(4, None), key='-FLOW_tol-', default_text='0.25')],
+        [sg.Text('Air from buffer: '),
+         sg.Combo(['none'], default_value='none', key='-BUFFER_AIR-'),
+         sg.Button('Calibrate dead volumes', key='-CALIBRATE_DEAD_VOLUME-', disabled=True)],
 
         [sg.HorizontalSeparator()],
         [sg.Text(' >>  Run sequences <<')],
         [sg.Text('Choose sequence: '),
          sg.Combo(['To-be-specified'], key='-SEQ_LIST-'),
-         sg.Button('RUN sequence', key='-RUN_SEQ-', disabled=True)
-         #sg.Button('STOP sequence', key='-STOP_SEQ-', disabled=False)
+         sg.Button('RUN sequence', key='-RUN_SEQ-', disabled=True),
+         sg.Button('STOP sequence', key='-STOP_SEQ-', disabled=True)
          ],
+        [sg.Text('', size=(60, 1), key='-JOB_STATUS-')],
 
         #[sg.HorizontalSeparator()],
         #[sg.Text(' Pippette robot status'),
@@ -191,25 +210,19 @@ def main():
     M = None  # Microscope
     C = None  # Coordinator
 
-    # >>> Logger
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
-
+    # >>> Logger: records are written to disk and console by a listener thread
     now = datetime.now()
     data_string = now.strftime("%Y-%m-%d__%H-%M")
     f_log = f'fluidics__{data_string}.log'
-    logger_stream = logging.getLogger('Automator-GUI-STREAM')  # Logs the name of the function
-    logger_stream.setLevel(logging.DEBUG)  # DEBUG, INFO, ERROR, CRITICAL
-    handler_stream = logging.StreamHandler()
-    handler_stream.setFormatter(formatter)
-    logger_stream.addHandler(handler_stream)
-
-    logger = logging.getLogger('Automator-GUI')  # Logs the name of the function
-    logger.setLevel(logging.DEBUG)  # DEBUG, INFO, ERROR, CRITICAL
-    handler = logging.FileHandler(f_log, 'w')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-
-    logger_stream.info(f'More detailed log file can be found here {handler.baseFilename}.')
+    logger, logger_stream, log_listener = setup_logging(f_log)
+
+    # >>> Step timing metrics, also written periodically as Prometheus text file
+    metrics_writer = prometheusWriter(METRICS, f'metrics__{data_string}.prom', logger=logger).start()
+
+    # >>> Worker threads for robot and coordinator operations (keeps GUI responsive)
+    jobs = jobExecutor(window=win_ctrl, logger=logger)
+
+    logger_stream.info(f'More detailed log file can be found here {pathlib.Path(f_log).resolve()}.')
     logger_stream.info(f"Using autofish version {version('autofish')}.")
     logger.info(f"Using autofish version {version('autofish')}.")
 
@@ -224,6 +237,7 @@ def main():
 
             if window == win_ctrl:            # if closing control window, exit program
                 window.close()
+                jobs.cancel()
                 try:
                     if (R is not None) and not R.status['demo']:
                         try:
@@ -244,6 +258,10 @@ def main():
                         except:
                             logger.error('No serial port .')
 
+                    # Worker threads and processes of the microscope
+                    if M is not None:
+                        M.close()
+
                 except (UnboundLocalError, AttributeError) as e:
                     logger_stream.error('Could not close serial connections')
                     logger.error('Could not close serial connections')
@@ -260,11 +278,18 @@ def main():
             else:
                 win_ctrl['-INITIATE_CONTROL-'].update(disabled=True)
 
-            if C:
+            if C and not jobs.busy():
                 win_ctrl['-RUN_ALL_ROUNDS-'].update(disabled=False)
             else:
                 win_ctrl['-RUN_ALL_ROUNDS-'].update(disabled=True)
 
+            win_ctrl['-STOP_SEQ-'].update(disabled=not jobs.busy())
+
+            if C and not jobs.busy() and win_ctrl['-JOURNAL_FILE-'].get() != 'specify-journal-file':
+                win_ctrl['-RESUME_RUN-'].update(disabled=False)
+            else:
+                win_ctrl['-RESUME_RUN-'].update(disabled=True)
+
         # > Fluidics control
         if win_fluidics:
 
@@ -328,6 +353,19 @@ def main():
                 # Disable verify flow is no sensor is specified
                 if  R.sensor == None:
                     win_fluidics['-FLOW_verify-'].update(disabled=True)
+
+                # Calibration of dead volumes requires flow sensor and zeroed robot
+                win_fluidics['-CALIBRATE_DEAD_VOLUME-'].update(disabled=not (R.sensor and R.status['experiment_config']
+                                                                              and R.status['robot_zeroed'] and not jobs.busy()))
+
+                # Only one robot operation at a time
+                if jobs.busy():
+                    win_fluidics['-RUN_SEQ-'].update(disabled=True)
+                    win_fluidics['-SELECT_BUFFER-'].update(disabled=True)
+                    win_fluidics['-MOVE_ZERO-'].update(disabled=True)
+                    win_fluidics['-PUMP-'].update(disabled=True)
+
+            win_fluidics['-STOP_SEQ-'].update(disabled=not jobs.busy())
                     
 
         # >> pycromanger control
@@ -370,6 +408,30 @@ def main():
         #            if R.status['ports_assigned']:
         #                win_fluidics.Element('-PLATE-STATUS-').update(value=R.plate.check_stage())
 
+        # ******************************************************************************************************
+        # >> Progress of jobs running in worker threads
+        # ******************************************************************************************************
+        elif event == '-JOB_PROGRESS-':
+            info = values[event]
+            txt_status = ', '.join(f'{key}: {val}' for key, val in info.items())
+            for win in (win_ctrl, win_fluidics):
+                if win:
+                    win['-JOB_STATUS-'].update(txt_status)
+
+        elif event == '-JOB_DONE-':
+            info = values[event]
+            logger_stream.info(f'Job {info["job"]} {info["status"]} after {info["duration"]} s.')
+            for win in (win_ctrl, win_fluidics):
+                if win:
+                    win['-JOB_STATUS-'].update(f'{info["job"]}: {info["status"]}')
+
+            # Buffer is only selected once the robot and valve reached it
+            if R is not None and info['job'].startswith('select buffer '):
+                R.status['buffer_selected'] = info['status'] == 'done'
+
+            if R is not None and R.status['experiment_config'] and win_fluidics:
+                update_round_list(win_fluidics, R)
+
         # ******************************************************************************************************
         # >> Main control interface
         # ******************************************************************************************************
@@ -389,6 +451,10 @@ def main():
         elif event == '-Window-Fluidics-' and not win_fluidics:
             win_fluidics = make_window_fluidics()
 
+        elif event == '-SHOW_METRICS-':
+            sg.popup_scrolled(METRICS.format_snapshot(), title='Step timing', font='Courier 10',
+                              size=(90, 20), non_blocking=True)
+
         elif event == 'Popup':
             sg.popup('This is a BLOCKING popup', 'all windows remain inactive while popup active')
 
@@ -396,8 +462,12 @@ def main():
             C = Controller(Robot=R, Microscope=M, logger=logger, logger_short=logger_stream)
 
         elif event == '-RUN_ALL_ROUNDS-':
-            C.run_all_rounds(dir_save=win_ctrl["-OUTPUT_DIR_SAVE_IMGS-"].get())
-            win_fluidics['-SEQ_LIST-'].update(values=R.rounds_available)
+            jobs.submit('all rounds', C.run_all_rounds, stop=R.stop,
+                        dir_save=win_ctrl["-OUTPUT_DIR_SAVE_IMGS-"].get())
+
+        elif event == '-RESUME_RUN-':
+            dir_save = win_ctrl["-OUTPUT_DIR_SAVE_IMGS-"].get().strip() or None
+            jobs.submit('resume run', C.resume, values['-JOURNAL_FILE-'], stop=R.stop, dir_save=dir_save)
 
         # ******************************************************************************************************
         # >> text file sync : write
@@ -469,6 +539,7 @@ def main():
 
             try:
                 R = Robot(values['-CONFIG_SYSTEM-'], logger=logger, logger_short=logger_stream)
+                R.progress_fn = jobs.progress
                 R.initiate_system()
                 window['-INITIATE_SYSTEM-'].update(disabled=True)
 
@@ -482,8 +553,8 @@ def main():
                 R.load_config_experiment(values['-EXP_FILE-'])
                 window['-BUFFER_LIST-'].update(values=R.buffer_names)
                 window['-BUFFER_LIST-'].update(value=R.buffer_names[0])
-                window['-SEQ_LIST-'].update(values=R.rounds_available)
-                window['-SEQ_LIST-'].update(value=R.rounds_available[0])
+                window['-BUFFER_AIR-'].update(values=['none'] + R.buffer_names, value='none')
+                update_round_list(window, R)
                 window['-OUTLET_VALVE_LIST-'].update(values=R.valve_out_settings['positions'])
                 window['-OUTLET_VALVE_LIST-'].update(value=R.valve_out_settings['positions'][0])
                 R.status['experiment_config'] = True
@@ -561,14 +632,14 @@ def main():
                 logger.error(e)
 
         elif event == '-MOVE_ZERO-':
-            R.plate.move_zero()
+            jobs.submit('move to zero', R.plate.move_zero)
 
         # >>>>> Priming/WASHING lines
         elif event == '-SELECT_BUFFER-':
             try:
                 buffer_sel = values['-BUFFER_LIST-']
-                R.select_buffer(buffer_sel)
-                R.status['buffer_selected'] = True
+                R.status['buffer_selected'] = False  # Set when the job is done (-JOB_DONE-)
+                jobs.submit(f'select buffer {buffer_sel}', R.select_buffer, buffer_sel, stop=R.stop)
 
             except (UnboundLocalError, AttributeError) as e:
                 logger.error(f'Could not select buffer: {buffer_sel}')
@@ -581,13 +652,18 @@ def main():
                 R.flow['expected'] = float(values['-FLOW_expected-'])
                 R.flow['tolerance'] = float(values['-FLOW_tol-'])
 
-                R.pump_run(pump_time)
+                jobs.submit(f'pump {pump_time} s', R.pump_run, pump_time, stop=R.stop)
                 R.status['buffer_selected'] = False
 
             except (UnboundLocalError, AttributeError) as e:
                 logger_stream.error(f'Could not activate pump for specified duration: {pump_time}')
                 logger.error(e)
 
+        elif event == '-CALIBRATE_DEAD_VOLUME-':
+            buffer_air = values['-BUFFER_AIR-']
+            buffer_air = None if buffer_air == 'none' else buffer_air
+            jobs.submit('calibrate dead volumes', R.calibrate_dead_volume, buffer_air=buffer_air, stop=R.stop)
+
         # >>>>> Outlet valve
         elif event == '-SELECT_OUTLET_VALVE-':
             try:
@@ -603,14 +679,7 @@ def main():
         elif event == '-RUN_SEQ-':
             try:
                 round_id = values['-SEQ_LIST-']
-                run_single_round_thread = threading.Thread(target=R.run_single_round,
-                                                           args=(round_id,))
-                run_single_round_thread.start()
-                run_single_round_thread.join()  # Interpreter will wait until your process get completed or terminated
-                window['-SEQ_LIST-'].update(values=R.rounds_available)
-
-                if len(R.rounds_available) > 0:
-                    window['-SEQ_LIST-'].update(value=R.rounds_available[0])
+                jobs.submit(f'round {round_id}', R.run_single_round, round_id, stop=R.stop)
 
             except (UnboundLocalError, AttributeError) as e:
                 logger_stream.error(f'Could not run round: {round_id}')
@@ -618,17 +687,12 @@ def main():
                 logger.error(e)
 
         elif event == '-STOP_SEQ-':
-            try:
-                round_id = values['-SEQ_LIST-']
-                R.stop.set()
-                if not run_single_round_thread.is_alive():
-                    logger.info('Robot stopped')
-            except (UnboundLocalError, AttributeError) as e:
-                logger_stream.error(f'Could not STOP round: {round_id}')
-                logger.error(f'Could not STOP round: {round_id}')
-                logger.error(e)
+            logger_stream.info('Stopping robot after the current action.')
+            jobs.cancel()
 
     window.close()
+    metrics_writer.close()
+    log_listener.stop()
 
 
 if __name__ == '__main__':
@@ -7,25 +7,43 @@ import time
 import re
 import json
 import yaml
-import logging
 from datetime import datetime
 import math
-from threading import Event
+from threading import Event, RLock
+import functools
 from itertools import compress
 import os
-import numpy as np
 import csv
 from pathlib import Path
 import importlib
 
 from importlib.metadata import version
 
+from autofish.logs import logMixin, device_logger
+from autofish.metrics import METRICS
+from autofish.journal import runJournal, read_journal, journal_state
+from autofish.volumelog import volumeLog
+from autofish.calibration import pumpCalibration
+from autofish.supervisor import consoleOperator
+from autofish.devicestate import stateCache
+from autofish.scheduler import roundScheduler
+
 # ---------------------------------------------------------------------------
 #  ROBOT class: manages the entire fluidics system
 # ---------------------------------------------------------------------------
 
+def _holds_run_lock(fn):
+    """ Method uses the hardware for a run, other threads can not move the robot meanwhile (see Robot.run_lock).
+    """
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        with self.run_lock:
+            return fn(self, *args, **kwargs)
+    return wrapper
+
+
 
-class Robot():
+class Robot(logMixin):
     """
     == demo mode
     Can be use in "demo" mode (via the fluidics_config.json file). Here, no
@@ -47,17 +65,7 @@ class Robot():
         }
 
         # Setup logger
-        if isinstance(logger, type(None)):
-            self.logger = logging.getLogger('AUTOMATOR-Robot')  # Logs the name of the function
-            self.logger.setLevel(100)
-        else:
-            self.logger = logger
-
-        if isinstance(logger_short, type(None)):
-            self.logger_short = logging.getLogger('AUTOMATOR-Robot')  # Logs the name of the function
-            self.logger_short.setLevel(100)
-        else:
-            self.logger_short = logger_short
+        self.setup_loggers(logger, logger_short, name='AUTOMATOR-Robot', name_short='AUTOMATOR-Robot')
 
         # Log version
         self.log_msg('info', f"Using autofish version {version('autofish')}.")
@@ -69,6 +77,8 @@ class Robot():
 
         # For threading
         self.stop = Event()
+        self.progress_fn = None     # Called with progress information, e.g. jobExecutor.progress
+        self.operator = consoleOperator()  # Asks the operator, e.g. remoteOperator with the control API
 
         # flow measurements
         self.flow = {
@@ -77,8 +87,8 @@ class Robot():
             'tolerance': None
         }
 
-        self.volume_measurements = []
-        self.volume_measurements.append(['Time', 'round', 'buffer', 'duration', 'vol_expected', 'vol_measured'])
+        # Append-only log of volume measurements (opened with the first measurement)
+        self.volume_log = None
 
         # General robot configuration
         self.hardware_components = ["pump", "plate", "valve_in", "valve_out", "flow_sensor"]
@@ -87,8 +97,23 @@ class Robot():
         self.buffer_names = []
         self.current_buffer = None
         self.current_round = 'NA'
+        self.current_step = None
+        self.run_lock = RLock()       # Held while a run uses the hardware (rounds, acquisitions, moves between rounds)
         self.file_volume_measurements = None
         self.sensor = None
+        self.flow_monitor = None
+        self.pump_calibration = None  # Dead volumes of buffers, to trim pump durations
+        self.prefetch = None          # Settings to prefetch the next buffer during pauses (optional)
+        self.prefetch_next = None     # Buffer to prefetch during the current pause
+        self.prefetched = None        # Buffer filled up to the chamber by the last prefetch
+        self.optimizer = None         # Optimizes the steps of each round (optional)
+        self.scheduler = roundScheduler()  # State and order of rounds
+        self.actors = {}              # Actors running the device controllers (optional)
+        self.device_states = {}       # Last known state of each device, kept when controllers are re-created
+
+        # Journal of completed steps, and state of an interrupted round when resuming
+        self.journal = None
+        self.resume_state = None
 
         # Load robot configuration (but don't initiate the components)
         self.config_file_system = config_file_system
@@ -97,39 +122,59 @@ class Robot():
         # Finished
         self.log_msg('info', 'Robot ready to be initiated.')
 
-    # Function to handle both logging calls and different logging types
-    def log_msg(self, type, msg, msg_short=''):
-        """log_msg _summary_
+    @property
+    def rounds_available(self):
+        """ Rounds that will be run, in the order they will be run (see scheduler).
+        """
+        return self.scheduler.runnable()
+
+    def is_running(self):
+        """ True while another thread holds the run lock, i.e. a run uses the hardware.
+        """
+        if self.run_lock.acquire(blocking=False):
+            self.run_lock.release()
+            return False
+        return True
+
+    def add_round(self, round_id, priority=None):
+        """ Add a round while the experiment is running, or run a round again (e.g. a failed round).
+        All buffers of the round have to be defined in the buffer list.
 
         Args:
-            type (_type_): _description_
-            msg (str): _description_
-            msg_short (str, optional): _description_. Defaults to ''.
+            round_id (str): round id.
+            priority (float, optional): lower runs first. Defaults to last for new rounds, first for known rounds.
+
+        Returns:
+            bool: True if round was added.
         """
+        buffers_round = self.buffers_round_all.get(round_id, self.buffers_round_all['default'])
+        missing = [buffer + round_id for buffer in buffers_round if buffer + round_id not in self.buffer_names]
+        if missing:
+            self.log_msg('error', f'Round {round_id} can not be added, buffers not defined: {missing}')
+            return False
 
-        if type == 'info':
-            self.logger.info(msg)
-            if msg_short:
-                self.logger_short.info(msg_short)
-            else:
-                self.logger_short.info(msg)
+        self.scheduler.add(round_id, priority)
+        self.log_msg('info', f'Round {round_id} added ({self.scheduler.state(round_id)}), available rounds: {self.rounds_available}')
+        return True
 
-        elif type == 'error':
-            self.logger.error(msg)
-            if msg_short:
-                self.logger_short.error(msg_short)
-            else:
-                self.logger_short.error(msg)
+    def report_progress(self, **info):
+        """ Report progress (e.g. step, remaining time, measured volume) to the progress callback.
+        """
+        if self.progress_fn is not None:
+            info.setdefault('round', self.current_round)
+            self.progress_fn(**info)
 
     # Pause for specifid duration in seconds
     def pause(self, sleep_time):
-        """ Pauses robot for indicated duration in seconds.
+        """ Pauses robot for indicated duration in seconds. Returns earlier when the robot is stopped.
 
         Args:
             sleep_time (int): time to sleep in seconds.
         """
 
-        time.sleep(int(sleep_time))
+        # Measurements are on disk before the robot is idle for a while
+        self.save_volume_measurements()
+        self.stop.wait(int(sleep_time))
         self.logger.info('Paused for '+str(sleep_time))
 
     def verify_flow(self, duration, volume_measured):
@@ -149,34 +194,37 @@ class Robot():
         vol_diff = abs(volume_measured-volume_expected)/volume_expected
         self.log_msg('info', f'VOLUME. measured {volume_measured} ml, expected {volume_expected} ml -> diff {round(100*vol_diff)} %')
 
-        now = datetime.now()
-        current_time = now.strftime("%H:%M:%S")
-        self.volume_measurements.append([current_time,
-                                        self.current_round,
-                                        self.current_buffer,
-                                        duration,
-                                        volume_expected,
-                                        volume_measured])
-
         if vol_diff > tol:
             self.log_msg('error', 'Measured volume is outside of specified tolerance of expected volume. WILL STOP, user verification required.')
-            # ToDo: add a real verification
-            input("Press Enter to continue... ")
+            answer = self.operator.ask('Measured volume is outside of tolerance. Continue?', options=('continue', 'stop'), stop=self.stop)
+            if answer == 'stop':
+                self.stop.set()
 
-    def save_volume_measurements(self):
-        """save_volume_measurements _summary_
+    def log_volume_measurement(self, **data):
+        """ Append a volume measurement to the volume log. The log is created next to the
+        experiment config with the first measurement (volume_log__<date>.csv).
 
         Args:
-            file_save (_type_, optional): _description_. Defaults to None.
+            data: columns of the volume log, see volumeLog.COLUMNS.
         """
-        if not self.file_volume_measurements:
-            now = datetime.now()
-            data_string = now.strftime("%Y-%m-%d_%H-%M")
-            self.file_volume_measurements = str(Path(self.config_file_experiment).parent / f'volume_log__{data_string}.csv')
+        if self.volume_log is None:
+            if not self.file_volume_measurements:
+                now = datetime.now()
+                data_string = now.strftime("%Y-%m-%d_%H-%M")
+                self.file_volume_measurements = str(Path(self.config_file_experiment).parent / f'volume_log__{data_string}.csv')
+            self.volume_log = volumeLog(self.file_volume_measurements)
+
+        self.volume_log.write(Time=datetime.now().strftime("%H:%M:%S"),
+                              round=self.current_round,
+                              step=self.current_step,
+                              buffer=self.current_buffer,
+                              **data)
 
-        with open(self.file_volume_measurements, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerows(self.volume_measurements)
+    def save_volume_measurements(self):
+        """ Make sure that all volume measurements are written to disk.
+        """
+        if self.volume_log is not None:
+            self.volume_log.sync()
 
     def pump_run(self, pump_time):
         """pump_run _summary_
@@ -188,12 +236,18 @@ class Robot():
         if self.sensor:
             self.sensor.start()
 
-        # Start pump for specified duration
+        # Start pump for specified duration (stops earlier when robot is stopped)
         self.log_msg('info', f'Starting pump for {pump_time}s.')
-        self.pump.start()
-        time.sleep(pump_time)
-        self.pump.stop()
-        self.log_msg('info', f'Pump was running for {int(pump_time)} s.')
+        if self.sensor and self.flow_monitor:
+            pump_duration_raw = round(self.pump_monitored(pump_time), 3)
+        else:
+            t_start = time.perf_counter()
+            with METRICS.span('pump_run', 'pump'):
+                self.pump.start()
+                self.stop.wait(pump_time)
+                self.pump.stop()
+            pump_duration_raw = round(time.perf_counter() - t_start, 3)
+        self.log_msg('info', 'Pump was running for %d s.', pump_time, device='pump', duration=pump_time)
 
         time.sleep(1)
 
@@ -204,14 +258,289 @@ class Robot():
             # Make sure that volume was returned (None for problems)
             if volume_measured is not None:
                 self.log_msg('info', f'Measured volume: {volume_measured} ml')
+                self.report_progress(step='pump', duration=pump_time, volume=volume_measured)
+
+                volume_expected = None
+                if self.flow['expected']:
+                    volume_expected = round(self.flow['expected']*pump_time / 60, 3)
+                flow_stats = getattr(self.sensor, 'flow_stats', None) or {}
+                self.log_volume_measurement(duration=pump_time,
+                                            pump_duration_raw=pump_duration_raw,
+                                            vol_expected=volume_expected,
+                                            vol_measured=volume_measured,
+                                            **{f'flow_{key}': value for key, value in flow_stats.items()})
 
                 if self.flow['verify']:
-                    self.verify_flow(pump_time, volume_measured)
+                    with METRICS.span('verify_flow', 'flow_sensor'):
+                        self.verify_flow(pump_time, volume_measured)
             else:
                 self.log_msg('error', 'No volume measurement returned. Check sensor!')
 
+    def pump_monitored(self, pump_time):
+        """ Run pump while the live flow is monitored for anomalies (bubbles, occlusions, empty wells).
+        When an anomaly is detected, the pump is stopped and the configured action is taken:
+            abort   : stop the run.
+            reprime : move again to the current buffer, and pump for the remaining time.
+            pause   : wait for the operator, and pump for the remaining time.
+
+        Args:
+            pump_time (float): pump duration in seconds.
+
+        Returns:
+            float: time the pump was running in seconds.
+        """
+        monitor = self.flow_monitor
+        n_reprime = 0
+        time_remaining = pump_time
+        time_pumped = 0
+
+        while time_remaining > 0 and not self.stop.is_set():
+            monitor.reset()
+            self.sensor.read(keep=False)  # Discard measurements while pump was stopped
+
+            anomaly = None
+            t_start = time.perf_counter()
+            t_end = t_start + time_remaining
+            with METRICS.span('pump_run', 'pump'):
+                self.pump.start()
+                while anomaly is None and not self.stop.is_set() and (t_wait := t_end - time.perf_counter()) > 0:
+                    self.stop.wait(min(monitor.poll_interval, t_wait))
+                    anomaly = monitor.update(*self.sensor.read())
+                self.pump.stop()
+
+            time_pumped += time.perf_counter() - t_start
+            time_remaining = t_end - time.perf_counter()
+            if anomaly is None:
+                break
+
+            METRICS.increment(f'flow_anomaly_{anomaly}')
+            self.log_msg('error', f'Flow anomaly detected: {anomaly} after {time_pumped:.1f} s, {max(0, time_remaining):.1f} s remaining.',
+                         device='flow_sensor')
+            self.report_progress(step='pump', anomaly=anomaly, remaining_pump=round(max(0, time_remaining), 1))
+
+            action = monitor.action
+            if action == 'reprime' and n_reprime >= monitor.max_reprime:
+                self.log_msg('warning', f'Flow anomaly persists after {n_reprime} re-prime(s), will pause.')
+                action = 'pause'
+
+            if action == 'abort':
+                self.sensor.stop()
+                self.log_msg('error', 'Pumping aborted because of flow anomaly. WILL STOP.')
+                raise SystemExit
+
+            elif action == 'reprime':
+                n_reprime += 1
+                self.log_msg('info', f'Re-priming from buffer {self.current_buffer}.')
+                if self.current_buffer is not None:
+                    self.select_buffer(self.current_buffer, force=True)
+
+            elif action == 'pause':
+                self.log_msg('info', 'WAITING FOR USER INPUT ... check tubing and wells, then continue pumping.')
+                answer = self.operator.ask('Flow anomaly: check tubing and wells. Continue pumping?', options=('continue', 'stop'), stop=self.stop)
+                if answer == 'stop':
+                    self.stop.set()
+
+        return time_pumped
+
+    def pump_duration(self, duration):
+        """ Pump duration for the current buffer: trimmed to the minimal duration if the dead
+        volume of the buffer is calibrated (see calibrate_dead_volume). The minimal duration is computed
+        for the expected flow rate (flow settings), or for the flow rate of the calibration.
+
+        Args:
+            duration (float): pump duration in seconds specified in the sequence.
+
+        Returns:
+            float: pump duration in seconds.
+        """
+        if self.pump_calibration is None or self.current_buffer is None:
+            return duration
+        position = self.experiment_config['buffers'].get(self.current_buffer)
+        return self.pump_calibration.pump_duration(self.current_buffer, duration, flow=self.flow['expected'], position=position)
+
+    def prefetch_duration(self, buffer):
+        """ Pump duration to fill the line of a buffer up to the chamber junction: from the
+        prefetch settings, or from the calibrated dead volume of the buffer.
+
+        Returns:
+            float: duration in seconds, None if not known.
+        """
+        if 'duration' in self.prefetch:
+            return self.prefetch['duration']
+        if self.pump_calibration is not None:
+            position = self.experiment_config['buffers'].get(buffer)
+            return self.pump_calibration.fill_duration(buffer, flow=self.flow['expected'], position=position)
+        return None
+
+    def pause_prefetch(self, sleep_time, buffer):
+        """ Pause, and prefetch the next buffer towards the end of the pause: the outlet valve
+        routes to waste (bypassing the chamber), the robot moves to the buffer and the line is filled up
+        to the chamber junction. The outlet valve is then switched back to the chamber, and the following
+        pump step only has to exchange the chamber volume (see pump_duration_prefetched).
+
+        Falls back to a normal pause when the pause is too short or the fill duration is not known.
+
+        Args:
+            sleep_time (int): duration of pause in seconds.
+            buffer (str): next buffer.
+        """
+        t_fill = self.prefetch_duration(buffer)
+        if t_fill is None or self.valve_out is None:
+            self.log_msg('warning', f'Cannot prefetch buffer {buffer} (unknown fill duration or no outlet valve).')
+            self.pause(sleep_time)
+            return
+
+        t_wait = sleep_time - t_fill - self.prefetch.get('margin', 30)
+        if t_wait < 0:
+            self.log_msg('info', f'Pause of {sleep_time}s too short to prefetch buffer {buffer}.')
+            self.pause(sleep_time)
+            return
+
+        self.pause(t_wait)
+        if self.stop.is_set():
+            return
+
+        self.log_msg('info', f'Prefetching buffer {buffer} ({t_fill}s to waste)')
+        t_start = time.monotonic()
+        with METRICS.span('prefetch', 'robot'):
+            with METRICS.span('valve_move', 'valve_out'):
+                self.valve_out.move(self.prefetch['valve_waste'])
+            self.select_buffer(buffer)
+            self.pump_run(t_fill)
+            with METRICS.span('valve_move', 'valve_out'):
+                self.valve_out.move(self.prefetch['valve_chamber'])
+        self.prefetched = buffer
+        self.report_progress(step='prefetch', param=buffer)
+
+        t_remaining = sleep_time - t_wait - (time.monotonic() - t_start)
+        if t_remaining > 0:
+            self.pause(t_remaining)
+
+    def pump_duration_prefetched(self, duration):
+        """ Pump duration of the step following a prefetch: time to exchange the chamber volume
+        (calibrated), or the specified duration minus the time already pumped for the prefetch, but
+        at least the time to exchange the chamber volume at the expected flow rate. Without the chamber
+        exchange time, the specified duration is pumped.
+
+        Args:
+            duration (float): pump duration in seconds specified in the sequence.
+
+        Returns:
+            float: pump duration in seconds.
+        """
+        flow = self.flow['expected']
+        duration_exchange = None
+        if self.pump_calibration is not None:
+            position = self.experiment_config['buffers'].get(self.current_buffer)
+            duration_chamber = self.pump_calibration.chamber_duration(self.current_buffer, flow=flow, position=position)
+            if duration_chamber is not None:
+                return min(duration, duration_chamber)
+            duration_exchange = self.pump_calibration.exchange_duration(flow)
+
+        if duration_exchange is None:
+            self.log_msg('info', f'Chamber exchange time of buffer {self.current_buffer} not known, pumping {duration}s.')
+            return duration
+
+        duration_prefetched = max(duration - self.prefetch_duration(self.current_buffer), duration_exchange)
+        self.log_msg('info', f'Buffer {self.current_buffer} not calibrated, pumping {min(duration, duration_prefetched)}s '
+                             f'(at least {duration_exchange}s to exchange the chamber).')
+        return min(duration, duration_prefetched)
+
+    def prefetch_buffer(self, steps, i_step, round_id):
+        """ Buffer that can be prefetched during a pause: the pause has to be followed by a
+        buffer and a pump step, and the buffer has to be different from the current buffer.
+
+        Args:
+            steps (list): steps of the sequence.
+            i_step (int): index of the pause.
+            round_id (str): round id.
+
+        Returns:
+            str: buffer name, None if nothing should be prefetched.
+        """
+        following = steps[i_step+1:i_step+3]
+        if len(following) < 2 or not all(isinstance(step, dict) for step in following):
+            return None
+        if [list(step.keys())[0] for step in following] != ['buffer', 'pump']:
+            return None
+
+        buffer = following[0]['buffer']
+        if 'ii' in buffer:
+            buffer = buffer.replace('ii', round_id)
+        return buffer if buffer != self.current_buffer else None
+
+    def calibrate_dead_volume(self, buffers=None, buffer_air=None, purge_time=60, pump_time_max=300, t_settle=10):
+        """ Measure the dead volume from each buffer (valve port or plate well) to the chamber with
+        the flow sensor. The line has to contain air before each buffer, then the time until the
+        liquid front reaches the sensor, and the flow rate afterwards, give the dead volume.
+        The line is filled with air by pumping from buffer_air (e.g. an empty well) for purge_time.
+
+        Args:
+            buffers (list, optional): buffers to calibrate. Defaults to all buffers.
+            buffer_air (str, optional): buffer providing air. Defaults to None (lines are emptied manually).
+            purge_time (float, optional): time (s) to pump air. Defaults to 60.
+            pump_time_max (float, optional): maximum time (s) to wait for the liquid front. Defaults to 300.
+            t_settle (float, optional): time (s) to measure the flow rate after the front. Defaults to 10.
+        """
+        import numpy as np
+        from autofish.calibration import detect_front
+
+        if not self.sensor:
+            self.log_msg('error', 'Calibration of dead volumes requires a flow sensor.')
+            return
+
+        if self.pump_calibration is None:
+            self.pump_calibration = pumpCalibration(Path(self.config_file_system).parent / 'pump_calibration.json',
+                                                    logger=self.logger)
+
+        if buffers is None:
+            buffers = [buffer for buffer in self.buffer_names if buffer != buffer_air]
+
+        for buffer in buffers:
+            if self.stop.is_set():
+                self.logger.info('Stopping robot.')
+                raise SystemExit
+
+            if buffer_air is not None:
+                self.log_msg('info', f'Emptying line with air from {buffer_air}.')
+                self.select_buffer(buffer_air)
+                self.pump.start()
+                self.stop.wait(purge_time)
+                self.pump.stop()
+
+            self.log_msg('info', f'Calibrating dead volume of buffer {buffer}.')
+            self.select_buffer(buffer)
+            self.sensor.start()
+            self.pump.start()
+            t_start = time.perf_counter()
+            t_flow, flow = np.empty(0), np.empty(0)
+            i_front = None
+            while not self.stop.wait(0.5) and time.perf_counter() - t_start < pump_time_max:
+                t_new, flow_new = self.sensor.read()
+                t_flow, flow = np.concatenate((t_flow, t_new)), np.concatenate((flow, flow_new))
+                i_front = detect_front(flow, self.sensor.flow_min)
+                if i_front is not None and t_flow[-1] - t_flow[i_front] >= t_settle:
+                    break
+            self.pump.stop()
+            self.sensor.stop()
+
+            if i_front is None or t_flow[-1] - t_flow[i_front] < t_settle:
+                self.log_msg('error', f'Liquid front of buffer {buffer} not detected within {pump_time_max}s.')
+                continue
+
+            # Flow sensor reports ul/min, first measurement is at pump start
+            t_front = t_flow[i_front] - t_flow[0]
+            flow_rate = float(np.median(flow[i_front:])) / 1000
+            dead_volume = flow_rate * t_front / 60
+            self.pump_calibration.add(buffer, dead_volume, flow_rate, t_front,
+                                      position=self.experiment_config['buffers'][buffer])
+            self.pump_calibration.save()
+            self.log_msg('info', f'Buffer {buffer}: dead volume {dead_volume:.3f} ml (front after {t_front:.1f}s at {flow_rate:.3f} ml/min), '
+                                 f'minimal pump duration {self.pump_calibration.min_duration(buffer)}s.')
+
     # Move robot to specified buffer
-    def select_buffer(self, buffer_sel):
+    @METRICS.span('select_buffer')
+    def select_buffer(self, buffer_sel, force=False):
         """ Changes the valves and plate to the correct position for the provided buffer
 
         BUFFER POSITIONS
@@ -232,10 +561,19 @@ class Robot():
 
         Args:
             buffer_sel ([type]): [description]
+            force (bool, optional): move even if the robot is already at the buffer, the needle is
+                lifted and re-enters the well (e.g. to re-prime). Defaults to False.
         """
 
         self.log_msg('info', f'Moving robot to buffer {buffer_sel}')
 
+        if force:
+            # Forget known positions, otherwise the controllers skip the moves
+            self.current_buffer = None
+            for device in (self.plate, self.valve_in):
+                if device:
+                    device.state.invalidate()
+
         if buffer_sel == self.current_buffer:
             self.log_msg('info', 'Robot is already in place ... not need to move.')
 
@@ -243,21 +581,25 @@ class Robot():
             buffers = self.experiment_config['buffers']
 
             if buffer_sel not in self.buffer_names:
-                self.log_msg('error', 'Buffer not defined in buffer list '+str(buffer_sel), 'Buffer not defined in buffer list '+str(buffer_sel))
-                self.log_msg('error', 'Stopping robot', 'Stopping robot')
+                self.log_msg('error', 'Buffer not defined in buffer list %s', buffer_sel)
+                self.log_msg('error', 'Stopping robot')
                 raise SystemExit
 
             valve_id, plate_id, plate_pos = buffers[buffer_sel]
 
+            # Position is not known if a move fails. Moves to known positions are skipped by the controllers.
+            self.current_buffer = None
+
             # Move valve if specified
             self.log_msg('info', f'Moving valve to position: {valve_id}')
             if valve_id > 0:
 
                 if self.valve_in is None:
-                    self.log_msg('error', 'NO VALVE DEFINED. STOPPING SYSTEM.', 'NO VALVE DEFINED. STOPPING SYSTEM.')
+                    self.log_msg('error', 'NO VALVE DEFINED. STOPPING SYSTEM.')
                     raise SystemExit
                 else:
-                    self.valve_in.move(valve_id)
+                    with METRICS.span('valve_move', 'valve_in'):
+                        self.valve_in.move(valve_id)
 
             # Move plate
             self.log_msg('info', f'Plate ID: {plate_id}')
@@ -281,15 +623,9 @@ class Robot():
                         self.log_msg('error', f'Position on well not in good format: {plate_pos}')
                         raise SystemExit
 
-                    # Move to XY position
+                    # Move to XY position, then Z position (move_stage waits until the move is done)
                     self.plate.move_stage({'X': x_pos, 'Y': y_pos})
-                    while 'Idl' not in self.plate.check_stage(): #Wait until move is done before proceeding.
-                        time.sleep(0.5)
-
-                    # Move to Z position
                     self.plate.move_stage({'Z': z_pos})
-                    while 'Idl' not in self.plate.check_stage(): #Wait until move is done before proceeding.
-                        time.sleep(0.5)
 
             # Well (plate 1).
             if plate_id == 1:
@@ -301,15 +637,10 @@ class Robot():
                                   'y': self.well_coords[plate_pos]['y']}
 
                     self.plate.move_stage(new_pos_xy)
-                    while 'Idl' not in self.plate.check_stage():  # Wait until move is done before proceeding.
-                        self.logger.info(self.plate.check_stage())
-                        time.sleep(1)
 
                     # Move to Z
                     new_pos_z = {'z': self.well_coords[plate_pos]['z']}
                     self.plate.move_stage(new_pos_z)
-                    while 'Idl' not in self.plate.check_stage():  # Wait until move is done before proceeding.
-                        time.sleep(1)
 
                 else:
                     self.log_msg('error', f'Well is not defined: {plate_pos}')
@@ -337,7 +668,9 @@ class Robot():
         action = list(step.keys())[0]
         param = list(step.values())[0]
 
-        self.log_msg('info', f'>> STEP: {action}, with parameter {param}')
+        self.log_fields = {'round': round_id, 'step': action}
+        self.log_msg('info', '>> STEP: %s, with parameter %s', action, param)
+        self.report_progress(step=action, param=param, remaining=total_time)
 
         # == Move robot to specified buffer
         if action == 'buffer':
@@ -355,37 +688,65 @@ class Robot():
 
         # == Activate pump
         elif action == 'pump':
-            self.log_msg('info', f'Remaining time (approx): {total_time}')
+            self.log_msg('info', 'Remaining time (approx): %s', total_time)
 
             if self.stop.is_set():
                 self.logger.info('Stopping robot.')
                 raise SystemExit
 
+            if self.prefetched is not None and self.prefetched == self.current_buffer:
+                pump_time = self.pump_duration_prefetched(param)
+                self.log_msg('info', f'Pump duration trimmed to {pump_time}s (buffer {self.current_buffer} prefetched).')
+            else:
+                pump_time = self.pump_duration(param)
+                if pump_time < param:
+                    self.log_msg('info', f'Pump duration trimmed to {pump_time}s (dead volume of buffer {self.current_buffer}).')
+            self.prefetched = None
+
             if not demo:
-                self.pump_run(param)
+                self.pump_run(pump_time)
 
             time.sleep(1)
             total_time = total_time - float(param/60)
 
+            if self.stop.is_set():
+                self.logger.info('Stopping robot.')
+                raise SystemExit
+
         # == Pause
         elif action == 'pause':
-            self.log_msg('info', f'Remaining time (approx): {total_time}')
+            self.log_msg('info', 'Remaining time (approx): %s', total_time)
             if self.stop.is_set():
                 self.logger.info('Stopping robot.')
                 raise SystemExit
             if not demo:
-                self.pause(param)
+                if self.prefetch_next is not None:
+                    self.pause_prefetch(param, self.prefetch_next)
+                elif 'select' in step:
+                    # Buffer selection hoisted into the pause by the optimizer
+                    t_start = time.monotonic()
+                    self.select_buffer(step['select'])
+                    self.pause(max(param - (time.monotonic() - t_start), 0))
+                else:
+                    self.pause(param)
+            elif 'select' in step:
+                self.log_msg('info', f'Selecting buffer {step["select"]} during pause')
             total_time = total_time - float(param/60)
 
+            if self.stop.is_set():
+                self.logger.info('Stopping robot.')
+                raise SystemExit
+
         # == Move output valve
         elif action == 'valve_out':
             self.log_msg('info', f'Change output valve to : {param}')
 
             if self.valve_out is None:
-                self.log_msg('error', 'NO OUTPUT VALVE DEFINED. STOPPING SYSTEM.', 'NO VALVE DEFINED. STOPPING SYSTEM.')
+                self.log_msg('error', 'NO OUTPUT VALVE DEFINED. STOPPING SYSTEM.', msg_short='NO VALVE DEFINED. STOPPING SYSTEM.')
                 raise SystemExit
             else:
-                self.valve_out.move(param)
+                with METRICS.span('valve_move', 'valve_out'):
+                    self.valve_out.move(param)
                 self.pause(1)
 
         # Specify pump durations per outlet valve
@@ -398,7 +759,8 @@ class Robot():
 
             for v_pos, v_t in zip(self.valve_out_settings['positions'], param):
                 self.log_msg('info', f'Outlet valve {v_pos} and pump duration {v_t}.')
-                self.valve_out.move(v_pos)
+                with METRICS.span('valve_move', 'valve_out'):
+                    self.valve_out.move(v_pos)
                 self.pump_run(v_t)
 
         # === Move robot to specified position
@@ -408,8 +770,12 @@ class Robot():
 
         # === Wait for user input
         elif action == 'wait':
-            self.log_msg('info', 'WAITING FOR USER INPUT ... press ENTER to continue.')
-            input("Press Enter to continue...")
+            self.log_msg('info', 'WAITING FOR USER INPUT ... continue when ready.')
+            answer = self.operator.ask('Waiting for user. Continue?', options=('continue', 'stop'), stop=self.stop)
+            if answer == 'stop':
+                self.stop.set()
+                self.logger.info('Stopping robot.')
+                raise SystemExit
 
         elif action == 'image':
 
@@ -431,7 +797,8 @@ class Robot():
         return total_time
 
     # >>>> Functions to run one round
-    def run_single_round(self, round_id, total_time=None, steps=None):
+    @_holds_run_lock
+    def run_single_round(self, round_id, total_time=None, steps=None, step_prefix=''):
         """ Run a single fluidic round as specified by the round_id.
             Can be called recursively in case conditional steps are provided. 
 
@@ -439,12 +806,14 @@ class Robot():
             round_id (integer): number of round that should be run.
             total_time (_type_, optional): _description_. Defaults to None.
             steps (_type_, optional): _description_. Defaults to None.
+            step_prefix (str, optional): prefix of the step ids (for conditional steps). Defaults to ''.
 
         Returns:
             _type_: _description_
         """
 
         self.current_round = round_id
+        self.log_fields = {'round': round_id}
 
         # Check if this is the first call (and not a recursive one)
         if total_time is None:
@@ -464,36 +833,79 @@ class Robot():
         #  Permits to determine if the call is for a conditional round, where steps is defined.
         #  For a first call, the loaded sequence of steps is used
         cond_steps = True
+        step_ids = None
         if steps is None:
             steps = self.experiment_config['sequence']
             cond_steps = False
 
+            # Optimized plan: conditional steps are inlined, the step ids of the sequence are kept
+            if self.optimizer is not None:
+                plan, notes = self.optimizer.optimize(round_id)
+                for note in notes:
+                    self.log_msg('info', f'Optimized sequence: {note}')
+                step_ids = [step_id for step_id, _ in plan]
+                steps = [step for _, step in plan]
+
+            # Round can be skipped (e.g. with the control API) until it starts, the next round is then run
+            if not self.scheduler.start(round_id):
+                self.log_msg('warning', f'Round {round_id} is {self.scheduler.state(round_id)}, it will not be run.')
+                self.status['launch_acquisition'] = False
+                return total_time
+
+            # A resumed round continues the journal entries of the interrupted round
+            if self.resume_state is not None and self.resume_state['round'] == round_id:
+                self.log_msg('info', f'Resuming round {round_id}, steps already done: {sorted(self.resume_state["steps_done"])}')
+            else:
+                self.resume_state = None
+                self.journal_write('round_start', round=round_id)
+
         self.log_msg('info', f'RUNNING ROUND: {round_id}, expected duration {total_time}')
 
-        # Loop over all steps
-        for step in steps:  # Sequence is defined as list in config file.
+        try:
+            # Loop over all steps
+            for i_step, step in enumerate(steps):  # Sequence is defined as list in config file.
+                step_id = step_ids[i_step] if step_ids is not None else f'{step_prefix}{i_step}'
 
-            if isinstance(step, list):
+                if isinstance(step, list):
 
-                # ToDo: could htis be intergrated into the run_step function?
-                self.logger_short.info(f'Conditional step: {step}')
+                    # ToDo: could htis be intergrated into the run_step function?
+                    self.logger_short.info(f'Conditional step: {step}')
 
-                action = list(step[0].keys())[0]
-                round_ids_cond = list(step[0].values())[0].split(",")
+                    action = list(step[0].keys())[0]
+                    round_ids_cond = list(step[0].values())[0].split(",")
 
-                if action == 'round':
-                    if round_id in round_ids_cond: 
-                        self.log_msg('info', f'Running conditional steps for round: {round_id}')
-                        total_time = self.run_single_round(round_id, total_time=total_time, steps=step)
-                else:
-                    self.log_msg('error', f'First action has to be "round" and not {action}.')
+                    if action == 'round':
+                        if round_id in round_ids_cond: 
+                            self.log_msg('info', f'Running conditional steps for round: {round_id}')
+                            total_time = self.run_single_round(round_id, total_time=total_time, steps=step,
+                                                               step_prefix=f'{step_id}.')
+                    else:
+                        self.log_msg('error', f'First action has to be "round" and not {action}.')
 
-            else:
-                total_time = self.run_step(step, round_id, total_time)
+                else:
+                    # Prefetch the next buffer during a pause
+                    if self.prefetch is not None and 'pause' in step:
+                        self.prefetch_next = self.prefetch_buffer(steps, i_step, round_id)
+                    try:
+                        total_time = self.run_step_journal(step, step_id, round_id, total_time)
+                    finally:
+                        self.prefetch_next = None
+
+        except BaseException:
+            # Interrupted round stays first in the queue, otherwise the round failed
+            if not cond_steps:
+                if self.stop.is_set():
+                    self.scheduler.release(round_id)
+                else:
+                    self.scheduler.fail(round_id)
+            raise
 
         # Remove round id only if function call is not for a conditional step
         if not cond_steps:
-            self.rounds_available.remove(round_id)
+            self.resume_state = None
+            self.journal_write('round_done', round=round_id, launch_acquisition=self.status['launch_acquisition'])
+            METRICS.increment('rounds_completed')
+            self.scheduler.done(round_id)
             self.log_msg('info', f'Available rounds: {self.rounds_available}')
 
             if self.sensor:
@@ -501,10 +913,151 @@ class Robot():
 
         return total_time
 
+    def run_step_journal(self, step, step_id, round_id, total_time):
+        """ Run a step and record it in the journal. When resuming an interrupted round,
+        steps that are already done are skipped (steps without hardware action are repeated to
+        restore the robot status), and interrupted pauses only wait for the remaining time.
+
+        Args:
+            step (dict): step.
+            step_id (str): id of step in sequence.
+            round_id (str): round id.
+            total_time (float): remaining time of round.
+
+        Returns:
+            float: remaining time of round.
+        """
+        action = list(step.keys())[0]
+        param = list(step.values())[0]
+
+        resume = self.resume_state
+        if resume is not None:
+
+            if step_id in resume['steps_done'] and action not in ('image', 'round'):
+                self.log_msg('info', f'Step {step_id} ({action}: {param}) already done.')
+                if action in ('pump', 'pause'):
+                    total_time = total_time - float(param/60)
+                return total_time
+
+            # Position of hardware is unknown after restart, move back to last selected buffer
+            if resume['buffer'] is not None and action != 'buffer':
+                self.log_msg('info', f'Resume: moving back to buffer {resume["buffer"]}')
+                if not self.status['demo']:
+                    self.select_buffer(resume['buffer'])
+            resume['buffer'] = None
+
+            if step_id in resume['pause_remaining']:
+                step = {**step, 'pause': round(resume['pause_remaining'].pop(step_id))}
+                self.log_msg('info', f'Resume: remaining pause {step["pause"]} s (instead of {param} s)')
+                total_time = total_time - float((param - step['pause'])/60)
+
+        self.journal_write('step_start', round=round_id, step=step_id, action=action, param=list(step.values())[0])
+        self.current_step = step_id
+        try:
+            total_time = self.run_step(step, round_id, total_time)
+        finally:
+            self.current_step = None
+        self.journal_write('step_done', round=round_id, step=step_id, action=action, param=param, buffer=self.current_buffer)
+
+        return total_time
+
+    def journal_write(self, entry_type, **data):
+        """ Write entry to the journal of the run (if a journal is used).
+        """
+        if self.journal is not None:
+            self.journal.write(entry_type, **data)
+
+    def start_journal(self, file_journal=None):
+        """ Start a new journal of the run.
+
+        Args:
+            file_journal (str, optional): journal file. Defaults to journal__<date>.jsonl next to the experiment config.
+        """
+        if file_journal is None:
+            data_string = datetime.now().strftime("%Y-%m-%d_%H-%M")
+            file_journal = str(Path(self.config_file_experiment).parent / f'journal__{data_string}.jsonl')
+
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = runJournal(file_journal, logger=self.logger)
+        self.journal_write('run_start',
+                           config_file_system=str(self.config_file_system),
+                           config_file_experiment=str(self.config_file_experiment))
+
+    def resume(self, file_journal):
+        """ Restore the state of a run from its journal, e.g. after a crash. Loads the experiment
+        config of the run, removes rounds that are done, and prepares the interrupted round to
+        continue with the first incomplete step. New entries are appended to the same journal.
+
+        Args:
+            file_journal (str): journal of the interrupted run.
+
+        Returns:
+            dict: state of the run (see journal_state).
+        """
+        state = journal_state(read_journal(file_journal))
+        self.log_msg('info', f'Resuming run from journal {file_journal}')
+
+        if str(state['config_file_system']) != str(self.config_file_system):
+            self.log_msg('error', f'System config differs from journal: {state["config_file_system"]}')
+
+        self.load_config_experiment(state['config_file_experiment'])
+
+        for round_id in state['rounds_done']:
+            if round_id in self.scheduler:
+                self.scheduler.done(round_id)
+
+        # Hardware position is unknown after a restart
+        self.current_buffer = None
+
+        if state['round_current'] is not None:
+            self.resume_state = {'round': state['round_current'],
+                                 'steps_done': set(state['steps_done']),
+                                 'pause_remaining': dict(state['pause_remaining']),
+                                 'buffer': state['buffer']}
+
+            # Interrupted round is run first
+            if state['round_current'] in self.scheduler:
+                self.scheduler.reorder([state['round_current']])
+
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = runJournal(file_journal, logger=self.logger)
+        self.journal_write('resume', round=state['round_current'], steps_done=state['steps_done'])
+
+        self.log_msg('info', f'Rounds done: {state["rounds_done"]}, interrupted round: {state["round_current"]}, available rounds: {self.rounds_available}')
+        return state
+
+    def first_buffer(self, round_id):
+        """ Name of the first buffer of a round, if it is selected before anything is pumped.
+
+        Args:
+            round_id (str): round id.
+
+        Returns:
+            str: buffer name, None if the round starts with another action.
+        """
+        for step in self.experiment_config['sequence']:
+            if isinstance(step, list):
+                return None
+
+            action = list(step.keys())[0]
+            param = list(step.values())[0]
+
+            if action == 'buffer':
+                return param.replace('ii', round_id) if 'ii' in param else param
+            elif action in ('pump', 'pump_valve_out', 'wait'):
+                return None
+
+        return None
+
     # >>>> Functions to initiate robot
     def load_config_experiment(self, config_file_experiment):
         """
         Open config json file and returns configured hardware components.
+
+        Args:
+            config_file_experiment (str): experiment config file.
         """
 
         self.log_msg('info', f'Load robot specification file: {config_file_experiment}')
@@ -523,8 +1076,10 @@ class Robot():
         # Estimate over which buffers should be looped
         self.round_id_all, self.buffers_round_all, self.run_time_all = self.analyse_sequence()
 
-        # Keep track which cyles where not executed yet (a round can only be executed once)
-        self.rounds_available = self.round_id_all
+        # Keep track of the state of each round, and which rounds are run next
+        self.scheduler = roundScheduler(self.round_id_all)
+        if 'round_order' in self.experiment_config.keys():
+            self.scheduler.reorder([round_id for round_id in self.experiment_config['round_order'] if round_id in self.scheduler])
 
         # Calculate well positions
         if 'well_plate' in self.experiment_config.keys():
@@ -545,6 +1100,31 @@ class Robot():
             }
             self.status['outlet_valve'] = False
 
+        # Dead volumes of buffers to trim pump durations
+        if 'pump_calibration' in self.experiment_config.keys():
+            settings = dict(self.experiment_config['pump_calibration'] or {})
+            file_calibration = settings.pop('file', Path(self.config_file_system).parent / 'pump_calibration.json')
+            self.pump_calibration = pumpCalibration(file_calibration, logger=self.logger, **settings)
+
+        # Prefetch of the next buffer during pauses, through the outlet valve to waste
+        self.prefetch = self.experiment_config.get('prefetch')
+        self.prefetched = None
+        if self.prefetch is not None:
+            self.log_msg('info', f'Buffers will be prefetched during pauses: {self.prefetch}')
+
+        # Optimization of the steps of each round (see autofish.optimizer)
+        self.optimizer = None
+        settings = self.experiment_config.get('optimize', False)
+        if settings:
+            from autofish.optimizer import sequenceOptimizer
+            settings = settings if isinstance(settings, dict) else {}
+            self.optimizer = sequenceOptimizer(self.experiment_config['sequence'],
+                                               valve_out_positions=self.experiment_config.get('valve_out', {}).get('positions'),
+                                               hoist=settings.get('hoist', True) and self.prefetch is None,  # Prefetch needs buffer after pause
+                                               move_time=settings.get('move_time', 10),
+                                               logger=self.logger)
+            self.log_msg('info', 'Steps of each round will be optimized.')
+
     def check_plate_positions(self,):
         """
         Check if positions on plates are unique.
@@ -844,8 +1424,13 @@ class Robot():
         """ Closes all open serial ports.
         """
         self.logger.info('Closing all connections.')
+        for actor in self.actors.values():
+            actor.close()
+
         config_system = self.config_system
         for hardware_comp in config_system:
+            if not isinstance(config_system[hardware_comp], dict) or hardware_comp == 'actors':
+                continue
             self.log_msg('info', "  Closing serial port of component: %s", config_system[hardware_comp]['type'])
             if 'ser' in config_system[hardware_comp].keys():
                 ser = config_system[hardware_comp]['ser']
@@ -853,6 +1438,10 @@ class Robot():
                     if ser.isOpen() is True:
                         ser.close()
 
+        if self.volume_log is not None:
+            self.volume_log.close()
+            self.volume_log = None
+
     def initiate_system(self):
         """ If available, use predefined COM ports to connect to hardware.
         """
@@ -867,8 +1456,8 @@ class Robot():
             # >>> Connect to serial ports when specified
             for hardware_comp in config_system:
 
-                # Ignore demo entry
-                if hardware_comp == 'demo':
+                # Ignore demo entry and settings of actors
+                if hardware_comp in ('demo', 'actors'):
                     continue
 
                 # Verify if hardware component exists
@@ -900,6 +1489,10 @@ class Robot():
                                             timeout=0.5)
                         self.config_system[hardware_comp]['ser'] = ser
 
+                        # GRBL restarts when the port is opened. Pump and valves keep their settings.
+                        if hardware_comp == 'plate':
+                            self.device_state(hardware_comp).invalidate()
+
                     except serial.SerialException as e:
                         self.log_msg('error', f'  ERROR when opening serial port: {e}')
                         error_open_serial_port = True
@@ -930,6 +1523,12 @@ class Robot():
 
                 if 'flow_sensor' in self.config_system.keys():
                     self.sensor = self.assign_sensor()
+                    if self.sensor and 'anomaly' in self.config_system['flow_sensor'].keys():
+                        from autofish.anomaly import flowAnomalyDetector
+                        config_anomaly = {'flow_min': self.config_system['flow_sensor']['flow_min'],
+                                          **self.config_system['flow_sensor']['anomaly']}
+                        self.flow_monitor = flowAnomalyDetector(**config_anomaly)
+                        self.log_msg('info', f'  Flow anomalies will be detected, action: {self.flow_monitor.action}')
                 else:
                     self.sensor = None
 
@@ -937,6 +1536,10 @@ class Robot():
                     self.log_msg('info', 'All connected components assigned.')
                     self.status['ports_assigned'] = True
                     self.status['robot_zeroed'] = False
+
+                    # Each device in its own actor
+                    if 'actors' in self.config_system.keys():
+                        self.start_actors()
                 else:
                     self.log_msg('error', 'Could not assign one or more component (see error above).')
 
@@ -944,6 +1547,93 @@ class Robot():
                 self.log_msg('error', f'Assignment of robot components failed. {e}')
                 self.log_msg('error', config_system)
 
+    def start_actors(self):
+        """ Run each device controller in its own actor: a worker thread executing the requests of the
+        robot with deadlines (see autofish.actors). A hung device then only blocks its own requests,
+        and is restarted (serial port re-opened, controller re-created) when a request times out.
+
+        Settings in the system config, with deadlines in seconds (per device, or default):
+            "actors": {"timeout": 30, "plate": 400, "retries": 1}
+
+        The default deadline of the plate robot covers a move with three axes (each up to timeout_idle).
+        Moves are not retried after a timeout, the plate robot is homed instead (see recover_plate).
+        """
+        from autofish.actors import deviceActor, actorProxy
+
+        settings = self.config_system['actors']
+        devices = (('pump', 'pump', self.assign_pump),
+                   ('plate', 'plate', self.assign_plate),
+                   ('valve_in', 'valve_in', lambda: self.assign_valve(valve_id='valve_in')),
+                   ('valve_out', 'valve_out', lambda: self.assign_valve(valve_id='valve_out')),
+                   ('flow_sensor', 'sensor', self.assign_sensor))
+
+        self.actors = {}
+        for name, attr, assign_fn in devices:
+            device = getattr(self, attr)
+            if not device:
+                continue
+            timeout = settings.get('timeout', 30)
+            if name == 'plate':
+                timeout = max(timeout, 3 * getattr(device, 'timeout_idle', 0) + 30)
+            actor = deviceActor(device, name,
+                                timeout=settings.get(name, timeout),
+                                restart_fn=lambda name=name, assign_fn=assign_fn: self.reconnect_device(name, assign_fn),
+                                retries=settings.get('retries', 1),
+                                motion=('move_stage', 'move_zero', 'jog_stage', 'zero_stage') if name == 'plate' else (),
+                                recover_fn=self.recover_plate if name == 'plate' else None,
+                                logger=device_logger(self.logger, name))
+            self.actors[name] = actor
+            setattr(self, attr, actorProxy(actor))
+            self.log_msg('info', f'  {name} runs in actor with deadline {actor.timeout}s')
+
+    def reconnect_device(self, name, assign_fn):
+        """ Re-open serial port of a device and create a new controller (used to restart actors).
+
+        Args:
+            name (str): device name in the system config.
+            assign_fn (callable): creates the controller, e.g. self.assign_pump.
+
+        Returns:
+            new controller.
+        """
+        self.device_state(name).invalidate()
+        ser = self.config_system[name].get('ser')
+        if ser is not None:
+            ser.close()
+            ser.open()
+        device = assign_fn()
+        if not device:
+            raise RuntimeError(f'Could not reconnect to {name}')
+        return device
+
+    def recover_plate(self):
+        """ Position of the plate robot is lost after a move timed out: reconnect, and home the robot
+        if it has homing switches (homing in the plate settings). Otherwise, the robot has to be zeroed again.
+        """
+        self.status['robot_zeroed'] = False
+        try:
+            self.actors['plate'].restart()
+            if self.actors['plate'].device.home():  # Not through the actor, a failed homing is not recovered again
+                self.status['robot_zeroed'] = True
+                self.log_msg('info', 'Plate robot homed after failed move.')
+                return
+        except Exception as e:
+            self.log_msg('error', f'Plate robot could not be recovered: {e}')
+        self.log_msg('error', 'Position of plate robot is lost, ZERO THE ROBOT AGAIN.')
+
+    def device_state(self, name):
+        """ Last known state of a device (see autofish.devicestate). The state is kept when the
+        controller is re-created on the same connection, e.g. to not set the flow rate of the pump again.
+        """
+        if name not in self.device_states:
+            self.device_states[name] = stateCache(name)
+        return self.device_states[name]
+
+    def restart_device(self, name):
+        """ Restart the actor of a device, e.g. 'plate'.
+        """
+        self.actors[name].restart()
+
     def assign_sensor(self):
         """ Use fluidics configuration file and generate a pump object
 
@@ -965,7 +1655,7 @@ class Robot():
                                    self.config_system['flow_sensor']['separator_decimal'],
                                    self.config_system['flow_sensor']['kernel_size'],
                                    self.config_system['flow_sensor']['flow_min'],
-                                   logger=self.logger)
+                                   logger=device_logger(self.logger, 'flow_sensor'))
 
             return sensor
 
@@ -998,7 +1688,7 @@ class Robot():
             # Make sure that baudrate is correct
             ser = self.config_system['pump']['ser']
             ser.baudrate = self.config_system['pump']['baudrate']
-            pump = RegloDigitalController(ser, logger=self.logger)
+            pump = RegloDigitalController(ser, logger=device_logger(self.logger, 'pump'), state=self.device_state('pump'))
 
             # Set flowrate and revolution direction as specfied in log file
             pump.info()  # For unknown reasons the first command does not execute
@@ -1015,7 +1705,7 @@ class Robot():
             pump = LongerBT100(ser, 
                                self.config_system['pump']['speed'],
                                self.config_system['pump']['revolution'],
-                               logger=self.logger)
+                               logger=device_logger(self.logger, 'pump'))
             return pump
 
         elif self.config_system['pump']['type'] == 'MZR gear pump':
@@ -1024,7 +1714,7 @@ class Robot():
             # Make sure that baudrate is correct
             ser = self.config_system['pump']['ser']
             ser.baudrate = self.config_system['pump']['baudrate']
-            pump = MzrGearPump(ser, logger=self.logger)
+            pump = MzrGearPump(ser, logger=device_logger(self.logger, 'pump'))
 
             # Set speed
             pump.set_speed(self.config_system['pump']['Speed'])
@@ -1061,7 +1751,7 @@ class Robot():
             # Make sure that baudrate is correct
             ser = self.config_system[valve_id]['ser']
             ser.baudrate = self.config_system[valve_id]['baudrate']
-            return HamiltonMVPController(ser, logger=self.logger)
+            return HamiltonMVPController(ser, logger=device_logger(self.logger, valve_id), state=self.device_state(valve_id))
 
         elif self.config_system[valve_id]['type'] == 'AMC RVM':
             self.log_msg('info', f'  AMC RVM valve on port {self.config_system[valve_id]["ser"].portstr}')
@@ -1069,7 +1759,7 @@ class Robot():
             # Make sure that baudrate is correct
             ser = self.config_system[valve_id]['ser']
             ser.baudrate = self.config_system[valve_id]['baudrate']
-            return AMCRVMController(ser, logger=self.logger)
+            return AMCRVMController(ser, logger=device_logger(self.logger, valve_id), state=self.device_state(valve_id))
 
         else:
             self.log_msg('error', f'  Unknown valve: {self.config_system[valve_id]["type"]}')
@@ -1100,7 +1790,10 @@ class Robot():
             # Make sure that baudrate is correct
             ser = self.config_system['plate']['ser']
             ser.baudrate = self.config_system['plate']['baudrate'] 
-            return GRBLrobot(ser, self.config_system['plate']['feed'], logger=self.logger)
+            return GRBLrobot(ser, self.config_system['plate']['feed'], logger=device_logger(self.logger, 'plate'),
+                             timeout_idle=self.config_system['plate'].get('timeout_idle', 120),
+                             homing=self.config_system['plate'].get('homing', False),
+                             state=self.device_state('plate'))
 
         else:
             self.log_msg('error', f'  Unknown plate robot: {self.config_system["plate"]["type"]}')
@@ -1164,22 +1857,36 @@ class sensirion_csv(flowSensor):
         self.separator_decimal = separator_decimal
         self.kernel_size = kernel_size  # Kernel size of moving average
         self.flow_min = flow_min  # Minimum flow, below this value will be set to 0
+        self.flow_stats = None  # Statistics of the flow rate of the last measurement
 
     def start(self):
         """start _summary_
         """
+        self.flow_stats = None
+        self.data = []
+        self.line_partial = b''
         self.file_flow = open(self.file_name_flow, "rb")
         self.file_flow.seek(-2, os.SEEK_END)
         while self.file_flow.read(1) != b'\n':
             self.file_flow.seek(-2, os.SEEK_CUR)
 
-    def stop(self):
-        """stop _summary_
+    def read(self, final=False, keep=True):
+        """ Read the measurements written since the last call (used to monitor the live flow).
+        Incomplete lines (still written by the sensor software) are kept for the next call.
+
+        Args:
+            final (bool, optional): last read of the measurement, also use an incomplete last line. Defaults to False.
+            keep (bool, optional): keep the measurements for the volume integrated by stop(). Use False
+                to discard measurements, e.g. while the pump is stopped. Defaults to True.
 
         Returns:
-            _type_: _description_
+            tuple: time (s) and flow rate of the new measurements as numpy arrays.
         """
-        flow_log = [line.strip().decode("utf-8") for line in self.file_flow.readlines()]
+        import numpy as np
+
+        lines = (self.line_partial + self.file_flow.read()).split(b'\n')
+        self.line_partial = b'' if final else lines.pop()
+        flow_log = [line.strip().decode("utf-8") for line in lines if line.strip()]
 
         flowreader = csv.reader(flow_log,
                                 delimiter=self.delimiter,
@@ -1187,9 +1894,27 @@ class sensirion_csv(flowSensor):
         data_raw = [data for data in flowreader]
 
         # Convert to float and remove , as separator for thousand
-        # data = [[float(x.replace(',', '')) for x in row] for row in data_raw]
         data = [[float(x.replace(self.separator_thousand, '')
                        .replace(self.separator_decimal, '.')) for x in row] for row in data_raw]
+        if keep:
+            self.data.extend(data)
+
+        if len(data) == 0:
+            return np.empty(0), np.empty(0)
+        data_array = np.asarray(data)
+        return data_array[:, 1], data_array[:, 2]
+
+    def stop(self):
+        """stop _summary_
+
+        Returns:
+            _type_: _description_
+        """
+        import numpy as np
+
+        self.read(final=True)
+        self.file_flow.close()
+        data = self.data
 
         if len(data) <= 1:
             self.logger.error('No time-course of flow measurements can be read. Is logging active?')
@@ -1199,13 +1924,16 @@ class sensirion_csv(flowSensor):
             data_array = np.asarray(data)
             t_flow = data_array[:, 1] - data_array[0, 1]  # Set first time-point to
             flow = data_array[:, 2]
+            self.flow_stats = {'mean': round(float(flow.mean()), 3),
+                               'std': round(float(flow.std()), 3),
+                               'min': round(float(flow.min()), 3),
+                               'max': round(float(flow.max()), 3)}
 
             # Moving average and signal integration
             kernel = np.ones(self.kernel_size) / self.kernel_size
             flow_convolved = np.convolve(flow, kernel, mode='same')
             flow_convolved[flow_convolved < self.flow_min] = 0
             volume_total = round(np.trapz(flow_convolved, t_flow/60)/1000, 3)
-            self.file_flow.close()
             return volume_total
 
 # ---------------------------------------------------------------------------
@@ -1233,7 +1961,7 @@ class GRBLrobot(plateController):
         plateController (_type_): _description_
     """
 
-    def __init__(self, ser, feed, logger):
+    def __init__(self, ser, feed, logger, timeout_idle=120, homing=False, state=None):
 
         # Initiate logger
         self.logger = logger
@@ -1241,6 +1969,9 @@ class GRBLrobot(plateController):
         # Initiate
         self.ser = ser
         self.feed = feed
+        self.timeout_idle = timeout_idle  # Maximum time (s) of a move
+        self.homing = homing              # Robot has homing switches ($H), work coordinates are kept by GRBL
+        self.state = state if state is not None else stateCache('plate')  # Known coordinates X, Y, Z
         self.logger.info('GRBLrobot controller initiated.')
 
         # Set status report
@@ -1253,9 +1984,30 @@ class GRBLrobot(plateController):
         """ Set current position to 0 for all axis.
         """
         ser = self.ser
-        ser.write(('G10 L20 P0 X0 Y0 Z0 \n').encode('utf-8'))
-        grbl_out = ser.readline().decode('utf-8')
-        self.logger.info('PLATE: Current position set to zero: '+grbl_out)
+        with self.state.guard():
+            ser.write(('G10 L20 P0 X0 Y0 Z0 \n').encode('utf-8'))
+            grbl_out = ser.readline().decode('utf-8')
+            self.logger.info('PLATE: Current position set to zero: '+grbl_out)
+            for axis in ('X', 'Y', 'Z'):
+                self.state.set(axis, 0)
+
+    def home(self):
+        """ Run the homing cycle, e.g. after the position was lost. The work coordinates (zero of
+        zero_stage) are stored by GRBL and are valid again after homing.
+
+        Returns:
+            bool: True if homed, False if the robot has no homing switches.
+        """
+        if not self.homing:
+            return False
+        ser = self.ser
+        self.state.invalidate()
+        with self.state.guard():
+            ser.write(('$H\n').encode('utf-8'))
+            self.wait_idle()
+            grbl_out = ser.readline().decode('utf-8')
+            self.logger.info('PLATE: homing cycle: ' + grbl_out)
+        return True
 
     def check_stage(self):
         """check_stage _summary_
@@ -1270,10 +2022,32 @@ class GRBLrobot(plateController):
         grbl_out = ser.readline().decode('utf-8')
         return grbl_out
 
+    def wait_idle(self, timeout=None, interval=0.5):
+        """ Wait until the GRBL reports that it is idle, i.e. the move is done.
+
+        Args:
+            timeout (float, optional): maximum waiting time in seconds. Defaults to timeout_idle.
+            interval (float, optional): time between status requests in seconds. Defaults to 0.5.
+
+        Raises:
+            TimeoutError: GRBL is not idle after timeout.
+        """
+        timeout = self.timeout_idle if timeout is None else timeout
+        t_end = time.monotonic() + timeout
+        while 'Idl' not in (status := self.check_stage()):
+            self.logger.debug('GRBL status: %s', status)
+            if time.monotonic() > t_end:
+                self.logger.error('PLATE: GRBL not idle after %s s, last status: %s', timeout, status)
+                raise TimeoutError(f'GRBL not idle after {timeout} s')
+            time.sleep(interval)
+
+    @METRICS.span('grbl_move', 'plate')
     def move_stage(self, pos):
         """ Move stage to provided XY position in the dictionary.
         Will loop over provided values and move stage to coordinates.
 
+        Moves to known coordinates (see state) are skipped.
+
         Args:
             pos (dict): contains new position as a dictionary, e.g.  {'X':5}
 
@@ -1282,23 +2056,29 @@ class GRBLrobot(plateController):
         for axis, coord in pos.items():
 
             if axis not in ('X', 'x', 'Y', 'y', 'Z', 'z'):
-                self.log_msg('error', 'Position has to be X, Y or Z')
+                self.logger.error('Position has to be X, Y or Z')
+                continue
+
+            if self.state.skip(axis.upper(), coord):
+                self.logger.info('Already at %s=%s', axis.upper(), coord)
                 continue
 
-            # Always move to Z=0 first
-            ser.write(('G0 Z0 \n').encode('utf-8'))
-            while 'Idl' not in self.check_stage():  # Wait until move is done before proceeding.
-                self.logger.info(self.check_stage())
-                time.sleep(0.5)
+            with self.state.guard():
 
-            # Move to provided coordinates
-            ser.write(('G0 '+axis.upper()+str(coord)+' \n').encode('utf-8')) # Move to provided coordinates
-            while 'Idl' not in self.check_stage():  # Wait until move is done before proceeding.
-                time.sleep(0.5)
+                # Always move to Z=0 first
+                if axis.upper() != 'Z' and not self.state.skip('Z', 0):
+                    ser.write(('G0 Z0 \n').encode('utf-8'))
+                    self.wait_idle()  # Wait until move is done before proceeding.
+                    self.state.set('Z', 0)
 
-            grbl_out = ser.readline().decode('utf-8')  # Wait for grbl response with carriage return
-            self.logger.info('Moved to '+axis.upper()+'='+str(pos[axis]))
-            self.logger.info('GRBL out:'+grbl_out)
+                # Move to provided coordinates
+                ser.write(('G0 '+axis.upper()+str(coord)+' \n').encode('utf-8')) # Move to provided coordinates
+                self.wait_idle()
+                self.state.set(axis.upper(), coord)
+
+                grbl_out = ser.readline().decode('utf-8')  # Wait for grbl response with carriage return
+                self.logger.info('Moved to %s=%s', axis.upper(), pos[axis])
+                self.logger.info('GRBL out: %s', grbl_out)
 
     def move_zero(self):
         """ Move stage to zero position
@@ -1307,14 +2087,9 @@ class GRBLrobot(plateController):
 
             # Move to Z
             self.move_stage({'z': 0})
-            while 'Idl' not in self.check_stage():  # Wait until move is done before proceeding.
-                time.sleep(1)
 
             # Move to X,Y
-
             self.move_stage({'X': 0, 'Y': 0})
-            while 'Idl' not in self.plate.check_stage():  # Wait until move is done before proceeding.
-                time.sleep(1)
 
             # Reset current position
             self.current_buffer = None
@@ -1332,9 +2107,10 @@ class GRBLrobot(plateController):
 
         ser = self.ser
         feed = self.feed
-        ser.write(('$J=G91 G21 '+jog_axis.upper()+str(jog_dist)+'F'+str(feed)+' \n').encode('utf-8'))  # Move code to GRBL, xy first
-        while 'Idl' not in self.check_stage():  # Wait until move is done before proceeding.
-            time.sleep(0.25)
+        self.state.invalidate(jog_axis.upper())  # Position after jogging is not known
+        with self.state.guard():
+            ser.write(('$J=G91 G21 '+jog_axis.upper()+str(jog_dist)+'F'+str(feed)+' \n').encode('utf-8'))  # Move code to GRBL, xy first
+            self.wait_idle(interval=0.25)  # Wait until move is done before proceeding.
         grbl_out = ser.readline().decode('utf-8')  # Wait for grbl response with carriage return
         self.logger.info('GRBL out:' + grbl_out)
         self.logger.info('GRBL status:' + self.check_stage())
@@ -1442,12 +2218,13 @@ class RegloDigitalController(pumpController):
     Args:
         pumpController (_type_): _description_
     """
-    def __init__(self, ser, logger):
+    def __init__(self, ser, logger, state=None):
         """__init__ _summary_
 
         Args:
             ser (_type_): _description_
             logger (_type_, optional): _description_. Defaults to None.
+            state (stateCache, optional): known flow rate and revolution direction. Defaults to None.
         """
 
         # Setting up logger
@@ -1455,6 +2232,7 @@ class RegloDigitalController(pumpController):
 
         # Initiate
         self.ser = ser
+        self.state = state if state is not None else stateCache('pump')
         self.logger.info('RegloDigitalController initiated.')
 
     def _check_response(self, response):
@@ -1483,6 +2261,9 @@ class RegloDigitalController(pumpController):
 
         Args:
             ser_cmd (_type_): _description_
+
+        Returns:
+            int: 1 if command was successfully executed, 0 otherwise.
         """
 
         self.logger.info('Command send: %s', ser_cmd)
@@ -1512,7 +2293,7 @@ class RegloDigitalController(pumpController):
                 self.logger.error(f'Setting flow rate seems to have failed. {response}')
 
         # Check if response is good
-        self._check_response(response)
+        return self._check_response(response)
 
     def info(self):
         """ Get infos from pump - expected response *
@@ -1538,13 +2319,24 @@ class RegloDigitalController(pumpController):
         Args:
             rev (_type_): _description_
         """
+        if self.state.skip('revolution', rev):
+            self.logger.info('PUMP: revolution direction already %s', rev)
+            return
+
         self.logger.info('PUMP: set revolution direction: %s', rev)
-        if rev == 'CW':
-            self._send_cmd('1J\r')
-        elif rev == 'CCW':
-            self._send_cmd('1K\r')
+        with self.state.guard():
+            if rev == 'CW':
+                status = self._send_cmd('1J\r')
+            elif rev == 'CCW':
+                status = self._send_cmd('1K\r')
+            else:
+                self.logger.info('Revolution direction is either CW or CCW!')
+                return
+
+        if status:
+            self.state.set('revolution', rev)
         else:
-            self.logger.info('Revolution direction is either CW or CCW!')
+            self.state.invalidate('revolution')
 
     def set_flowrate(self, rate, exp=-2):
         """ Specify flowrate 'rate' in ml/min
@@ -1560,12 +2352,22 @@ class RegloDigitalController(pumpController):
             rate (_type_): _description_
             exp (int, optional): _description_. Defaults to -2.
         """
+        if self.state.skip('flowrate', (rate, exp)):
+            self.logger.info('PUMP: flow-rate already %f ml/min', rate)
+            return
+
         self.logger.info('PUMP: set flow-rate: %f ml/min', rate)
 
         ee = '{}'.format(exp)
         mmmmm = str(int(rate * 10**(-(exp)))).zfill(4)
         ser_cmd = '1f' + mmmmm + ee + '\r'
-        self._send_cmd(ser_cmd)
+        with self.state.guard():
+            status = self._send_cmd(ser_cmd)
+
+        if status:
+            self.state.set('flowrate', (rate, exp))
+        else:
+            self.state.invalidate('flowrate')
 
 
 class LongerBT100(pumpController):
@@ -1679,6 +2481,40 @@ class valveController():
         '''Move valve '''
         raise NotImplementedError('No move function defined for this class!')
 
+    def _wait_ready(self, valve_id=1, timeout=10):
+        """ Query the status of the valve until the last command is executed. Replies of the
+        OEM protocol are '/0' + status byte + ETX: bit 5 of the status byte is set when the valve
+        is ready, bits 0-3 are the error code.
+
+        Args:
+            valve_id (int, optional): address of the valve. Defaults to 1.
+            timeout (float, optional): time to wait for the valve in seconds. Defaults to 10.
+
+        Returns:
+            bool: True if the valve executed the command without error.
+        """
+        t_end = time.monotonic() + timeout
+        try:
+            self.ser.reset_input_buffer()  # Replies of previous commands
+            while time.monotonic() < t_end:
+                self.ser.write('/{}Q\r'.format(valve_id).encode('utf-8'))
+                response = self.ser.read_until(b'\x03')
+                i_reply = response.find(b'/0')
+                if i_reply >= 0 and len(response) > i_reply + 2:
+                    status = response[i_reply + 2]
+                    if status & 0x0F:
+                        self.logger.error(f'Valve reports error code {status & 0x0F}.')
+                        return False
+                    if status & 0x20:
+                        return True
+                time.sleep(0.1)
+        except (OSError, AttributeError) as e:
+            self.logger.error(f'Could not query status of valve: {e}')
+            return False
+
+        self.logger.error(f'Valve did not confirm the command within {timeout} s.')
+        return False
+
 
 class HamiltonMVPController(valveController):
     """HamiltonMVPController _summary_
@@ -1687,13 +2523,14 @@ class HamiltonMVPController(valveController):
         valveController (_type_): _description_
     """
 
-    def __init__(self, ser, logger):
+    def __init__(self, ser, logger, state=None):
 
         # Setting up logger
         self.logger = logger
 
         # Initiate
         self.ser = ser
+        self.state = state if state is not None else stateCache('valve')  # Known port
         self.valves_init()
         self.logger.info('HamiltonMVPController initiated.')
 
@@ -1702,13 +2539,18 @@ class HamiltonMVPController(valveController):
 
         Args:
             ser_cmd (_type_): _description_
+
+        Returns:
+            bool: True if command was sent.
         """
 
         self.logger.info('VALVE: command send: %s', ser_cmd)
         try:
             self.ser.write(ser_cmd.encode('utf-8'))
+            return True
         except (UnboundLocalError, AttributeError):
             self.logger.error('Could not execute serial command.')
+            return False
 
     def valves_init(self):
         """valves_init _summary_
@@ -1718,6 +2560,7 @@ class HamiltonMVPController(valveController):
         """ 
         valve_id = 1
         self.logger.critical('Valve: initiate #  %s', valve_id)
+        self.state.invalidate('port')  # Valve is homed
 
         ''' Initialize a MVP valve for h factor commands '''
         ser_cmd = '/{}h30001R\r'.format(valve_id)  # Enable h-factor commands
@@ -1738,11 +2581,20 @@ class HamiltonMVPController(valveController):
             port_id (_type_): _description_
         """
 
+        if self.state.skip('port', port_id):
+            self.logger.info(f'Valve already at position {port_id}')
+            return
+
         self.logger.info(f'Move valve to position {port_id}')
 
         valve_id = 1
         ser_cmd = '/{}h2600{}R\r'.format(valve_id, port_id)
-        self._send_cmd(ser_cmd)
+        with self.state.guard():
+            # Port is only known once the valve confirms the move
+            if self._send_cmd(ser_cmd) and self._wait_ready(valve_id):
+                self.state.set('port', port_id)
+            else:
+                self.state.invalidate('port')
 
 
 class AMCRVMController(valveController):
@@ -1752,13 +2604,14 @@ class AMCRVMController(valveController):
         valveController (_type_): _description_
     """
 
-    def __init__(self, ser, logger):
+    def __init__(self, ser, logger, state=None):
 
         # Setting up logger
         self.logger = logger
 
         # Initiate
         self.ser = ser
+        self.state = state if state is not None else stateCache('valve')  # Known port
         self.valves_init()
         self.logger.info('AMCRVMController initiated.')
 
@@ -1767,13 +2620,18 @@ class AMCRVMController(valveController):
 
         Args:
             ser_cmd (_type_): _description_
+
+        Returns:
+            bool: True if command was sent.
         """
 
         self.logger.info('VALVE: command send: %s', ser_cmd)
         try:
             self.ser.write(bytes(ser_cmd, 'utf-8'))
+            return True
         except (UnboundLocalError, AttributeError):
             self.logger.error('Could not execute serial command.')
+            return False
 
     def valves_init(self):
         """valves_init _summary_
@@ -1783,6 +2641,7 @@ class AMCRVMController(valveController):
         """ 
 
         self.logger.info('Valve: initiate ')
+        self.state.invalidate('port')  # Valve is homed
         self._send_cmd("/1ZR\r")
         time.sleep(5)
         self.logger.info('RVM initiated')
@@ -1794,8 +2653,17 @@ class AMCRVMController(valveController):
             port_id (_type_): _description_
         """
 
+        if self.state.skip('port', port_id):
+            self.logger.info(f'RVM already at port {port_id}')
+            return
+
         self.logger.info(f'Move valve to position {port_id}')
 
         ser_cmd = "/1B" + str(port_id) + "R\r"
-        self._send_cmd(ser_cmd)
-        self.logger.info(f'RVM moved to port {port_id}')
+        with self.state.guard():
+            # Port is only known once the valve confirms the move
+            if self._send_cmd(ser_cmd) and self._wait_ready():
+                self.state.set('port', port_id)
+                self.logger.info(f'RVM moved to port {port_id}')
+            else:
+                self.state.invalidate('port')
@@ -0,0 +1,163 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import json
+import logging
+import math
+from datetime import datetime
+from pathlib import Path
+
+
+# ---------------------------------------------------------------------------
+# Dead volume of the fluidics lines
+# ---------------------------------------------------------------------------
+
+def detect_front(flow, flow_min, n_samples=10):
+    """ Detect the arrival of the liquid front at the flow sensor: first of n_samples
+    consecutive measurements with a flow of at least flow_min (air gives no flow reading).
+
+    Args:
+        flow (np.array): flow rate measurements.
+        flow_min (float): minimum flow rate of liquid.
+        n_samples (int, optional): consecutive measurements above flow_min. Defaults to 10.
+
+    Returns:
+        int: index of the measurement where the front arrived, None if not detected.
+    """
+    import numpy as np
+
+    above = (np.asarray(flow) >= flow_min).astype(int)
+    if above.size < n_samples:
+        return None
+    runs = np.convolve(above, np.ones(n_samples, dtype=int), mode='valid')
+    idx = np.flatnonzero(runs == n_samples)
+    return int(idx[0]) if idx.size else None
+
+
+class pumpCalibration():
+    """ Dead volumes from each buffer (valve port or plate well) to the chamber, and the
+    resulting minimal pump durations.
+
+    Calibration file (json), one entry per buffer:
+        dead_volume : volume (ml) from buffer to chamber.
+        flow        : flow rate (ml/min) measured during the calibration.
+        t_front     : time (s) until the liquid front reached the flow sensor.
+        position    : buffer position [valve-id, plate-id, plate-pos] when calibrated.
+        date        : date of calibration.
+
+    The minimal pump duration of a buffer is the time to pump its dead volume plus the volume of
+    the chamber, multiplied by a safety factor. Settings in the experiment config:
+
+        pump_calibration:
+            file: 'pump_calibration.json'   # calibration file
+            chamber_volume: 0.1             # volume (ml) to exchange in the chamber
+            safety_factor: 1.5              # multiplies the minimal volume
+    """
+
+    def __init__(self, file_calibration, chamber_volume=0.1, safety_factor=1.5, logger=None):
+        """__init__ _summary_
+
+        Args:
+            file_calibration (str): calibration file, loaded if it exists.
+            chamber_volume (float, optional): volume (ml) to exchange in the chamber. Defaults to 0.1.
+            safety_factor (float, optional): factor for the minimal volume. Defaults to 1.5.
+            logger (logging.Logger, optional): logger. Defaults to None.
+        """
+        if isinstance(logger, type(None)):
+            self.logger = logging.getLogger('AUTOMATOR-Calibration')
+            self.logger.setLevel(100)
+        else:
+            self.logger = logger
+
+        self.file_calibration = str(file_calibration)
+        self.chamber_volume = chamber_volume
+        self.safety_factor = safety_factor
+        self.buffers = {}
+
+        if Path(self.file_calibration).is_file():
+            with open(self.file_calibration) as f:
+                self.buffers = json.load(f)
+            self.logger.info(f'Loaded dead volumes of {len(self.buffers)} buffers from {self.file_calibration}')
+
+    def add(self, buffer, dead_volume, flow, t_front, position=None):
+        """ Add (or replace) calibration of a buffer.
+        """
+        self.buffers[buffer] = {'dead_volume': round(dead_volume, 4),
+                                'flow': round(flow, 4),
+                                't_front': round(t_front, 2),
+                                'position': position,
+                                'date': datetime.now().strftime("%Y-%m-%d %H:%M")}
+
+    def save(self):
+        with open(self.file_calibration, 'w') as f:
+            json.dump(self.buffers, f, indent=4)
+        self.logger.info(f'Saved dead volumes to {self.file_calibration}')
+
+    def min_duration(self, buffer, flow=None, position=None):
+        """ Minimal pump duration for a buffer.
+
+        Args:
+            buffer (str): buffer name.
+            flow (float, optional): flow rate (ml/min). Defaults to flow rate of the calibration.
+            position (list, optional): current position of buffer, calibration is not used if it changed. Defaults to None.
+
+        Returns:
+            float: duration in seconds, None if buffer is not calibrated.
+        """
+        return self._duration(buffer, flow, position, dead_volume=True, chamber=True)
+
+    def fill_duration(self, buffer, flow=None, position=None):
+        """ Pump duration to fill the line of a buffer up to the chamber (dead volume only), e.g.
+        to prefetch the buffer. Arguments as for min_duration.
+        """
+        return self._duration(buffer, flow, position, dead_volume=True, chamber=False)
+
+    def chamber_duration(self, buffer, flow=None, position=None):
+        """ Pump duration to exchange the chamber volume, when the line is already filled with the
+        buffer. Arguments as for min_duration.
+        """
+        return self._duration(buffer, flow, position, dead_volume=False, chamber=True)
+
+    def exchange_duration(self, flow):
+        """ Pump duration to exchange the chamber volume at a flow rate, for buffers that are not calibrated.
+
+        Args:
+            flow (float): flow rate (ml/min).
+
+        Returns:
+            float: duration in seconds, None if the flow rate is not known.
+        """
+        if not flow:
+            return None
+        return math.ceil(60 * self.safety_factor * self.chamber_volume / flow)
+
+    def _duration(self, buffer, flow, position, dead_volume, chamber):
+        calib = self.buffers.get(buffer)
+        if calib is None:
+            return None
+        if position is not None and calib['position'] is not None and list(position) != list(calib['position']):
+            self.logger.warning(f'Position of buffer {buffer} changed since calibration, calibration not used.')
+            return None
+        flow = flow or calib['flow']
+        volume = self.safety_factor * (dead_volume * calib['dead_volume'] + chamber * self.chamber_volume)
+        return math.ceil(60 * volume / flow)
+
+    def pump_duration(self, buffer, duration, flow=None, position=None):
+        """ Pump duration of a step: the duration specified in the sequence, trimmed to the minimal
+        duration of the buffer (when calibrated).
+
+        Args:
+            buffer (str): buffer name.
+            duration (float): pump duration (s) specified in the sequence.
+            flow (float, optional): flow rate (ml/min). Defaults to flow rate of the calibration.
+            position (list, optional): current position of buffer. Defaults to None.
+
+        Returns:
+            float: pump duration in seconds.
+        """
+        duration_min = self.min_duration(buffer, flow, position)
+        if duration_min is None:
+            return duration
+        return min(duration, duration_min)
+
@@ -0,0 +1,312 @@
+'''
+autoFISH command line
+
+    autofish                      : start the GUI (default)
+    autofish run ...              : run all rounds of an experiment without GUI
+    autofish resume ...           : resume an interrupted run from its journal
+    autofish optimize ...         : show the optimized steps of each round (dry run)
+
+Progress is written to stdout as JSON lines, log messages to stderr and the log file.
+'''
+
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import argparse
+import json
+import signal
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+
+from autofish.logs import setup_logging
+from autofish.metrics import METRICS, prometheusWriter
+
+SYNC_MODES = ('pycromanager', 'remote', 'ttl', 'file-create', 'file-write')
+
+
+# ---------------------------------------------------------------------------
+# Machine-readable progress
+# ---------------------------------------------------------------------------
+
+class jsonProgress():
+    """ Writes progress as one JSON object per line, e.g. to stdout. Can be used as
+    progress callback of the robot (Robot.progress_fn).
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+        self.lock = Lock()
+
+    def __call__(self, **info):
+        self.emit('progress', **info)
+
+    def emit(self, event, **info):
+        entry = {'time': round(time.time(), 3), 'event': event, **info}
+        with self.lock:
+            self.stream.write(json.dumps(entry, default=str) + '\n')
+            self.stream.flush()
+
+
+# ---------------------------------------------------------------------------
+# Setup of fluidics and microscope
+# ---------------------------------------------------------------------------
+
+def create_robot(args, logger, logger_short, progress):
+    """ Robot from the system config: open serial ports and zero the plate robot at its current position.
+
+    Returns:
+        Robot: robot, None if the hardware could not be initiated.
+    """
+    from autofish.automator import Robot
+
+    R = Robot(args.system, logger=logger, logger_short=logger_short)
+    R.progress_fn = progress
+    R.initiate_system()
+
+    if not R.status['demo']:
+        if not R.status['ports_assigned']:
+            logger_short.error('Fluidics system could not be initiated, see log file.')
+            return None
+        if not args.no_zero:
+            logger_short.info('Current position of plate robot is used as zero.')
+            R.plate.zero_stage()
+        R.status['robot_zeroed'] = True
+
+    return R
+
+
+def create_microscope(args, logger, logger_short):
+    """ Microscope for the specified synchronization mode.
+
+    Returns:
+        Microscope: microscope, None if it could not be initiated.
+    """
+    from autofish.imager import pycroManager, TTL_sync, fileSync_write, fileSync_create
+
+    if args.sync == 'pycromanager':
+        M = pycroManager(logger=logger, logger_short=logger_short)
+        M.load_config_file(args.microscope)
+        M.load_position_list(file_pos=args.positions)
+        M.mm_connect(args.mm_headless)
+        M.create_acquisition_event()
+        if not M.status['acquisition_event']:
+            return None
+
+    elif args.sync == 'remote':
+        from autofish.remote import remoteMicroscope
+
+        # Microscope config: a worker with pycromanager is started (and restarted), otherwise host:port of a running worker
+        if Path(args.microscope).is_file():
+            worker_cmd = [sys.executable, '-m', 'autofish.remote', '--microscope', args.microscope,
+                          '--port', str(args.remote_port)]
+            if args.positions:
+                worker_cmd += ['--positions', args.positions]
+            if args.mm_headless:
+                worker_cmd.append('--mm-headless')
+            M = remoteMicroscope(port=args.remote_port, worker_cmd=worker_cmd, progress_timeout=args.progress_timeout,
+                                 acquisition_timeout=args.acquisition_timeout, logger=logger, logger_short=logger_short)
+        else:
+            host, port = args.microscope.rsplit(':', 1)
+            M = remoteMicroscope(host=host, port=int(port), progress_timeout=args.progress_timeout,
+                                 acquisition_timeout=args.acquisition_timeout, logger=logger, logger_short=logger_short)
+        if not M.connect():
+            return None
+
+    elif args.sync == 'ttl':
+        M = TTL_sync(logger=logger, logger_short=logger_short)
+        if not M.connect_serial_port(file_config_TTL=args.microscope):
+            return None
+
+    elif args.sync == 'file-write':
+        M = fileSync_write(logger=logger, logger_short=logger_short)
+        M.initiate_sync_file(args.microscope)
+
+    elif args.sync == 'file-create':
+        M = fileSync_create(logger=logger, logger_short=logger_short)
+        file_sync = Path(args.microscope)
+        if not isinstance(M.initiate_sync_file(path_sync_file=file_sync.parent, name_sync_file=file_sync.name), Path):
+            return None
+
+    return M
+
+
+def close_hardware(R, M, logger):
+    """ Stop pump, move plate robot to zero, close serial ports, and release the microscope.
+    """
+    if R is not None and not R.status['demo']:
+        try:
+            R.pump.stop()
+        except Exception:
+            logger.error('Could not stop pump.')
+        if R.status['robot_zeroed']:
+            R.plate.move_zero()
+        R.close_serial_ports()
+
+    if M is not None and M.__class__.__name__ == 'TTL_sync':
+        M.close_serial_port()
+
+    if M is not None:
+        M.close()
+
+
+# ---------------------------------------------------------------------------
+# Commands
+# ---------------------------------------------------------------------------
+
+def run(args):
+    """ Run all rounds (command run), or resume a run from its journal (command resume).
+
+    Returns:
+        int: exit code, 0 if the run finished, 1 if it failed, 130 if it was stopped.
+    """
+    from autofish.coordinator import Controller
+
+    data_string = datetime.now().strftime("%Y-%m-%d__%H-%M")
+    file_log = args.log_file or f'fluidics__{data_string}.log'
+    logger, logger_short, log_listener = setup_logging(file_log, name='Automator-CLI', name_short='Automator-CLI-STREAM')
+    metrics_writer = prometheusWriter(METRICS, args.metrics_file or f'metrics__{data_string}.prom', logger=logger).start()
+    progress = jsonProgress()
+
+    R, M, api = None, None, None
+    status = 'failed'
+    t_start = time.time()
+    try:
+        R = create_robot(args, logger, logger_short, progress)
+        M = create_microscope(args, logger, logger_short) if R is not None else None
+
+        if R is not None and M is not None:
+            # Stop cooperatively (after the current pump or pause) on Ctrl-C or SIGTERM
+            def request_stop(signum, frame):
+                logger_short.info('Stop requested, the run will stop after the current step.')
+                R.stop.set()
+            signal.signal(signal.SIGINT, request_stop)
+            signal.signal(signal.SIGTERM, request_stop)
+
+            C = Controller(Robot=R, Microscope=M, logger=logger, logger_short=logger_short)
+
+            # Questions to the operator are answered with the control API instead of the console
+            if args.api_port is not None:
+                from autofish.api import controlAPI
+                api = controlAPI(R, port=args.api_port, logger=logger).attach().start()
+                logger_short.info(f'Control API on http://127.0.0.1:{api.port}')
+
+            if args.command == 'run':
+                R.load_config_experiment(args.experiment)
+                if args.rounds:
+                    for round_id in R.rounds_available:
+                        if round_id not in args.rounds.split(','):
+                            R.scheduler.skip(round_id)
+                progress.emit('run_start', rounds=list(R.rounds_available), dir_save=args.dir_save)
+                C.run_all_rounds(args.dir_save, parallel_fluidics=args.parallel_fluidics)
+            else:
+                progress.emit('run_start', journal=args.journal)
+                C.resume(args.journal, dir_save=args.dir_save, parallel_fluidics=args.parallel_fluidics)
+
+            status = 'stopped' if R.stop.is_set() else 'done'
+
+    except SystemExit:
+        status = 'stopped' if (R is not None and R.stop.is_set()) else 'failed'
+
+    except Exception as e:
+        logger.exception(f'Run failed: {e}')
+
+    finally:
+        progress.emit('run_done', status=status, duration=round(time.time() - t_start, 1),
+                      rounds_remaining=R.rounds_available if R is not None else None,
+                      rounds_failed=R.scheduler.rounds('failed') if R is not None else None)
+        try:
+            if api is not None:
+                api.close()
+            close_hardware(R, M, logger)
+        finally:
+            metrics_writer.close()
+            log_listener.stop()
+
+    return {'done': 0, 'failed': 1, 'stopped': 130}[status]
+
+
+def optimize(args):
+    """ Dry run of the sequence optimizer: critical path before and after, and diff of the steps of each round.
+    """
+    from autofish.automator import Robot
+    from autofish.optimizer import sequenceOptimizer
+
+    R = Robot(args.system)
+    R.load_config_experiment(args.experiment)
+    optimizer = R.optimizer or sequenceOptimizer(R.experiment_config['sequence'],
+                                                 valve_out_positions=R.experiment_config.get('valve_out', {}).get('positions'))
+    rounds = args.rounds.split(',') if args.rounds else R.rounds_available
+    for round_id in rounds:
+        print(optimizer.report(round_id) + '\n')
+    return 0
+
+
+def gui(args):
+    from autofish import autofish_gui
+    autofish_gui.main()
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='autofish', description='Control of automated fluidics system and microscope.')
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('gui', help='start graphical user interface (default)')
+
+    parser_run = commands.add_parser('run', help='run all rounds of an experiment without GUI')
+    parser_resume = commands.add_parser('resume', help='resume an interrupted run from its journal')
+    parser_optimize = commands.add_parser('optimize', help='show the optimized steps of each round (dry run)')
+
+    for parser_cmd in (parser_run, parser_resume):
+        parser_cmd.add_argument('--system', required=True, help='system config of the fluidics (json)')
+        parser_cmd.add_argument('--sync', required=True, choices=SYNC_MODES, help='synchronization with the microscope')
+        parser_cmd.add_argument('--microscope', required=True,
+                                help='pycromanager: microscope config (yaml); remote: microscope config (yaml) '
+                                     'or host:port of a running worker; ttl: TTL config (json); '
+                                     'file-write / file-create: sync file')
+        parser_cmd.add_argument('--positions', help='position list (pycromanager)')
+        parser_cmd.add_argument('--mm-headless', action='store_true', help='start micromanager headless (pycromanager)')
+        parser_cmd.add_argument('--remote-port', type=int, default=6001, help='port of the acquisition worker (remote)')
+        parser_cmd.add_argument('--progress-timeout', type=float, default=300,
+                                help='maximum time without new image in seconds (remote), the acquisition is then hung '
+                                     'and the worker is restarted. Default: 300')
+        parser_cmd.add_argument('--acquisition-timeout', type=float,
+                                help='maximum duration of an acquisition in seconds (remote), the worker is then restarted')
+        parser_cmd.add_argument('--parallel-fluidics', action='store_true',
+                                help='move robot to the first buffer of the next round during imaging')
+        parser_cmd.add_argument('--no-zero', action='store_true',
+                                help='do not set the current position of the plate robot as zero')
+        parser_cmd.add_argument('--api-port', type=int,
+                                help='start control API on localhost with this port, questions are then answered with the API')
+        parser_cmd.add_argument('--log-file', help='log file. Defaults to fluidics__<date>.log')
+        parser_cmd.add_argument('--metrics-file', help='Prometheus text file. Defaults to metrics__<date>.prom')
+
+    parser_run.add_argument('--experiment', required=True, help='experiment config (yaml)')
+    parser_run.add_argument('--dir-save', required=True, help='folder to save images')
+    parser_run.add_argument('--rounds', help='comma-separated rounds to run. Defaults to all rounds')
+
+    parser_resume.add_argument('--journal', required=True, help='journal of the interrupted run')
+    parser_resume.add_argument('--dir-save', help='folder to save images. Defaults to folder of the run')
+
+    parser_optimize.add_argument('--system', required=True, help='system config of the fluidics (json)')
+    parser_optimize.add_argument('--experiment', required=True, help='experiment config (yaml)')
+    parser_optimize.add_argument('--rounds', help='comma-separated rounds. Defaults to all rounds')
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command in ('run', 'resume'):
+        sys.exit(run(args))
+    if args.command == 'optimize':
+        sys.exit(optimize(args))
+    sys.exit(gui(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
-import logging
+from autofish.logs import logMixin
+from autofish.memory import MEMORY
 
 
-class Controller():
+class Controller(logMixin):
     """Controller _summary_
     """
     def __init__(self, Robot, Microscope, logger=None, logger_short=None):
@@ -9,100 +10,193 @@ class Controller():
 
         Args:
             Robot (_type_): _description_
-            Microscope (_type_): _description_
+            Microscope (Microscope or list): one or several microscopes, all are started for each round.
             logger (_type_, optional): _description_. Defaults to None.
             logger_short (_type_, optional): _description_. Defaults to None.
         """
         # Setup logger
-        if isinstance(logger, type(None)):
-            self.logger = logging.getLogger('AUTOMATOR-Robot')  # Logs the name of the function
-            self.logger.setLevel(100)
-        else:
-            self.logger = logger
-
-        if isinstance(logger_short, type(None)):
-            self.logger_short = logging.getLogger('AUTOMATOR-Robot')  # Logs the name of the function
-            self.logger_short.setLevel(100)
-        else:
-            self.logger_short = logger_short
+        self.setup_loggers(logger, logger_short, name='AUTOMATOR-Controller', name_short='AUTOMATOR-Controller')
 
         # Assign control object for fluidic robot and microscope control
         self.R = Robot
-        self.M = Microscope
+        if isinstance(Microscope, (list, tuple)):
+            self.microscopes = list(Microscope)
+        else:
+            self.microscopes = [Microscope]
+        self.M = self.microscopes[0]
+
+        # Results of the online image QC (see autofish.qc)
+        for M in self.microscopes:
+            if getattr(M, 'qc', None) is not None:
+                M.qc.on_result = self.qc_result
 
-    # Function to handle both logging calls and different logging types
-    def log_msg(self, type, msg, msg_short=''):
-        """log_msg _summary_
+    # Function to run ALL rounds (in order listed )
+    def run_all_rounds(self, dir_save, parallel_fluidics=False, journal=True):
+        """run_all_rounds _summary_
 
         Args:
-            type (_type_): _description_
-            msg (_type_): _description_
-            msg_short (str, optional): _description_. Defaults to ''.
+            dir_save (_type_): _description_
+            parallel_fluidics (bool, optional): while imaging, move robot to the first buffer
+                of the next round (no pumping, the sample is not touched). Defaults to False.
+            journal (bool, optional): start a new journal of the run (to resume it after a crash).
+                Defaults to True.
         """
-        if type == 'info':
-            self.logger.info(msg)
-            if msg_short:
-                self.logger_short.info(msg_short)
-            else:
-                self.logger_short.info(msg)
+        if journal:
+            self.R.start_journal()
+        self.R.journal_write('run_settings', dir_save=str(dir_save))
+        MEMORY.configure_from(self.R.experiment_config.get('memory'), dir_save, logger=self.logger)
 
-        elif type == 'error':
-            self.logger.error(msg)
-            if msg_short:
-                self.logger_short.error(msg_short)
-            else:
-                self.logger_short.error(msg)
+        # The hardware is used by the run until the last round is imaged (see Robot.run_lock)
+        with self.R.run_lock:
+            # Rounds can be added, requeued or skipped while running (see Robot.scheduler)
+            while (round_id := self.next_round()) is not None:
+                if self.R.stop.is_set():
+                    self.log_msg('info', 'Run stopped.')
+                    break
 
-    # Function to run ALL rounds (in order listed )
-    def run_all_rounds(self, dir_save):
-        """run_all_rounds _summary_
+                self.log_fields = {'round': round_id}
+
+                # Memory is sampled before and after each round and acquisition
+                with MEMORY.span('round', round_id):
+
+                    # >> Perform fluidics
+                    self.log_msg('info', f'Running next ROUND {round_id}')
+                    self.R.run_single_round(round_id)
+
+                    # ToDo: check that fluidics run worked out
+
+                    # Acquire images
+                    if self.R.status['launch_acquisition']:
+                        self.acquire_images(round_id, dir_save, parallel_fluidics=parallel_fluidics)
+
+                # ToDo: check that acquisition worked out
+
+    def next_round(self):
+        """ Next round to run. When no round is left, waits for the image QC of the last acquisitions,
+        which can requeue a round.
+
+        Returns:
+            str: round id, None if all rounds are done.
+        """
+        round_id = self.R.scheduler.next()
+        if round_id is not None or self.R.stop.is_set():
+            return round_id
+
+        for M in self.microscopes:
+            qc = getattr(M, 'qc', None)
+            if qc is not None and not qc.wait_idle():
+                self.log_msg('warning', f'QC of last acquisition with {M._type()} not done after {qc.timeout}s.')
+        return self.R.scheduler.next()
+
+    def acquire_images(self, round_id, dir_save, parallel_fluidics=False):
+        """ Acquire images on all microscopes. Acquisitions can be repeated in case of a crash.
 
         Args:
-            dir_save (_type_): _description_
+            round_id (str): round id, used as name of the acquisition.
+            dir_save (str): folder to save data.
+            parallel_fluidics (bool, optional): move robot to the first buffer of the next round during imaging. Defaults to False.
         """
-        while len(self.R.rounds_available) > 0:
-            round_id = self.R.rounds_available[0]
+        acquisition_needed = True
+
+        while acquisition_needed:
+            with MEMORY.span('acquisition', round_id):
+                handles = [M.start_acquisition(dir_save=dir_save, name_base=f'{round_id}') for M in self.microscopes]
+
+                # Fluidics that does not touch the sample
+                if parallel_fluidics:
+                    self.prepare_next_round()
 
-            # >> Perform fluidics
-            self.log_msg('info', f'Running next ROUND {round_id}')
-            self.R.run_single_round(round_id)
+                # Wait for acquisitions, cancel them when the run is stopped
+                for handle in handles:
+                    while not handle.wait(timeout=1):
+                        if self.R.stop.is_set() and not handle.cancelled:
+                            handle.cancel()
 
-            # ToDo: check that fluidics run worked out
+            if self.R.stop.is_set():
+                self.log_msg('info', 'Acquisition cancelled, run stopped.')
+                return
 
-            # Acquire images
-            if self.R.status['launch_acquisition']:
+            errors = [(handle.microscope, handle.exception) for handle in handles if handle.exception is not None]
+            acquisition_needed = False
 
-                # Acquisition with file sync
-                if (self.M.__class__.__name__) in {'fileSync_write', 'fileSync_create','TTL_sync'}:
-                    self.M.acquire_images()
+            for M, e in errors:
+                self.log_msg('error', f'Problems during acquisition with {M._type()} ({e}).')
 
-                # Acquisition with pycromanager
-                elif (self.M.__class__.__name__) == 'pycroManager':
+            if not errors:
+                self.R.journal_write('acquisition_done', round=round_id)
 
-                    # This should help to repeat acquisitions in case of a crash
+            if errors:
+                # Ask user if acquisition should be repeated
+                self.log_msg('info', 'WAITING FOR USER INPUT ... "again" to repeat acquisition, otherwise run will continue.')
+                answer = self.R.operator.ask(f'Problems during acquisition of round {round_id}. Repeat acquisition?',
+                                             options=('continue', 'again'), stop=self.R.stop)
+                if answer == 'again':
                     acquisition_needed = True
 
-                    while acquisition_needed:
-                        try:
-                            self.M.acquire_images(
-                                dir_save=dir_save,
-                                name_base=f'{round_id}')
-                            acquisition_needed = False
-
-                        except Exception as e:
-                            self.log_msg('error', f'Problems during acquisition ({e}).')
-
-                            # Ask user if acquisition should be repeated
-                            self.log_msg('info', 'WAITING FOR USER INPUT ... type "again" to repeat acquisition')
-                            usr_input = input('WAITING FOR USER INPUT ... type "again" to repeat acquisition, otherwise run will continue.\n')
-                            if usr_input == 'again':
-                                acquisition_needed = True
-                            else:
-                                acquisition_needed = False
-
-                # Error when unknown instance of Microscope instance
-                else:
-                    self.log_msg('error', f'Unknown Microscope instance ({self.M.__class__.__name__}).')
-
-            # ToDo: check that acquisition worked out
-            # ToDo: create thread also for imaging (or combined with fluidics)
+    def qc_result(self, round_id, result):
+        """ Result of the image QC of a round (called from a QC worker). When thresholds are violated,
+        the round is requeued (run again after the current round) or the operator is alerted.
+
+        Args:
+            round_id (str): round id.
+            result (dict): see imageQC._evaluate.
+        """
+        violations = result['violations']
+        requeued = False
+
+        if violations:
+            qc = next(M.qc for M in self.microscopes if getattr(M, 'qc', None) is not None)
+            state = self.R.scheduler.state(round_id)
+            attempts = self.R.scheduler.attempts(round_id)
+
+            if qc.action == 'requeue' and state == 'done' and attempts <= qc.max_redo and not self.R.stop.is_set():
+                self.R.scheduler.requeue(round_id)
+                requeued = True
+                self.log_msg('error', f'QC of round {round_id} failed ({"; ".join(violations)}), round is requeued.')
+            else:
+                self.log_msg('error', f'QC of round {round_id} failed ({"; ".join(violations)}), CHECK THE IMAGES.')
+
+        self.R.journal_write('qc', round=round_id, violations=violations, requeued=requeued, channels=result['channels'])
+        self.R.report_progress(step='qc', round=round_id, violations=violations, requeued=requeued,
+                               channels=result['channels'])
+
+    def resume(self, file_journal, dir_save=None, parallel_fluidics=False):
+        """ Resume an interrupted run from its journal: acquire images of rounds that are done
+        but were not imaged, then continue with the first incomplete step.
+
+        Args:
+            file_journal (str): journal of the interrupted run.
+            dir_save (str, optional): folder to save data. Defaults to the folder in the journal.
+            parallel_fluidics (bool, optional): see run_all_rounds. Defaults to False.
+        """
+        with self.R.run_lock:
+            self._resume(file_journal, dir_save, parallel_fluidics)
+
+    def _resume(self, file_journal, dir_save, parallel_fluidics):
+        state = self.R.resume(file_journal)
+
+        if dir_save is None:
+            dir_save = state['dir_save']
+        MEMORY.configure_from(self.R.experiment_config.get('memory'), dir_save, logger=self.logger)
+
+        for round_id in state['acquisition_pending']:
+            self.log_msg('info', f'Resume: acquiring images of round {round_id}')
+            self.acquire_images(round_id, dir_save)
+
+        # Resumed run continues the journal of the interrupted run
+        self.run_all_rounds(dir_save, parallel_fluidics=parallel_fluidics, journal=False)
+
+    def prepare_next_round(self):
+        """ Move robot to the first buffer of the next round (valve and plate only, no pumping).
+        """
+        round_next = self.R.scheduler.next()
+        if round_next is None or self.R.status['demo']:
+            return
+
+        buffer_next = self.R.first_buffer(round_next)
+        if buffer_next is not None:
+            self.log_msg('info', f'During imaging: moving robot to buffer of next round {buffer_next}')
+            try:
+                self.R.select_buffer(buffer_next)
+            except SystemExit:
+                self.log_msg('error', f'Could not move to buffer {buffer_next} during imaging.')
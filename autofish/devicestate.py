@@ -0,0 +1,72 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+from contextlib import contextmanager
+from threading import Lock
+
+from autofish.metrics import METRICS
+
+
+# ---------------------------------------------------------------------------
+# Last known state of a device
+# ---------------------------------------------------------------------------
+
+class stateCache():
+    """ Last known state of a device, e.g. position of the plate robot, port of a valve, or flow rate
+    of a pump. Used by the device controllers to skip commands that would not change anything.
+
+    Values are only set after a command succeeded. Unknown values (never set, or invalidated after
+    an error, a timeout or a reconnect) never match, and the command is then sent.
+    """
+
+    def __init__(self, name='device'):
+        """__init__ _summary_
+
+        Args:
+            name (str, optional): name of the device, used for the metrics. Defaults to 'device'.
+        """
+        self.name = name
+        self.values = {}
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.values.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+
+    def skip(self, key, value):
+        """ Check if a command setting key to value can be skipped, i.e. the value is known and
+        identical. Skipped commands are counted in the metrics (commands_skipped_<name>).
+
+        Returns:
+            bool: True if the command can be skipped.
+        """
+        with self.lock:
+            known = key in self.values and self.values[key] == value
+        if known:
+            METRICS.increment(f'commands_skipped_{self.name}')
+        return known
+
+    def invalidate(self, *keys):
+        """ Forget the values of the specified keys, of all keys if none is specified.
+        """
+        with self.lock:
+            if not keys:
+                self.values.clear()
+            for key in keys:
+                self.values.pop(key, None)
+
+    @contextmanager
+    def guard(self):
+        """ Context manager for commands: the complete state is invalidated when the command raises
+        an exception, since it is then not known what the device did.
+        """
+        try:
+            yield self
+        except BaseException:
+            self.invalidate()
+            raise
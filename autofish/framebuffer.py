@@ -0,0 +1,245 @@
+'''
+Shared-memory ring buffer to pass acquired frames to consumer processes.
+
+The image hook of the acquisition copies each frame once into a free slot of a shared memory block
+and queues the slot index with a small metadata dict (no pickling of the image). Consumer processes
+map the same block, call the consumer function on a view of the slot (no copy), and release the
+slot. Heavy per-frame computation then runs on other cores, without the GIL of the acquisition.
+
+When all slots are in use (consumers are behind), the hook either drops the frame ('drop', the
+acquisition is never slowed down) or waits up to a timeout for a free slot ('block').
+
+Consumers are given as 'module:function' (imported in the worker, workers are started with the spawn
+start method on all platforms). The function is called with the frame (and the keyword arguments kwargs). With keep_results,
+values other than None are returned with the metadata of the frame to the acquisition process, and have
+to be read with frameRing.results (the queue of results is not bounded).
+
+Settings in the microscope config:
+    frames:
+        consumer: 'autofish.qc:tile_metrics'
+        workers: 2
+        slots: 16                # number of frames in the ring
+        shape: [2048, 2048]      # maximum frame shape
+        dtype: 'uint16'
+        policy: 'drop'           # or 'block'
+        timeout: 1               # s, for policy 'block'
+        keep_results: false      # return results of the consumer (read after each round)
+'''
+
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import importlib
+import logging
+import multiprocessing as mp
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from autofish.metrics import METRICS
+
+
+# ---------------------------------------------------------------------------
+# Consumer processes
+# ---------------------------------------------------------------------------
+
+def load_consumer(spec):
+    """ Function from 'module:function'.
+    """
+    module, function = spec.split(':')
+    return getattr(importlib.import_module(module), function)
+
+
+def _consume(name_shm, slot_bytes, consumer, kwargs, ready, free, results, counters):
+    """ Main function of a consumer process.
+    """
+    shm = shared_memory.SharedMemory(name=name_shm)
+    fn = load_consumer(consumer)
+    try:
+        while True:
+            item = ready.get()
+            if item is None:
+                return
+            slot, shape, dtype, metadata = item
+            frame = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=slot * slot_bytes)
+            try:
+                result = fn(frame, **kwargs)
+                if result is not None and results is not None:
+                    results.put((metadata, result))
+                with counters['processed'].get_lock():
+                    counters['processed'].value += 1
+            except Exception:
+                with counters['failed'].get_lock():
+                    counters['failed'].value += 1
+            finally:
+                del frame
+                free.put(slot)
+    finally:
+        shm.close()
+
+
+# ---------------------------------------------------------------------------
+# Ring buffer
+# ---------------------------------------------------------------------------
+
+class frameRing():
+    """ Ring of frame slots in shared memory, filled by the image hook and emptied by consumer processes
+    (see module docstring).
+    """
+
+    POLICIES = ('drop', 'block')
+
+    def __init__(self, consumer, workers=2, slots=16, shape=(2048, 2048), dtype='uint16', policy='drop', timeout=1,
+                 kwargs=None, keep_results=False, logger=None):
+        """__init__ _summary_
+
+        Args:
+            consumer (str): consumer function, 'module:function'.
+            workers (int, optional): number of consumer processes. Defaults to 2.
+            slots (int, optional): number of frames in the ring. Defaults to 16.
+            shape (tuple, optional): maximum frame shape. Defaults to (2048, 2048).
+            dtype (str, optional): maximum data type of frames. Defaults to 'uint16'.
+            policy (str, optional): when the ring is full, 'drop' the frame or 'block'. Defaults to 'drop'.
+            timeout (float, optional): maximum waiting time (s) for a free slot with policy 'block'. Defaults to 1.
+            kwargs (dict, optional): keyword arguments of the consumer function. Defaults to None.
+            keep_results (bool, optional): return results of the consumer to this process, they have to be read
+                with results(). Defaults to False.
+            logger (logging.Logger, optional): logger. Defaults to None.
+        """
+        if isinstance(logger, type(None)):
+            self.logger = logging.getLogger('AUTOMATOR-Frames')
+            self.logger.setLevel(100)
+        else:
+            self.logger = logger
+
+        if policy not in self.POLICIES:
+            raise ValueError(f'Policy of frame ring has to be one of {self.POLICIES}, not {policy}')
+
+        self.consumer = consumer
+        self.policy = policy
+        self.timeout = timeout
+        self.kwargs = kwargs or {}
+        self.n_slots = slots
+        self.slot_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.current_round = None
+
+        # Validate consumer before starting processes
+        load_consumer(consumer)
+
+        # Spawn on all platforms: forking a process with running threads (logging, actors) can deadlock
+        context = mp.get_context('spawn')
+        self.shm = shared_memory.SharedMemory(create=True, size=self.n_slots * self.slot_bytes)
+        self.ready = context.Queue()
+        self.free = context.Queue()
+        self.results_queue = context.Queue() if keep_results else None
+        self.counters = {key: context.Value('q', 0) for key in ('processed', 'failed')}
+        self.n_written = 0
+        self.n_dropped = 0
+        self.n_too_large = 0
+
+        for slot in range(self.n_slots):
+            self.free.put(slot)
+
+        self.workers = [context.Process(target=_consume, name=f'frames-{i}', daemon=True,
+                                        args=(self.shm.name, self.slot_bytes, consumer, self.kwargs, self.ready, self.free,
+                                              self.results_queue, self.counters))
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+        self.logger.info(f'Frame ring: {self.n_slots} slots of {self.slot_bytes / 2**20:.1f} MB, '
+                         f'{workers} consumer processes ({consumer}).')
+
+    @classmethod
+    def from_config(cls, config, logger=None):
+        config = dict(config)
+        if 'shape' in config:
+            config['shape'] = tuple(config['shape'])
+        return cls(logger=logger, **config)
+
+    # >>> Acquisition
+    def start_round(self, round_id):
+        self.current_round = round_id
+
+    def _acquire_slot(self):
+        try:
+            if self.policy == 'block':
+                return self.free.get(timeout=self.timeout)
+            return self.free.get_nowait()
+        except queue.Empty:
+            return None
+
+    def put(self, image, metadata=None):
+        """ Copy a frame into a free slot and queue it for the consumers.
+
+        Args:
+            image (np.ndarray): frame.
+            metadata (dict, optional): small, picklable metadata, e.g. axes of the frame. Defaults to None.
+
+        Returns:
+            bool: True if the frame was queued, False if it was dropped.
+        """
+        image = np.asarray(image)
+        if image.nbytes > self.slot_bytes:
+            self.n_too_large += 1
+            METRICS.increment('frames_too_large')
+            return False
+
+        slot = self._acquire_slot()
+        if slot is None:
+            self.n_dropped += 1
+            METRICS.increment('frames_dropped')
+            return False
+
+        frame = np.ndarray(image.shape, dtype=image.dtype, buffer=self.shm.buf, offset=slot * self.slot_bytes)
+        frame[...] = image
+        del frame
+
+        self.ready.put((slot, image.shape, image.dtype.str, metadata or {}))
+        self.n_written += 1
+        return True
+
+    def image_process_fn(self, image, metadata):
+        """ Image hook for pycromanager: queue the frame (with its axes and round), returns the image unchanged.
+        """
+        self.put(image, {'round': self.current_round, 'axes': metadata.get('Axes', {})})
+        return image, metadata
+
+    # >>> Results
+    def results(self):
+        """ Results of the consumers available so far, list of (metadata, result).
+        """
+        items = []
+        if self.results_queue is None:
+            return items
+        while True:
+            try:
+                items.append(self.results_queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    def stats(self):
+        """ Frame counters: written to the ring, dropped (ring full), too large for a slot, processed, failed.
+        """
+        return {'written': self.n_written,
+                'dropped': self.n_dropped,
+                'too_large': self.n_too_large,
+                'processed': self.counters['processed'].value,
+                'failed': self.counters['failed'].value}
+
+    def close(self, timeout=10):
+        """ Let consumers process the queued frames, stop them and release the shared memory.
+        """
+        for _ in self.workers:
+            self.ready.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                self.logger.warning(f'Frame consumer {worker.name} did not stop, terminating.')
+                worker.terminate()
+
+        self.logger.info(f'Frame ring closed: {self.stats()}')
+        self.shm.close()
+        self.shm.unlink()
@@ -4,74 +4,135 @@
 # Imports
 # ---------------------------------------------------------------------------
 
-import numpy as np
-import logging
 import time
 import yaml
 import json
 import serial
-from threading import Event
+from threading import Event, Thread
 import gc
+from collections import deque
 from pathlib import Path
 
+from autofish.logs import logMixin
+from autofish.metrics import METRICS
 
-try:
-    from pycromanager import Core
-    from pycromanager import Acquisition, multi_d_acquisition_events, start_headless
-except ImportError:
-    print('Pyrcomanger is not installed, please install if required!')
+
+def _pycromanager():
+    """ Import pycromanager when it is used: it is optional, and importing it (and its Java bridge) is slow.
+    """
+    try:
+        import pycromanager
+    except ImportError as e:
+        raise ImportError('Pycromanager is not installed, please install if required (pip install pycromanager)!') from e
+    return pycromanager
 
 # ---------------------------------------------------------------------------
 # Parental class
 # ---------------------------------------------------------------------------
 
 
-class Microscope:
+class acquisitionHandle():
+    """ Handle of an acquisition running in the background, returned by Microscope.start_acquisition.
+    """
+
+    def __init__(self, microscope, dir_save=None, name_base='test'):
+        """__init__ _summary_
+
+        Args:
+            microscope (Microscope): microscope running the acquisition.
+            dir_save (str, optional): folder to save data. Defaults to None.
+            name_base (str, optional): name of the acquisition. Defaults to 'test'.
+        """
+        self.microscope = microscope
+        self.name_base = name_base
+        self.done = Event()
+        self.exception = None
+        self.cancelled = False
+
+        self.thread = Thread(target=self._run, args=(dir_save, name_base), daemon=True)
+        self.thread.start()
+
+    def _run(self, dir_save, name_base):
+        try:
+            with METRICS.span('acquire_images', self.microscope._type()):
+                self.microscope.acquire_images(dir_save=dir_save, name_base=name_base)
+        except Exception as e:
+            self.exception = e
+        finally:
+            self.done.set()
+
+    def poll(self):
+        """ Returns True if acquisition is finished (successfully, with an error, or cancelled).
+        """
+        return self.done.is_set()
+
+    def wait(self, timeout=None):
+        """ Wait until acquisition is finished.
+
+        Args:
+            timeout (float, optional): maximum time to wait in seconds. Defaults to None (wait forever).
+
+        Returns:
+            bool: True if acquisition is finished.
+        """
+        return self.done.wait(timeout)
+
+    def cancel(self):
+        """ Ask the microscope to stop the acquisition.
+        """
+        self.cancelled = True
+        self.microscope.cancel_acquisition()
+
+
+class Microscope(logMixin):
     def __init__(self, logger=None, logger_short=None):
 
         # Setup logger
-        if isinstance(logger, type(None)):
-            self.logger = logging.getLogger('AUTOMATOR-Robot')  # Logs the name of the function
-            self.logger.setLevel(100)
-        else:
-            self.logger = logger
+        self.setup_loggers(logger, logger_short, name='AUTOMATOR-Microscope', name_short='AUTOMATOR-Microscope')
+        self.log_fields = {'device': self._type()}
 
-        if isinstance(logger_short, type(None)):
-            self.logger_short = logging.getLogger('AUTOMATOR-Microscope')  # Logs the name of the function
-            self.logger_short.setLevel(100)
-        else:
-            self.logger_short = logger_short
+        # For threading: set to cancel a running acquisition
+        self.stop = Event()
+
+        # Number of acquired images, shows the progress of acquisitions (e.g. heartbeat of the acquisition worker)
+        self.n_images = 0
 
     def _type(self):
         return self.__class__.__name__
 
-    def acquire_images(self):
-        """acquire_images _summary_
+    def acquire_images(self, dir_save=None, name_base='test'):
+        """ Acquire images, returns when acquisition is done.
+
+        Args:
+            dir_save (str, optional): folder to save data. Defaults to None.
+            name_base (str, optional): name of the acquisition. Defaults to 'test'.
         """
-        pass
+        raise NotImplementedError('No acquire_images function defined for this class!')
 
-    # Function to handle both logging calls and different logging types
-    def log_msg(self, type, msg, msg_short=''):
-        """log_msg _summary_
+    def start_acquisition(self, dir_save=None, name_base='test'):
+        """ Start acquisition in the background.
 
         Args:
-            type (_type_): _description_
-            msg (_type_): _description_
-            msg_short (str, optional): _description_. Defaults to ''.
-        """
-        if type == 'info':
-            self.logger.info(msg)
-            if msg_short:
-                self.logger_short.info(msg_short)
-            else:
-                self.logger_short.info(msg)
+            dir_save (str, optional): folder to save data. Defaults to None.
+            name_base (str, optional): name of the acquisition. Defaults to 'test'.
+
+        Returns:
+            acquisitionHandle: handle to poll, wait for or cancel the acquisition.
+        """
+        self.stop.clear()
+        return acquisitionHandle(self, dir_save=dir_save, name_base=name_base)
+
+    def cancel_acquisition(self):
+        """ Cancel a running acquisition.
+        """
+        self.log_msg('info', 'Cancelling acquisition.')
+        self.stop.set()
+
+    def close(self):
+        """ Release the resources of the microscope (worker threads and processes, shared memory).
+        """
+        pass
 
-        elif type == 'error':
-            self.logger.error(msg)
-            if msg_short:
-                self.logger_short.error(msg_short)
-            else:
-                self.logger_short.error(msg)  
 
 
 # ---------------------------------------------------------------------------
@@ -87,12 +148,13 @@ class pycroManager(Microscope):
         # Involve the init function of the parent class
         super().__init__(logger, logger_short)
 
-        # For threading
-        self.stop = Event()
-
         # Other parameters
         self.config = []
         self.positions = []
+        self.store = None
+        self.qc = None      # Online image QC
+        self.frames = None  # Shared-memory ring buffer for consumer processes
+        self.acq = None     # Running acquisition
 
         # Robot status flags
         self.status = {
@@ -119,6 +181,41 @@ class pycroManager(Microscope):
         else:
             self.timeout = 500
 
+        # Storage of images: one NDTiff dataset per round, or all rounds in one OME-Zarr store
+        self.store = None
+        if 'storage' in self.config:
+            if self.config['storage']['type'] != 'ome-zarr':
+                self.log_msg('error', f'Unknown storage type: {self.config["storage"]["type"]}, will use NDTiff')
+
+        # Bounded-memory mode: at most max_frames images are queued (acquisition engine, QC, frame ring)
+        max_frames = self.config.get('max_frames')
+        if max_frames:
+            streaming = self.config.get('streaming')
+            streaming = dict(streaming) if isinstance(streaming, dict) else {}
+            streaming['in_flight'] = streaming.get('in_flight', 1)
+            streaming['batch'] = min(streaming.get('batch', max_frames), max(1, max_frames // (streaming['in_flight'] + 1)))
+            self.config['streaming'] = streaming
+            if 'qc' in self.config:
+                self.config['qc'] = {**self.config['qc'], 'queue': min(self.config['qc'].get('queue', 64), max_frames)}
+            if 'frames' in self.config:
+                self.config['frames'] = {**self.config['frames'], 'slots': min(self.config['frames'].get('slots', 16), max_frames)}
+
+        # Online image QC (worker threads, see autofish.qc)
+        if self.qc is not None:
+            self.qc.close()
+            self.qc = None
+        if 'qc' in self.config:
+            from autofish.qc import imageQC
+            self.qc = imageQC.from_config(self.config['qc'], logger=self.logger)
+
+        # Frames passed to consumer processes (see autofish.framebuffer)
+        if self.frames is not None:
+            self.frames.close()
+            self.frames = None
+        if 'frames' in self.config:
+            from autofish.framebuffer import frameRing
+            self.frames = frameRing.from_config(self.config['frames'], logger=self.logger)
+
         self.status['config'] = True
         self.log_msg('info', f'Microscope config loaded: {self.config}.')
 
@@ -141,11 +238,11 @@ class pycroManager(Microscope):
                 config_file = str(Path(self.config['mm_app_path'], self.config['mm_config_file']))
 
                 if Path(mm_app_path).is_dir() and Path(config_file).is_file():
-                    start_headless(mm_app_path, config_file)
+                    _pycromanager().start_headless(mm_app_path, config_file)
                 else:
                     self.log_msg('error',f'MM configuration file/path does not exist: {config_file}!')
             else:
-                self.core = Core()
+                self.core = _pycromanager().Core()
 
             self.status['micromanger_connect'] = True
             self.log_msg('info', 'Communction with micromanager etablished.')
@@ -173,6 +270,48 @@ class pycroManager(Microscope):
         except Exception as e:
             self.log_msg('error', f'Could set micromanger parameters ({e}).')
 
+    def mm_core(self):
+        """ Core of micromanager (also when micromanager was started headless).
+        """
+        if getattr(self, 'core', None) is None:
+            self.core = _pycromanager().Core()
+        return self.core
+
+    def light_off(self):
+        """ Turn off the light after the acquisition, set with 'light_off' in the config file:
+            'config'      : set the channel config 'channel_blank' (default when channel_blank is set).
+            'shutter'     : close the shutter ('shutter' in the config file, default: current shutter).
+            'acquisition' : acquire one image of channel_blank at the current position (images are not saved).
+        When the core command fails, the blank acquisition is used.
+        """
+        method = self.config.get('light_off', 'config' if 'channel_blank' in self.config else None)
+        if method is None:
+            return
+
+        if method in ('config', 'shutter'):
+            try:
+                core = self.mm_core()
+                if method == 'config':
+                    core.set_config(self.config['channel_group'], self.config['channel_blank'])
+                    core.wait_for_config(self.config['channel_group'], self.config['channel_blank'])
+                elif 'shutter' in self.config:
+                    core.set_shutter_open(self.config['shutter'], False)
+                else:
+                    core.set_shutter_open(False)
+                self.log_msg('info', f'Light turned off ({method}).')
+                return
+            except Exception as e:
+                self.log_msg('error', f'Could not turn off light with {method} ({e}), will use blank acquisition.')
+
+        if self.event_blank is None:
+            self.log_msg('error', 'Could not turn off light: no channel_blank in config.')
+            return
+
+        self.log_msg('info', 'Start blank acquisition.')
+        with _pycromanager().Acquisition(directory=None, name='_blank', image_process_fn=lambda image, metadata: None,
+                                         show_display=False, timeout=self.timeout) as acq:
+            acq.acquire(self.event_blank)
+
     # Read config file with some settings
     def load_position_list(self, file_pos=None):
         """load_position_list _summary_
@@ -186,6 +325,8 @@ class pycroManager(Microscope):
             file_pos (_type_): _description_
         """
 
+        import numpy as np
+
         self.log_msg('info', f'Reading position list for microscope type {self.config["type"]}')
 
         # For demo
@@ -247,34 +388,272 @@ class pycroManager(Microscope):
         # Reset acquisition event flag
         self.status['acquisition_event'] = False
 
+    def sequencing_support(self):
+        """ Check which axes can be hardware-sequenced by the Micro-Manager devices: z (focus stage)
+        and channels (all properties of the channel group, with the same exposure for all channels).
+
+        Returns:
+            dict: {'z': bool, 'channels': bool}
+        """
+        support = {'z': False, 'channels': False}
+        try:
+            core = self.mm_core()
+
+            support['z'] = bool(core.is_stage_sequenceable(core.get_focus_device()))
+
+            support['channels'] = len(set(self.config['channel_exposures_ms'])) == 1
+            for channel in self.config['channels']:
+                config_data = core.get_config_data(self.config['channel_group'], channel)
+                for i in range(config_data.size()):
+                    setting = config_data.get_setting(i)
+                    if not core.is_property_sequenceable(setting.get_device_label(), setting.get_property_name()):
+                        support['channels'] = False
+
+        except Exception as e:
+            self.log_msg('error', f'Could not check hardware sequencing of the devices ({e}).')
+
+        return support
+
+    def acquisition_order(self):
+        """ Order of the acquisition axes (outermost first), from 'order' in the config file (e.g. 'cz':
+        a z-stack for each channel, 'zc': all channels for each z-plane). Time and positions are always
+        the outer axes.
+
+        With 'sequencing' in the config file ('z', 'channels', or both as list), the sequenced axis is
+        acquired innermost, so that Micro-Manager runs it as one hardware sequence without software
+        waits between images. Falls back to the configured order when the devices don't support it.
+
+        Returns:
+            str: order for multi_d_acquisition_events, e.g. 'tpcz'.
+        """
+        order = self.config.get('order', 'cz')
+        if sorted(order) != ['c', 'z']:
+            self.log_msg('error', f'Acquisition order has to be "cz" or "zc", not {order}. Will use "cz".')
+            order = 'cz'
+
+        sequencing = self.config.get('sequencing', [])
+        sequencing = [sequencing] if isinstance(sequencing, str) else list(sequencing or [])
+        if sequencing:
+            support = self.sequencing_support()
+            axes = [axis for axis in sequencing if support.get(axis, False)]
+            for axis in sequencing:
+                if axis not in axes:
+                    self.log_msg('info', f'Hardware sequencing of {axis} not supported by the devices, software timed.')
+
+            # Both axes sequenced: any order works, otherwise the sequenced axis is innermost
+            if axes == ['z']:
+                order = 'cz'
+            elif axes == ['channels']:
+                order = 'zc'
+            self.log_msg('info', f'Hardware sequencing of: {axes}, acquisition order {order}.')
+
+        return 'tp' + order
+
+    def z_offsets(self):
+        """ Z offset of each position from 'z_offsets' in the config file: list with one offset per
+        position, or dictionary {position index: offset}. Defaults to 0.
+
+        Returns:
+            np.ndarray: offsets.
+        """
+        import numpy as np
+
+        offsets = np.zeros(len(self.positions))
+        config_offsets = self.config.get('z_offsets') or {}
+        if isinstance(config_offsets, list):
+            config_offsets = dict(enumerate(config_offsets))
+        for i_pos, offset in config_offsets.items():
+            if int(i_pos) < len(offsets):
+                offsets[int(i_pos)] = offset
+        return offsets
+
+    def acquisition_events(self, batch_size=1000):
+        """ Stream acquisition events position by position, instead of creating all events of the
+        acquisition up front. Batches contain the events of whole positions (hardware sequences of a
+        position are not split), at most batch_size events unless a position has more.
+
+        Args:
+            batch_size (int, optional): maximum number of events per batch. Defaults to 1000.
+
+        Yields:
+            list: events.
+        """
+        import numpy as np
+        multi_d_acquisition_events = _pycromanager().multi_d_acquisition_events
+
+        offsets = self.z_offsets()
+        batch = []
+
+        for i_pos, position in enumerate(self.positions):
+            xyz = np.asarray(position, dtype=float).copy()
+            xyz[2] += offsets[i_pos]
+
+            events = multi_d_acquisition_events(
+                channel_group=self.config['channel_group'],
+                channels=self.config['channels'],
+                channel_exposures_ms=self.config['channel_exposures_ms'],
+                xyz_positions=xyz[None, :],
+                z_start=self.config['z_start'],
+                z_end=self.config['z_end'],
+                z_step=self.config['z_step'],
+                order=self.order)
+            for event in events:
+                event['axes']['position'] = i_pos
+
+            if batch and len(batch) + len(events) > batch_size:
+                yield batch
+                batch = []
+            batch += events
+
+        if batch:
+            yield batch
+
+    def acquire_streaming(self, acq, counter):
+        """ Submit the streamed events in batches, with at most in_flight batches waiting in the acquisition
+        engine (settings 'streaming' in the config file: true, or a dictionary with 'batch', 'in_flight', and
+        'timeout', the time in seconds without new image after which the next batches are submitted anyway).
+
+        Args:
+            acq (Acquisition): running acquisition.
+            counter (dict): number of received images ('n'), incremented by the image hook.
+        """
+        settings = self.config['streaming'] if isinstance(self.config['streaming'], dict) else {}
+        batch_size = settings.get('batch', 1000)
+        in_flight = settings.get('in_flight', 2)
+        timeout = settings.get('timeout', 60)
+
+        submitted = deque()
+        n_submitted = 0
+        for batch in self.acquisition_events(batch_size):
+            if self.stop.is_set():
+                return
+            acq.acquire(batch)
+            n_submitted += len(batch)
+            submitted.append(n_submitted)
+
+            # Back-pressure: wait until the images of the oldest batches arrived
+            n_received, t_received = counter['n'], time.monotonic()
+            while len(submitted) > in_flight:
+                if counter['n'] >= submitted[0]:
+                    submitted.popleft()
+                elif self.stop.is_set():
+                    submitted.clear()
+                elif counter['n'] != n_received:
+                    n_received, t_received = counter['n'], time.monotonic()
+                elif time.monotonic() - t_received > timeout:
+                    self.log_msg('error', f'Streaming: no images for {timeout}s, submitting next batches.')
+                    submitted.clear()
+                else:
+                    time.sleep(0.02)
+
     # Create the acquisition event with the specified parameters in the config file
     def create_acquisition_event(self):
         """create_acquisition_event _summary_
         """
-        # Actual acquisition event
-        self.event = multi_d_acquisition_events(
-            channel_group=self.config['channel_group'],
-            channels=self.config['channels'],
-            channel_exposures_ms=self.config['channel_exposures_ms'],
-            xyz_positions=self.positions,
-            z_start=self.config['z_start'],
-            z_end=self.config['z_end'],
-            z_step=self.config['z_step'])
-
-        # - Create a blank acquisition event
+        multi_d_acquisition_events = _pycromanager().multi_d_acquisition_events
+        self.order = self.acquisition_order()
+
+        # Actual acquisition event. When streaming, events are created during the acquisition (see acquisition_events)
+        if self.config.get('streaming'):
+            self.event = None
+        else:
+            self.event = multi_d_acquisition_events(
+                channel_group=self.config['channel_group'],
+                channels=self.config['channels'],
+                channel_exposures_ms=self.config['channel_exposures_ms'],
+                xyz_positions=self.positions + self.z_offsets()[:, None] * [0, 0, 1],
+                z_start=self.config['z_start'],
+                z_end=self.config['z_end'],
+                z_step=self.config['z_step'],
+                order=self.order)
+
+        # - Create a blank acquisition event (fallback of light_off), at the current position
         #     Can be necessary to turn off light on certain systems
         self.event_blank = None
         if 'channel_blank' in self.config.keys():
-
-            self.event_blank = multi_d_acquisition_events(
-                channel_group=self.config['channel_group'],
-                channels=[self.config['channel_blank']],
-                channel_exposures_ms=[0],
-                xyz_positions=np.asarray([self.positions[0]]))
+            self.event_blank = {'axes': {'channel': self.config['channel_blank']},
+                                'config_group': [self.config['channel_group'], self.config['channel_blank']],
+                                'exposure': 0}
 
         self.status['acquisition_event'] = True
         self.log_msg('info', 'Multi-D acquisition event created.')
 
+    def open_store(self, dir_save):
+        """ Open OME-Zarr store in the save folder, when specified in the config file.
+        The same store is used for all following rounds.
+
+        Args:
+            dir_save (str): folder to save data.
+
+        Returns:
+            omeZarrStore: store, or None if images are saved as NDTiff.
+        """
+        if 'storage' not in self.config or self.config['storage']['type'] != 'ome-zarr':
+            return None
+
+        settings = self.config['storage']
+        path_store = Path(dir_save, f"{settings.get('name', 'experiment')}.ome.zarr")
+
+        if self.store is None or self.store.path_store != path_store:
+            from autofish.storage import omeZarrStore
+            self.store = omeZarrStore(path_store,
+                                      channels=self.config['channels'],
+                                      n_levels=settings.get('levels', 3),
+                                      clevel=settings.get('clevel', 5),
+                                      logger=self.logger)
+        return self.store
+
+    def image_process_fn(self, store=None, counter=None):
+        """ Image hook of the acquisition: counting of images (progress, and streaming), QC and frame
+        ring (only queue the image), then saving to the store.
+
+        Returns:
+            callable: image hook.
+        """
+        def count_fn(image, metadata):
+            self.n_images += 1
+            if counter is not None:
+                counter['n'] += 1
+            return image, metadata
+
+        hooks = [count_fn] + [hook.image_process_fn for hook in (self.qc, self.frames, store) if hook is not None]
+        if len(hooks) == 1:
+            return hooks[0]
+
+        def image_process_fn(image, metadata):
+            for hook in hooks:
+                result = hook(image, metadata)
+                if result is None:  # Image consumed (not saved in a dataset)
+                    return None
+                image, metadata = result
+            return image, metadata
+        return image_process_fn
+
+    def acquire_events(self, acq, counter=None):
+        """ Submit the events of the acquisition: all at once, or streamed in batches.
+        """
+        if self.event is None:
+            self.acquire_streaming(acq, counter)
+        else:
+            acq.acquire(self.event)
+
+    def cancel_acquisition(self):
+        """ Cancel a running acquisition by aborting the pycromanager acquisition.
+        """
+        super().cancel_acquisition()
+        if self.acq is not None:
+            self.acq.abort()
+
+    def close(self):
+        """ Stop the QC workers and the frame consumers, and release the shared memory of the frame ring.
+        """
+        if self.qc is not None:
+            self.qc.close()
+            self.qc = None
+        if self.frames is not None:
+            self.frames.close()
+            self.frames = None
+
     def acquire_images(self, dir_save, name_base='test'):
         """acquire_images _summary_
 
@@ -283,24 +662,52 @@ class pycroManager(Microscope):
             name_base (str, optional): _description_. Defaults to 'test'.
         """
 
+        Acquisition = _pycromanager().Acquisition
+
         # Regular acquisition
         self.log_msg('info', 'Start acquisition.')
-        with Acquisition(directory=dir_save, name=name_base, show_display=False, timeout=self.timeout) as acq:
-            self.log_msg('info', f'Acquisition will be saved as: {acq._dataset_disk_location}')
-            acq.acquire(self.event)
+        t_start = time.perf_counter()
+        store = self.open_store(dir_save)
+        if self.qc:
+            self.qc.start_round(name_base, dir_save)
+        if self.frames:
+            self.frames.start_round(name_base)
+        counter = {'n': 0} if self.config.get('streaming') else None
+
+        if store:
+            store.start_round(name_base)
+            self.log_msg('info', f'Acquisition will be saved in: {store.path_store}, round {name_base}')
+            with Acquisition(directory=None, name=name_base, image_process_fn=self.image_process_fn(store, counter),
+                             show_display=False, timeout=self.timeout) as acq:
+                self.acq = acq
+                self.acquire_events(acq, counter)
+            store.end_round()
+        else:
+            with Acquisition(directory=dir_save, name=name_base, image_process_fn=self.image_process_fn(None, counter),
+                             show_display=False, timeout=self.timeout) as acq:
+                self.acq = acq
+                self.log_msg('info', f'Acquisition will be saved as: {acq._dataset_disk_location}')
+                self.acquire_events(acq, counter)
+        self.acq = None
         del acq
         gc.collect()
 
-        # Blank acquisition
-        if self.event_blank:
-            self.log_msg('info', 'Start blank acquisition.')
-            with Acquisition(directory=dir_save, name='_delete_blank', show_display=False, timeout=self.timeout) as acq:
-                self.log_msg('info', f'Acquisition will be saved as: {acq._dataset_disk_location}')
-                acq.acquire(self.event_blank)
-            del acq
-            gc.collect()
+        # QC of the round is evaluated by the workers once they analyzed all queued images
+        if self.qc:
+            self.qc.end_round(discard=self.stop.is_set())
+        if self.frames:
+            self.log_msg('info', f'Frames passed to consumers: {self.frames.stats()}')
+            results = self.frames.results()
+            if results:
+                self.log_msg('info', f'Results of frame consumers: {len(results)}')
+
+        if self.stop.is_set():
+            self.log_msg('info', 'Acquisition cancelled.')
+            return
 
-        self.log_msg('info', 'End of acquisition')
+        self.light_off()
+
+        self.log_msg('info', 'End of acquisition', round=name_base, duration=round(time.perf_counter() - t_start, 3))
 
 
 # ------------------------------------------------------------------------------------------------
@@ -308,6 +715,38 @@ class pycroManager(Microscope):
 # ------------------------------------------------------------------------------------------------
 
 
+def parse_ttl_frame(txt_frame):
+    """ Parse a frame of the serial protocol of the Arduino for TTL synchronization.
+
+    Frames have the format @<seq>,<event>,<micros>*<checksum>
+        seq      : sequence number of the frame (0-255, wraps around)
+        event    : READY, ACK, TRIG, FIN, ERR
+        micros   : device time in microseconds when the event occurred (wraps around after ~71 min)
+        checksum : XOR of all characters between @ and *, as 2-digit hex
+
+    Args:
+        txt_frame (str): line received from serial port.
+
+    Returns:
+        dict: with keys seq, event, micros; None if the line is not a valid frame.
+    """
+    if not (txt_frame.startswith('@') and '*' in txt_frame):
+        return None
+
+    payload, checksum = txt_frame[1:].rsplit('*', 1)
+    checksum_calc = 0
+    for c in payload:
+        checksum_calc ^= ord(c)
+
+    try:
+        if int(checksum, 16) != checksum_calc:
+            return None
+        seq, event, micros = payload.split(',')
+        return {'seq': int(seq), 'event': event, 'micros': int(micros)}
+    except ValueError:
+        return None
+
+
 class TTL_sync(Microscope):
     def __init__(self, **kargs):
 
@@ -315,7 +754,15 @@ class TTL_sync(Microscope):
         super().__init__(**kargs)
 
         # For threading
-        self.stop = Event()
+        self.finished = Event()     # Set by serial reader when acquisition finished
+        self.stop_reader = Event()
+        self.reader = None
+
+        # Received edges of the current acquisition (with device and host time), and latencies of each acquisition
+        self.edges = deque(maxlen=1000)
+        self.latencies = []
+        self.seq_last = None
+        self.t_trigger = None
 
         # Robot status flags
         self.status = {
@@ -354,42 +801,122 @@ class TTL_sync(Microscope):
             return(False)
 
         self.config_TLL = config_TLL
+
+        # Start dedicated thread reading from the serial port
+        self.stop_reader.clear()
+        self.reader = Thread(target=self.read_serial, daemon=True)
+        self.reader.start()
+
         return(True)
-    
-    def acquire_images(self):
-        """acquire_images _summary_
+
+    def read_serial(self):
+        """ Reads frames from the serial port until the port is closed. Runs in a dedicated thread.
+        readline returns as soon as a line is complete, the serial time-out only defines how
+        often the stop flag is checked.
+        """
+        ser = self.config_TLL['TTL']['ser']
+
+        while not self.stop_reader.is_set():
+            try:
+                txt_serial = ser.readline().decode('ascii', errors='replace').rstrip()
+            except (serial.SerialException, TypeError, AttributeError) as e:
+                if not self.stop_reader.is_set():
+                    self.log_msg('error', f'Reading from serial port of TTL sync failed ({e}).')
+                break
+
+            if not txt_serial:
+                continue
+
+            t_host = time.perf_counter()
+            frame = parse_ttl_frame(txt_serial)
+
+            # Older firmware without framed protocol
+            if frame is None:
+                if txt_serial == 'finished':
+                    frame = {'seq': None, 'event': 'FIN', 'micros': None}
+                else:
+                    self.logger.info(f'TTL sync: not a valid frame: {txt_serial}')
+                    continue
+
+            # Check for lost frames
+            if frame['seq'] is not None:
+                if self.seq_last is not None and frame['seq'] != (self.seq_last + 1) % 256:
+                    self.log_msg('error', f'TTL sync: frames lost (sequence {self.seq_last} -> {frame["seq"]}).')
+                self.seq_last = frame['seq']
+
+            frame['t_host'] = t_host
+            self.edges.append(frame)
+            self.logger.info(f'TTL sync: received {frame["event"]} (seq {frame["seq"]}, device time {frame["micros"]} us)')
+
+            if frame['event'] == 'ACK' and self.t_trigger is not None:
+                METRICS.observe('sync_handoff', self._type(), t_host - self.t_trigger)
+            elif frame['event'] == 'FIN':
+                self.finished.set()
+            elif frame['event'] == 'ERR':
+                self.log_msg('error', 'TTL sync: Arduino reported an error.')
+
+    def acquire_images(self, dir_save=None, name_base=None):
+        """ Start acquisition with a TTL trigger, and wait until the Arduino reports that acquisition is finished.
+
+        Args:
+            dir_save (str, optional): not used, data is saved by the acquisition software. Defaults to None.
+            name_base (str, optional): name of the acquisition (round id), used to record latencies. Defaults to None.
+
+        Raises:
+            RuntimeError: serial reader is not running, the end of the acquisition can not be detected.
         """
 
         # Start acquisition by sending command to serial port
-        # send 'Start acquisition'
+        self.finished.clear()
+        self.edges.clear()
+        t_start = time.perf_counter()
+        self.t_trigger = t_start
         self.config_TLL['TTL']['ser'].write(('start' + '\n').encode())
 
-        # Read from serial port until acquisition is done
+        # Wait until serial reader received that acquisition is done
         self.log_msg('info', 'Checking TTL for completion')
+        while not self.finished.wait(timeout=1):
+            if self.reader is None or not self.reader.is_alive():
+                self.log_msg('error', 'TTL sync: serial reader is not running.')
+                raise RuntimeError('TTL sync: serial reader is not running')
+            if self.stop.is_set():
+                self.log_msg('info', 'Acquisition cancelled, stop waiting for TTL.')
+                return
 
-        imaging = True
+        self.log_msg('info', 'Acqusition seems to be terminated')
 
-        while imaging:
+        # Latency between trigger and finished
+        edges = list(self.edges)
+        latency = {'round': name_base,
+                   'latency_host': edges[-1]['t_host'] - t_start,
+                   'latency_device': None}
 
-            # Read from serial
-            txt_serial = self.config_TLL['TTL']['ser'].readline().decode('ascii').rstrip()
-            #self.log_msg('info', f'Serial received {txt_serial}')
+        edge_trig = [edge for edge in edges if edge['event'] == 'TRIG']
+        edge_fin = edges[-1]
+        if edge_trig and edge_fin['micros'] is not None:
 
-            if txt_serial == 'finished':
-                self.log_msg('info', 'Acqusition seems to be terminated')
-                imaging = False
+            # Device time wraps around after 2**32 us, use host time to unwrap
+            dt_device = (edge_fin['micros'] - edge_trig[-1]['micros']) % 2**32
+            dt_host = 1e6*(edge_fin['t_host'] - edge_trig[-1]['t_host'])
+            dt_device += round((dt_host - dt_device) / 2**32) * 2**32
+            latency['latency_device'] = dt_device / 1e6
 
-            time.sleep(0.5)
+        self.latencies.append(latency)
+        self.log_msg('info', f'TTL sync: trigger to finished {latency["latency_host"]:.3f} s (host), {latency["latency_device"]} s (device)')
 
     def close_serial_port(self):
         """_summary_
         """
+        self.stop_reader.set()
         if 'ser' in self.config_TLL['TTL'].keys():
                 ser = self.config_TLL['TTL']['ser']
                 if ser is not None:
                     if ser.isOpen() is True:
                         ser.close()
 
+        if self.reader is not None:
+            self.reader.join(timeout=2)
+
 
 # ------------------------------------------------------------------------------------------------
 # Control with sync file : existing file, 1 to start acquisition, 0 to signal acquisition is done
@@ -402,9 +929,6 @@ class fileSync_write(Microscope):
         # Involve the init function of the parent class
         super().__init__(**kargs)
 
-        # For threading
-        self.stop = Event()
-
         # Robot status flags
         self.status = {
         }
@@ -420,12 +944,17 @@ class fileSync_write(Microscope):
         self.name_sync_file = name_sync_file
         self.log_msg('info', f'Acquisition sync file initiated {name_sync_file}')
 
-    def acquire_images(self):
+    def acquire_images(self, dir_save=None, name_base='test'):
         """acquire_images _summary_
+
+        Args:
+            dir_save (str, optional): not used, data is saved by the acquisition software. Defaults to None.
+            name_base (str, optional): not used. Defaults to 'test'.
         """
         # Start acquisition by setting file content to 1
-        with open(self.name_sync_file, 'w') as f:
-            f.write('1')
+        with METRICS.span('sync_handoff', self._type()):
+            with open(self.name_sync_file, 'w') as f:
+                f.write('1')
 
         # Read status of sync file
         self.log_msg('info', 'Checking sync file for completion')
@@ -440,6 +969,10 @@ class fileSync_write(Microscope):
                 self.log_msg('info', 'Acqusition seems to be terminated')
                 imaging = False
 
+            elif self.stop.is_set():
+                self.log_msg('info', 'Acquisition cancelled, stop checking sync file.')
+                imaging = False
+
             time.sleep(0.5)
 
         syncfile.close()
@@ -458,9 +991,6 @@ class fileSync_create(Microscope):
 
         self.sync_file = None
 
-        # For threading
-        self.stop = Event()
-
         # Robot status flags
         self.status = {
         }
@@ -486,12 +1016,17 @@ class fileSync_create(Microscope):
 
         return sync_file
 
-    def acquire_images(self):
+    def acquire_images(self, dir_save=None, name_base='test'):
         """acquire_images _summary_
+
+        Args:
+            dir_save (str, optional): not used, data is saved by the acquisition software. Defaults to None.
+            name_base (str, optional): not used. Defaults to 'test'.
         """
 
-        with open(str(self.sync_file), 'w') as f:
-            f.write('Temporary file to intiate acquisition!')
+        with METRICS.span('sync_handoff', self._type()):
+            with open(str(self.sync_file), 'w') as f:
+                f.write('Temporary file to intiate acquisition!')
 
         # Check if file exists
         self.log_msg('info', 'Checking exisstance of sync file')
@@ -502,4 +1037,9 @@ class fileSync_create(Microscope):
             if not self.sync_file.exists():
                 self.log_msg('info', 'Acqusition seems to be terminated')
                 imaging = False
+
+            elif self.stop.is_set():
+                self.log_msg('info', 'Acquisition cancelled, stop checking sync file.')
+                imaging = False
+
             time.sleep(0.5)
@@ -0,0 +1,158 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import logging
+import queue
+import time
+from threading import Thread, Event
+
+
+# ---------------------------------------------------------------------------
+# Background jobs for the GUI
+# ---------------------------------------------------------------------------
+
+class job():
+    """ One operation (e.g. a fluidics round) running in a worker thread.
+    """
+
+    def __init__(self, name, fn, args=(), kwargs=None, stop=None):
+        """__init__ _summary_
+
+        Args:
+            name (str): name of the job, shown in the GUI.
+            fn (callable): function to run.
+            args (tuple, optional): arguments of fn. Defaults to ().
+            kwargs (dict, optional): keyword arguments of fn. Defaults to None.
+            stop (threading.Event, optional): event that fn checks for cooperative cancellation. Defaults to None.
+        """
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.stop = stop if stop is not None else Event()
+
+        self.status = 'pending'     # pending, running, done, failed, cancelled
+        self.result = None
+        self.exception = None
+        self.t_start = None
+        self.t_end = None
+        self.thread = None
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+class jobExecutor():
+    """ Runs robot and coordinator operations in worker threads.
+
+    Progress is reported by the workers with progress(). When a PySimpleGUI window is
+    provided, it is forwarded to the event loop with write_event_value, otherwise it is
+    put in a queue (see events()):
+        '-JOB_PROGRESS-' : dict with the progress information (e.g. step, remaining, volume).
+        '-JOB_DONE-'     : dict with name, status and duration of the finished job.
+
+    Cancellation is cooperative: cancel() sets the stop event of the job, which the
+    robot checks between steps and while pumping or pausing.
+    """
+
+    def __init__(self, window=None, logger=None):
+        """__init__ _summary_
+
+        Args:
+            window (PySimpleGUI.Window, optional): window receiving the events. Defaults to None.
+            logger (logging.Logger, optional): logger. Defaults to None.
+        """
+        if isinstance(logger, type(None)):
+            self.logger = logging.getLogger('AUTOMATOR-Jobs')
+            self.logger.setLevel(100)
+        else:
+            self.logger = logger
+
+        self.window = window
+        self.queue = queue.Queue()
+        self.jobs = []      # running jobs, finished jobs are removed by submit() and running()
+
+    def submit(self, name, fn, *args, stop=None, **kwargs):
+        """ Run function in a worker thread.
+
+        Args:
+            name (str): name of the job.
+            fn (callable): function to run.
+            stop (threading.Event, optional): event that fn checks for cancellation, cleared before start. Defaults to None.
+
+        Returns:
+            job: the submitted job.
+        """
+        job_new = job(name, fn, args=args, kwargs=kwargs, stop=stop)
+        job_new.stop.clear()
+        job_new.thread = Thread(target=self._run, args=(job_new,), daemon=True)
+        self.running()
+        self.jobs.append(job_new)
+        job_new.thread.start()
+        return job_new
+
+    def _run(self, job_run):
+        job_run.status = 'running'
+        job_run.t_start = time.time()
+        self.progress(job=job_run.name, status='running')
+        try:
+            job_run.result = job_run.fn(*job_run.args, **job_run.kwargs)
+            job_run.status = 'cancelled' if job_run.stop.is_set() else 'done'
+
+        # The robot raises SystemExit when stopped or when a step can not be executed
+        except SystemExit:
+            job_run.status = 'cancelled' if job_run.stop.is_set() else 'failed'
+
+        except Exception as e:
+            job_run.status = 'failed'
+            job_run.exception = e
+            self.logger.error(f'Job {job_run.name} failed: {e}')
+
+        job_run.t_end = time.time()
+        info = {'job': job_run.name,
+                'status': job_run.status,
+                'duration': round(job_run.t_end - job_run.t_start, 1)}
+        self._emit('-JOB_DONE-', info)
+
+    def progress(self, **info):
+        """ Report progress of a running job. Can be used as progress callback of the robot.
+        """
+        self._emit('-JOB_PROGRESS-', info)
+
+    def _emit(self, event, info):
+        if self.window is not None:
+            self.window.write_event_value(event, info)
+        else:
+            self.queue.put((event, info))
+
+    def events(self):
+        """ Get all reported events (for use without a window).
+
+        Returns:
+            list: of tuples (event, info).
+        """
+        events = []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def running(self):
+        """ Returns the running jobs (finished jobs are dropped).
+        """
+        self.jobs = [job_run for job_run in self.jobs if job_run.t_end is None]
+        return [job_run for job_run in self.jobs if job_run.is_alive()]
+
+    def busy(self):
+        """ Returns True if a job is running.
+        """
+        return len(self.running()) > 0
+
+    def cancel(self):
+        """ Ask all running jobs to stop.
+        """
+        for job_run in self.running():
+            self.logger.info(f'Cancelling job {job_run.name}')
+            job_run.stop.set()
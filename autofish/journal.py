@@ -0,0 +1,168 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import json
+import logging
+import os
+import time
+from threading import Lock
+
+
+# ---------------------------------------------------------------------------
+# Journal of a run
+# ---------------------------------------------------------------------------
+
+class runJournal():
+    """ Append-only journal of a run, one JSON object per line.
+
+    Every entry is flushed and fsync'd before the call returns, so the journal
+    survives a crash of Python or of the PC. Entries have a 'type':
+        run_start        : config files of the run
+        run_settings     : settings of the run, e.g. folder to save images (dir_save)
+        resume           : run was resumed from this journal
+        round_start      : round started
+        step_start       : step started (round, step id, action, param)
+        step_done        : step finished (round, step id, action, param, current buffer)
+        round_done       : all steps of a round finished (and if images should be acquired)
+        acquisition_done : images of a round acquired
+        qc               : result of the image QC of a round (requeued: round has to be run again)
+
+    Step ids are the index of the step in the sequence, for conditional steps the
+    index in the conditional block is appended (e.g. '8.2').
+    """
+
+    def __init__(self, file_journal, logger=None):
+        """__init__ _summary_
+
+        Args:
+            file_journal (str): journal file, new entries are appended.
+            logger (logging.Logger, optional): logger. Defaults to None.
+        """
+        if isinstance(logger, type(None)):
+            self.logger = logging.getLogger('AUTOMATOR-Journal')
+            self.logger.setLevel(100)
+        else:
+            self.logger = logger
+
+        self.file_journal = str(file_journal)
+        self.lock = Lock()
+        self.file = open(self.file_journal, 'a', encoding='utf-8')
+        self.logger.info(f'Journal of run: {self.file_journal}')
+
+    def write(self, entry_type, **data):
+        """ Append entry and wait until it is on disk.
+
+        Args:
+            entry_type (str): type of entry.
+            data: content of entry (json serializable).
+        """
+        entry = {'time': time.time(), 'type': entry_type, **data}
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_journal(file_journal):
+    """ Read all entries of a journal. An incomplete last line (crash during write) is ignored.
+
+    Args:
+        file_journal (str): journal file.
+
+    Returns:
+        list: entries.
+    """
+    entries = []
+    with open(file_journal, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return entries
+
+
+def journal_state(entries, now=None):
+    """ State of a run reconstructed from the entries of its journal.
+
+    Args:
+        entries (list): journal entries.
+        now (float, optional): current time (time.time()), used for remaining pause times. Defaults to None.
+
+    Returns:
+        dict: with keys
+            config_file_system, config_file_experiment, dir_save : from run_start
+            rounds_done         : rounds where all steps are done
+            rounds_acquired     : rounds where images were acquired
+            acquisition_pending : rounds done, where images still have to be acquired
+            round_current       : round that was interrupted (None if between rounds)
+            steps_done          : ids of steps of the interrupted round that are done
+            pause_remaining     : remaining pause time (s) of interrupted pause steps
+            buffer              : last selected buffer
+    """
+    if now is None:
+        now = time.time()
+
+    state = {'config_file_system': None,
+             'config_file_experiment': None,
+             'dir_save': None,
+             'rounds_done': [],
+             'rounds_acquired': [],
+             'acquisition_pending': [],
+             'round_current': None,
+             'steps_done': [],
+             'pause_remaining': {},
+             'buffer': None}
+
+    steps_started = {}
+
+    for entry in entries:
+        entry_type = entry['type']
+
+        if entry_type in ('run_start', 'run_settings'):
+            for key in ('config_file_system', 'config_file_experiment', 'dir_save'):
+                if key in entry:
+                    state[key] = entry[key]
+
+        elif entry_type == 'round_start':
+            state['round_current'] = entry['round']
+            state['steps_done'] = []
+            steps_started = {}
+
+        elif entry_type == 'step_start':
+            steps_started[entry['step']] = entry
+
+        elif entry_type == 'step_done':
+            state['steps_done'].append(entry['step'])
+            steps_started.pop(entry['step'], None)
+            state['buffer'] = entry.get('buffer', state['buffer'])
+
+        elif entry_type == 'round_done':
+            state['rounds_done'].append(entry['round'])
+            if entry.get('launch_acquisition', True):
+                state['acquisition_pending'].append(entry['round'])
+            state['round_current'] = None
+            state['steps_done'] = []
+            steps_started = {}
+
+        elif entry_type == 'acquisition_done':
+            state['rounds_acquired'].append(entry['round'])
+            if entry['round'] in state['acquisition_pending']:
+                state['acquisition_pending'].remove(entry['round'])
+
+        elif entry_type == 'qc' and entry.get('requeued'):
+            for key in ('rounds_done', 'rounds_acquired'):
+                if entry['round'] in state[key]:
+                    state[key].remove(entry['round'])
+
+    # Interrupted pauses: only the remaining time has to be waited
+    for step_id, entry in steps_started.items():
+        if entry['action'] == 'pause':
+            state['pause_remaining'][step_id] = max(0, float(entry['param']) - (now - entry['time']))
+
+    return state
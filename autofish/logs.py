@@ -0,0 +1,186 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import copy
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+from datetime import datetime
+
+
+# Structured fields that can be attached to log records (with extra=...)
+LOG_FIELDS = ('round', 'step', 'device', 'duration')
+
+
+# ---------------------------------------------------------------------------
+# Logging for Robot, Controller and Microscope
+# ---------------------------------------------------------------------------
+
+class logMixin():
+    """ Logging shared by Robot, Controller and Microscope.
+
+    Messages are logged to a detailed logger and a short logger (e.g. a log file
+    and the console). Structured fields (round, step, device, duration) can be passed
+    as keyword arguments, or set for all following messages in self.log_fields.
+    Arguments in args are merged lazily, i.e. only when the message is written.
+    """
+
+    def setup_loggers(self, logger=None, logger_short=None, name='AUTOMATOR-Robot', name_short='AUTOMATOR-Robot'):
+        """ Use provided loggers, or silent default loggers.
+
+        Args:
+            logger (logging.Logger, optional): detailed logger. Defaults to None.
+            logger_short (logging.Logger, optional): short logger. Defaults to None.
+            name (str, optional): name of default detailed logger. Defaults to 'AUTOMATOR-Robot'.
+            name_short (str, optional): name of default short logger. Defaults to 'AUTOMATOR-Robot'.
+        """
+        if isinstance(logger, type(None)):
+            self.logger = logging.getLogger(name)  # Logs the name of the function
+            self.logger.setLevel(100)
+        else:
+            self.logger = logger
+
+        if isinstance(logger_short, type(None)):
+            self.logger_short = logging.getLogger(name_short)  # Logs the name of the function
+            self.logger_short.setLevel(100)
+        else:
+            self.logger_short = logger_short
+
+        self.log_fields = {}
+
+    # Function to handle both logging calls and different logging types
+    def log_msg(self, type, msg, *args, msg_short='', **fields):
+        """ Log message to both loggers.
+
+        Args:
+            type (str): 'info', 'warning' or 'error'.
+            msg (str): message, can contain %-placeholders for args.
+            msg_short (str, optional): message for short logger, if different. Defaults to ''.
+            fields: structured fields (round, step, device, duration).
+        """
+        level = {'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR}.get(type)
+        if level is None:
+            return
+
+        extra = {**self.log_fields, **fields}
+        self.logger.log(level, msg, *args, extra=extra)
+        if msg_short:
+            self.logger_short.log(level, msg_short, extra=extra)
+        else:
+            self.logger_short.log(level, msg, *args, extra=extra)
+
+
+def device_logger(logger, device):
+    """ Logger for a hardware component, adds the device name to all records.
+
+    Args:
+        logger (logging.Logger): logger.
+        device (str): device name, e.g. 'pump'.
+
+    Returns:
+        logging.LoggerAdapter: logger adding the field device.
+    """
+    return logging.LoggerAdapter(logger, {'device': device})
+
+
+# ---------------------------------------------------------------------------
+# Non-blocking logging pipeline
+# ---------------------------------------------------------------------------
+
+class jsonFormatter(logging.Formatter):
+    """ Formats log records as one JSON object per line, including structured fields.
+    """
+
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                 'logger': record.name,
+                 'level': record.levelname,
+                 'message': record.getMessage()}
+
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+
+class deferredQueueHandler(logging.handlers.QueueHandler):
+    """ Queue handler that does not format the record in the calling thread.
+    Only the message is merged with its args (which can be changed by the caller once
+    the record is queued), formatting is done by the handlers of the listener thread.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _gzip_namer(name):
+    return name + '.gz'
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def setup_logging(file_log, name='Automator-GUI', name_short='Automator-GUI-STREAM',
+                  max_bytes=10*1024**2, backup_count=20, json_format=True):
+    """ Create a detailed (file) and short (console) logger. Both only put records in a
+    queue, which is emptied by a listener thread writing to disk and console. Log files are
+    rotated and compressed when they reach max_bytes.
+
+    Args:
+        file_log (str): log file.
+        name (str, optional): name of detailed logger. Defaults to 'Automator-GUI'.
+        name_short (str, optional): name of short logger. Defaults to 'Automator-GUI-STREAM'.
+        max_bytes (int, optional): size of log file before rotation. Defaults to 10 MB.
+        backup_count (int, optional): number of compressed log files to keep. Defaults to 20.
+        json_format (bool, optional): write log file as JSON lines. Defaults to True.
+
+    Returns:
+        tuple: detailed logger, short logger, and listener (call listener.stop() at the end).
+    """
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
+
+    handler_file = logging.handlers.RotatingFileHandler(file_log, 'a', maxBytes=max_bytes, backupCount=backup_count)
+    handler_file.namer = _gzip_namer
+    handler_file.rotator = _gzip_rotator
+    handler_file.setFormatter(jsonFormatter() if json_format else formatter)
+    handler_file.addFilter(logging.Filter(name))
+
+    handler_stream = logging.StreamHandler()
+    handler_stream.setFormatter(formatter)
+    handler_stream.addFilter(logging.Filter(name_short))
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler_file, handler_stream, respect_handler_level=True)
+    listener.start()
+
+    loggers = []
+    for logger_name in (name, name_short):
+        logger = logging.getLogger(logger_name)
+        logger.setLevel(logging.DEBUG)
+        logger.handlers.clear()
+        logger.addHandler(deferredQueueHandler(log_queue))
+        logger.propagate = False
+        loggers.append(logger)
+
+    return loggers[0], loggers[1], listener
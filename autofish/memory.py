@@ -0,0 +1,261 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import csv
+import ctypes
+import gc
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+from autofish.metrics import METRICS
+
+
+# ---------------------------------------------------------------------------
+# Memory of the process
+# ---------------------------------------------------------------------------
+
+def rss_bytes():
+    """ Resident set size (RSS) of this process in bytes, None if it can not be measured.
+    Uses psutil when installed, otherwise the operating system directly.
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        if sys.platform.startswith('linux'):
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+        if sys.platform == 'win32':
+            from ctypes import wintypes
+
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                            ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                            ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                            ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                            ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            process = ctypes.windll.kernel32.GetCurrentProcess()
+            if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+                return counters.WorkingSetSize
+            return None
+
+        import resource  # peak RSS only (e.g. macOS: bytes, others: kB)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+    except Exception:
+        return None
+
+
+def _release_heap():
+    """ Return freed heap memory to the operating system (glibc only).
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            ctypes.CDLL('libc.so.6').malloc_trim(0)
+        except Exception:
+            pass
+
+
+# ---------------------------------------------------------------------------
+# Monitoring
+# ---------------------------------------------------------------------------
+
+class memoryMonitor():
+    """ Samples the memory of the process (RSS, and the Python heap when tracemalloc is tracing) around
+    rounds and acquisitions.
+
+    Samples are written to the log, to the metrics (gauges memory_rss_mb, memory_heap_mb), and to a CSV
+    file, so that trends stay visible for long runs. The trend (MB per hour) is fitted over the last
+    samples. When the RSS is above the ceiling, a cleanup is run (garbage collection, returning freed
+    memory to the operating system) or only a warning is logged.
+
+    Settings in the experiment config:
+        memory:
+            ceiling: 8000          # MB of RSS
+            action: 'cleanup'      # or 'warn'
+            tracemalloc: 1         # trace Python allocations (number of frames), 0: off
+            file: 'memory.csv'     # in the folder to save data
+    """
+
+    COLUMNS = ['Time', 'label', 'round', 'phase', 'rss_mb', 'heap_mb', 'gc_gen0', 'gc_gen1', 'gc_gen2']
+
+    def __init__(self, ceiling=None, action='cleanup', tracemalloc_frames=0, file_csv=None, n_keep=5000, logger=None):
+        """__init__ _summary_
+
+        Args:
+            ceiling (float, optional): RSS in MB above which the action is triggered. Defaults to None (no ceiling).
+            action (str, optional): 'cleanup' or 'warn'. Defaults to 'cleanup'.
+            tracemalloc_frames (int, optional): trace Python allocations with this number of frames. Defaults to 0 (off).
+            file_csv (str, optional): CSV file, samples are appended. Defaults to None.
+            n_keep (int, optional): number of samples kept for the trend. Defaults to 5000.
+            logger (logging.Logger, optional): logger. Defaults to None.
+        """
+        self.lock = Lock()
+        self.samples = deque(maxlen=n_keep)
+        self.snapshot_last = None
+        self.configure(ceiling, action, tracemalloc_frames, file_csv, logger)
+
+    def configure(self, ceiling=None, action='cleanup', tracemalloc_frames=0, file_csv=None, logger=None):
+        """ Change the settings (see __init__).
+        """
+        if action not in ('cleanup', 'warn'):
+            raise ValueError(f'Memory action has to be "cleanup" or "warn", not {action}')
+
+        if isinstance(logger, type(None)):
+            self.logger = logging.getLogger('AUTOMATOR-Memory')
+            self.logger.setLevel(100)
+        else:
+            self.logger = logger
+
+        self.ceiling = ceiling
+        self.action = action
+        self.file_csv = str(file_csv) if file_csv else None
+        if tracemalloc_frames and not tracemalloc.is_tracing():
+            tracemalloc.start(tracemalloc_frames)
+
+    def configure_from(self, config, dir_save=None, logger=None):
+        """ Settings from the 'memory' entry of the experiment config, the CSV file is in the folder to save data.
+        """
+        config = config or {}
+        file_csv = None
+        if dir_save is not None and os.path.isdir(dir_save):
+            file_csv = os.path.join(dir_save, config.get('file', 'memory.csv'))
+        self.configure(ceiling=config.get('ceiling'), action=config.get('action', 'cleanup'),
+                       tracemalloc_frames=config.get('tracemalloc', 0), file_csv=file_csv, logger=logger)
+
+    # >>> Sampling
+    def sample(self, label='', round_id=None, phase=''):
+        """ Measure the memory now.
+
+        Returns:
+            dict: sample with rss_mb and heap_mb (None if not measured).
+        """
+        rss = rss_bytes()
+        sample = {'Time': round(time.time(), 3),
+                  'label': label,
+                  'round': round_id,
+                  'phase': phase,
+                  'rss_mb': round(rss / 2**20, 1) if rss is not None else None,
+                  'heap_mb': round(tracemalloc.get_traced_memory()[0] / 2**20, 1) if tracemalloc.is_tracing() else None}
+        sample.update(zip(('gc_gen0', 'gc_gen1', 'gc_gen2'), gc.get_count()))
+
+        with self.lock:
+            self.samples.append(sample)
+            if self.file_csv is not None:
+                self._write(sample)
+
+        if sample['rss_mb'] is not None:
+            METRICS.set_gauge('memory_rss_mb', sample['rss_mb'])
+        if sample['heap_mb'] is not None:
+            METRICS.set_gauge('memory_heap_mb', sample['heap_mb'])
+        return sample
+
+    def recent(self, n=100):
+        """ Last n samples (copies).
+        """
+        with self.lock:
+            return [dict(sample) for sample in list(self.samples)[-n:]]
+
+    def _write(self, sample):
+        new_file = not os.path.isfile(self.file_csv) or os.path.getsize(self.file_csv) == 0
+        with open(self.file_csv, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=self.COLUMNS)
+            if new_file:
+                writer.writeheader()
+            writer.writerow(sample)
+
+    @contextmanager
+    def span(self, label, round_id=None):
+        """ Sample before and after the enclosed block (e.g. a round), log the difference and check the ceiling.
+        """
+        start = self.sample(label, round_id, 'start')
+        try:
+            yield
+        finally:
+            end = self.sample(label, round_id, 'end')
+            if end['rss_mb'] is not None and start['rss_mb'] is not None:
+                heap = f', heap {end["heap_mb"]:.0f} MB' if end['heap_mb'] is not None else ''
+                trend = self.trend()
+                trend = f', trend {trend:+.1f} MB/h' if trend is not None else ''
+                self.logger.info(f'Memory after {label} {round_id or ""}: RSS {end["rss_mb"]:.0f} MB '
+                                 f'({end["rss_mb"] - start["rss_mb"]:+.0f} MB){heap}{trend}')
+            self.check(end)
+
+    def trend(self, min_hours=0.1):
+        """ Slope of the RSS (MB per hour) fitted over the kept samples, None if they cover less than min_hours.
+        """
+        with self.lock:
+            points = [(s['Time'] / 3600, s['rss_mb']) for s in self.samples if s['rss_mb'] is not None]
+        if len(points) < 2 or points[-1][0] - points[0][0] < min_hours:
+            return None
+
+        n = len(points)
+        t_mean = sum(t for t, _ in points) / n
+        m_mean = sum(m for _, m in points) / n
+        var = sum((t - t_mean)**2 for t, _ in points)
+        return sum((t - t_mean) * (m - m_mean) for t, m in points) / var
+
+    # >>> Ceiling
+    def check(self, sample=None):
+        """ Run the action if the RSS is above the ceiling.
+
+        Returns:
+            bool: True if the RSS is below the ceiling (after the cleanup).
+        """
+        sample = sample or self.sample('check')
+        if self.ceiling is None or sample['rss_mb'] is None or sample['rss_mb'] <= self.ceiling:
+            return True
+
+        METRICS.increment('memory_ceiling_reached')
+        if self.action == 'cleanup':
+            self.cleanup()
+            sample = self.sample('cleanup', sample['round'])
+            if sample['rss_mb'] <= self.ceiling:
+                self.logger.info(f'Memory after cleanup: RSS {sample["rss_mb"]:.0f} MB.')
+                return True
+
+        self.logger.warning(f'Memory above ceiling: RSS {sample["rss_mb"]:.0f} MB > {self.ceiling} MB.')
+        return False
+
+    def cleanup(self):
+        gc.collect()
+        _release_heap()
+
+    # >>> Python heap
+    def snapshot(self, top=10):
+        """ Largest Python allocations (by source line), and the growth since the previous snapshot.
+        Only available when tracemalloc is tracing (setting tracemalloc), tracing slows down the process.
+
+        Returns:
+            list: lines (str).
+        """
+        if not tracemalloc.is_tracing():
+            return ['Python heap: not traced (set tracemalloc in the memory settings)']
+
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        lines = [f'Python heap: {tracemalloc.get_traced_memory()[0] / 2**20:.1f} MB traced']
+        lines += [f'  {stat}' for stat in snapshot.statistics('lineno')[:top]]
+        if self.snapshot_last is not None:
+            lines.append('Growth since previous snapshot:')
+            lines += [f'  {stat}' for stat in snapshot.compare_to(self.snapshot_last, 'lineno')[:top]]
+        self.snapshot_last = snapshot
+        return lines
+
+
+# Monitor used by all components
+MEMORY = memoryMonitor()
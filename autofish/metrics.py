@@ -0,0 +1,203 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock, Thread, Event
+
+
+# ---------------------------------------------------------------------------
+# Timing of steps
+# ---------------------------------------------------------------------------
+
+class metricsRegistry():
+    """ In-process counters, gauges and duration histograms per step type and device.
+
+    Durations are recorded with span() (context manager) or observe(). For each
+    (step, device) the last n_keep durations are kept to compute p50 and p95, the
+    count, sum and maximum cover all observations.
+    """
+
+    def __init__(self, n_keep=1000):
+        """__init__ _summary_
+
+        Args:
+            n_keep (int, optional): number of durations kept for percentiles. Defaults to 1000.
+        """
+        self.n_keep = n_keep
+        self.lock = Lock()
+        self.durations = {}
+        self.counters = {}
+        self.gauges = {}
+
+    @contextmanager
+    def span(self, step, device='robot'):
+        """ Measure duration of the enclosed block.
+
+        Args:
+            step (str): step type, e.g. 'pump_run'.
+            device (str, optional): device, e.g. 'valve_in'. Defaults to 'robot'.
+        """
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(step, device, time.perf_counter() - t_start)
+
+    def observe(self, step, device, duration):
+        """ Record a duration in seconds.
+        """
+        key = (step, device)
+        with self.lock:
+            if key not in self.durations:
+                self.durations[key] = {'recent': deque(maxlen=self.n_keep), 'count': 0, 'sum': 0.0, 'max': 0.0}
+            hist = self.durations[key]
+            hist['recent'].append(duration)
+            hist['count'] += 1
+            hist['sum'] += duration
+            hist['max'] = max(hist['max'], duration)
+
+    def increment(self, name, value=1):
+        """ Increment a counter.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        """ Set a value that can go up and down, e.g. memory usage.
+        """
+        with self.lock:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        """ Current state of all metrics.
+
+        Returns:
+            dict: 'durations' with (step, device) as key, 'counters' and 'gauges'.
+        """
+        with self.lock:
+            durations = {}
+            for key, hist in self.durations.items():
+                recent = sorted(hist['recent'])
+                durations[key] = {'count': hist['count'],
+                                  'sum': hist['sum'],
+                                  'p50': _percentile(recent, 0.5),
+                                  'p95': _percentile(recent, 0.95),
+                                  'max': hist['max'],
+                                  'last': hist['recent'][-1]}
+            return {'durations': durations, 'counters': dict(self.counters), 'gauges': dict(self.gauges)}
+
+    def format_snapshot(self):
+        """ Snapshot as text table, e.g. for the GUI.
+        """
+        snapshot = self.snapshot()
+        lines = [f'{"step":<18}{"device":<16}{"n":>6}{"p50 [s]":>10}{"p95 [s]":>10}{"max [s]":>10}{"last [s]":>10}']
+        for (step, device), hist in sorted(snapshot['durations'].items()):
+            lines.append(f'{step:<18}{device:<16}{hist["count"]:>6}{hist["p50"]:>10.2f}{hist["p95"]:>10.2f}'
+                         f'{hist["max"]:>10.2f}{hist["last"]:>10.2f}')
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'{name}: {value}')
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append(f'{name}: {value:.1f}')
+        return '\n'.join(lines)
+
+    def to_prometheus(self):
+        """ Metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = ['# HELP autofish_step_duration_seconds Duration of fluidics and imaging steps.',
+                 '# TYPE autofish_step_duration_seconds summary']
+        for (step, device), hist in sorted(snapshot['durations'].items()):
+            labels = f'step="{step}",device="{device}"'
+            lines.append(f'autofish_step_duration_seconds{{{labels},quantile="0.5"}} {hist["p50"]:.6f}')
+            lines.append(f'autofish_step_duration_seconds{{{labels},quantile="0.95"}} {hist["p95"]:.6f}')
+            lines.append(f'autofish_step_duration_seconds_sum{{{labels}}} {hist["sum"]:.6f}')
+            lines.append(f'autofish_step_duration_seconds_count{{{labels}}} {hist["count"]}')
+
+        lines.append('# HELP autofish_step_duration_seconds_max Maximum duration of fluidics and imaging steps.')
+        lines.append('# TYPE autofish_step_duration_seconds_max gauge')
+        for (step, device), hist in sorted(snapshot['durations'].items()):
+            lines.append(f'autofish_step_duration_seconds_max{{step="{step}",device="{device}"}} {hist["max"]:.6f}')
+
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'# TYPE autofish_{name}_total counter')
+            lines.append(f'autofish_{name}_total {value}')
+
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append(f'# TYPE autofish_{name} gauge')
+            lines.append(f'autofish_{name} {value:.6f}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, file_prom):
+        """ Write metrics to a Prometheus text file. The file is replaced atomically,
+        so a reader (e.g. node exporter) never sees a partial file.
+
+        Args:
+            file_prom (str): file name, should end with .prom
+        """
+        file_tmp = Path(str(file_prom) + '.tmp')
+        with open(file_tmp, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(file_tmp, file_prom)
+
+
+def _percentile(values_sorted, q):
+    """ Percentile (nearest rank) of sorted values.
+    """
+    if not values_sorted:
+        return 0.0
+    return values_sorted[min(len(values_sorted) - 1, int(q * len(values_sorted)))]
+
+
+class prometheusWriter():
+    """ Writes the metrics periodically to a Prometheus text file (in a background thread).
+    """
+
+    def __init__(self, registry, file_prom, interval=15, logger=None):
+        """__init__ _summary_
+
+        Args:
+            registry (metricsRegistry): metrics to write.
+            file_prom (str): file name, should end with .prom
+            interval (float, optional): time between writes in seconds. Defaults to 15.
+            logger (logging.Logger, optional): logger. Defaults to None.
+        """
+        if isinstance(logger, type(None)):
+            self.logger = logging.getLogger('AUTOMATOR-Metrics')
+            self.logger.setLevel(100)
+        else:
+            self.logger = logger
+
+        self.registry = registry
+        self.file_prom = file_prom
+        self.interval = interval
+        self.stop = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            # A failed write (e.g. disk full, file locked) is retried at the next interval
+            try:
+                self.registry.write_prometheus(self.file_prom)
+            except Exception as e:
+                self.logger.error(f'Could not write metrics to {self.file_prom}: {e}')
+
+    def close(self):
+        """ Stop thread and write metrics a last time.
+        """
+        self.stop.set()
+        self.registry.write_prometheus(self.file_prom)
+
+
+# Registry used by all components
+METRICS = metricsRegistry()
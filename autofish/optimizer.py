@@ -0,0 +1,365 @@
+'''
+Optimization of the fluidics sequence of a round.
+
+The sequence of the experiment config is compiled into a flat plan for each round: conditional
+blocks of the round are inlined (instead of the recursion of Robot.run_single_round), and each step
+keeps its step id of the sequence (e.g. '8.2'), so the journal and resuming a run work as before.
+
+Passes over the plan:
+    merge_pauses      : adjacent pauses become one pause.
+    drop_redundant    : buffer selections of the current buffer and moves of the outlet valve to its
+                        current port are removed.
+    hoist_moves       : a selection of a round-invariant buffer (without 'ii') that directly follows a
+                        pause is done at the start of the pause ({'pause': 180, 'select': 'wash'}), the
+                        move then overlaps with the pause instead of being on the critical path.
+
+The optimized plan is compared against the original plan with an abstract execution (verify):
+the same buffers have to be pumped in the same order with the same durations, outlet valve
+positions and pauses between them.
+
+    python -m autofish.optimizer experiment_config.yaml r1 r5
+'''
+
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import difflib
+import logging
+
+
+# ---------------------------------------------------------------------------
+# Plan of a round
+# ---------------------------------------------------------------------------
+
+def step_action(step):
+    return list(step.keys())[0]
+
+
+def step_param(step):
+    return list(step.values())[0]
+
+
+def resolve_buffer(buffer, round_id):
+    """ Buffer name for a round ('ii' is replaced by the round id).
+    """
+    return buffer.replace('ii', round_id) if 'ii' in buffer else buffer
+
+
+def flatten(sequence, round_id, prefix=''):
+    """ Steps of a round, with the conditional blocks of the round inlined.
+
+    Args:
+        sequence (list): sequence of the experiment config.
+        round_id (str): round id.
+        prefix (str, optional): prefix of step ids. Defaults to ''.
+
+    Returns:
+        list: plan, list of (step_id, step).
+    """
+    plan = []
+    for i_step, step in enumerate(sequence):
+        step_id = f'{prefix}{i_step}'
+
+        if isinstance(step, list):
+            if step_action(step[0]) == 'round' and round_id in str(step_param(step[0])).split(','):
+                plan += flatten(step, round_id, prefix=f'{step_id}.')
+
+        elif step_action(step) != 'round':
+            plan.append((step_id, dict(step)))
+
+    return plan
+
+
+def format_plan(plan):
+    """ One line per step, e.g. '8.2    pause: 180 (select wash_v4)'.
+    """
+    lines = []
+    for step_id, step in plan:
+        line = f'{step_id:<8}{step_action(step)}: {step_param(step)}'
+        if 'select' in step:
+            line += f' (select {step["select"]})'
+        lines.append(line)
+    return lines
+
+
+# ---------------------------------------------------------------------------
+# Optimization passes
+# ---------------------------------------------------------------------------
+
+def merge_pauses(plan):
+    """ Merge adjacent pauses (the step id of the first pause is kept).
+
+    Returns:
+        tuple: (plan, notes)
+    """
+    plan_new, notes = [], []
+    for step_id, step in plan:
+        if plan_new and step_action(step) == 'pause' and 'select' not in step:
+            id_last, step_last = plan_new[-1]
+            if step_action(step_last) == 'pause' and 'select' not in step_last:
+                plan_new[-1] = (id_last, {'pause': step_param(step_last) + step_param(step)})
+                notes.append(f'merged pause {step_id} into pause {id_last}')
+                continue
+        plan_new.append((step_id, dict(step)))
+    return plan_new, notes
+
+
+def drop_redundant(plan, round_id, valve_out_positions=None):
+    """ Remove selections of the current buffer and moves of the outlet valve to its current port.
+    The state is unknown at the start of the round, and after 'wait' (operator) and 'zero_plate'.
+
+    Args:
+        plan (list): plan of the round.
+        round_id (str): round id.
+        valve_out_positions (list, optional): positions of the outlet valve (pump_valve_out). Defaults to None.
+
+    Returns:
+        tuple: (plan, notes)
+    """
+    plan_new, notes = [], []
+    buffer, valve_out = None, None
+
+    for step_id, step in plan:
+        action, param = step_action(step), step_param(step)
+
+        if action == 'buffer':
+            buffer_round = resolve_buffer(param, round_id)
+            if buffer_round == buffer:
+                notes.append(f'dropped buffer {step_id} ({buffer_round} already selected)')
+                continue
+            buffer = buffer_round
+
+        elif action == 'pause' and 'select' in step:
+            buffer_round = resolve_buffer(step['select'], round_id)
+            if buffer_round == buffer:
+                notes.append(f'dropped selection in pause {step_id} ({buffer_round} already selected)')
+                step = {'pause': param}
+            buffer = buffer_round
+
+        elif action == 'valve_out':
+            if param == valve_out:
+                notes.append(f'dropped valve_out {step_id} (already at {param})')
+                continue
+            valve_out = param
+
+        elif action == 'pump_valve_out':
+            valve_out = valve_out_positions[-1] if valve_out_positions else None
+
+        elif action in ('wait', 'zero_plate'):
+            buffer, valve_out = None, None
+
+        plan_new.append((step_id, dict(step)))
+
+    return plan_new, notes
+
+
+def hoist_moves(plan):
+    """ Selections of round-invariant buffers (without 'ii') that directly follow a pause are done at the
+    start of the pause.
+
+    Returns:
+        tuple: (plan, notes)
+    """
+    plan_new, notes = [], []
+    for step_id, step in plan:
+        if plan_new and step_action(step) == 'buffer' and 'ii' not in step_param(step):
+            id_last, step_last = plan_new[-1]
+            if step_action(step_last) == 'pause' and 'select' not in step_last:
+                plan_new[-1] = (id_last, {'pause': step_param(step_last), 'select': step_param(step)})
+                notes.append(f'hoisted buffer {step_id} ({step_param(step)}) into pause {id_last}')
+                continue
+        plan_new.append((step_id, dict(step)))
+    return plan_new, notes
+
+
+# ---------------------------------------------------------------------------
+# Verification and critical path
+# ---------------------------------------------------------------------------
+
+def simulate(plan, round_id, valve_out_positions=None):
+    """ Abstract execution of a plan: the fluidic events (pumping with buffer and outlet valve, operator,
+    zeroing of the plate) with the pause time before each event, and the imaging flag.
+
+    Returns:
+        tuple: (list of events, launch_acquisition)
+    """
+    events = []
+    buffer, valve_out, paused, launch_acquisition = None, None, 0, True
+
+    for _, step in plan:
+        action, param = step_action(step), step_param(step)
+
+        if action == 'buffer':
+            buffer = resolve_buffer(param, round_id)
+        elif action == 'pause':
+            paused += param
+            if 'select' in step:
+                buffer = resolve_buffer(step['select'], round_id)
+        elif action == 'valve_out':
+            valve_out = param
+        elif action == 'pump':
+            events.append(('pump', buffer, valve_out, param, paused))
+            paused = 0
+        elif action == 'pump_valve_out':
+            for v_pos, v_t in zip(valve_out_positions or [], param):
+                events.append(('pump', buffer, v_pos, v_t, paused))
+                paused = 0
+            valve_out = valve_out_positions[-1] if valve_out_positions else None
+        elif action in ('wait', 'zero_plate'):
+            events.append((action, paused))
+            buffer, valve_out, paused = None, None, 0
+        elif action == 'image':
+            launch_acquisition = param == 1
+
+    events.append(('end', buffer, valve_out, paused))
+    return events, launch_acquisition
+
+
+def verify(plan, plan_opt, round_id, valve_out_positions=None):
+    """ Check that the optimized plan has the same effect as the original plan.
+
+    Returns:
+        list: differences (str), empty if the plans are equivalent.
+    """
+    events, launch = simulate(plan, round_id, valve_out_positions)
+    events_opt, launch_opt = simulate(plan_opt, round_id, valve_out_positions)
+
+    differences = [f'event {i}: {event} != {event_opt}'
+                   for i, (event, event_opt) in enumerate(zip(events, events_opt)) if event != event_opt]
+    if len(events) != len(events_opt):
+        differences.append(f'number of events: {len(events)} != {len(events_opt)}')
+    if launch != launch_opt:
+        differences.append(f'launch_acquisition: {launch} != {launch_opt}')
+    return differences
+
+
+def critical_path(plan, move_time=10, valve_time=2):
+    """ Estimated duration of a plan. Steps run one after the other, except moves selected at the start
+    of a pause, which overlap with the pause.
+
+    Args:
+        plan (list): plan of the round.
+        move_time (float, optional): estimated duration (s) of a buffer selection. Defaults to 10.
+        valve_time (float, optional): estimated duration (s) of a move of the outlet valve. Defaults to 2.
+
+    Returns:
+        dict: total duration, and durations of pumping, pauses and moves on the critical path (s).
+    """
+    path = {'pump': 0, 'pause': 0, 'moves': 0}
+    for _, step in plan:
+        action, param = step_action(step), step_param(step)
+        if action == 'pump':
+            path['pump'] += param + 1  # Robot waits 1 s after pumping
+        elif action == 'pump_valve_out':
+            path['pump'] += sum(param)
+            path['moves'] += valve_time * len(param)
+        elif action == 'pause':
+            path['pause'] += param
+            if 'select' in step:
+                path['moves'] += max(move_time - param, 0)
+        elif action in ('buffer', 'zero_plate'):
+            path['moves'] += move_time
+        elif action == 'valve_out':
+            path['moves'] += valve_time
+    path['total'] = sum(path.values())
+    return path
+
+
+def diff(plan, plan_opt, round_id=''):
+    """ Dry-run diff of the plans (unified diff).
+    """
+    return '\n'.join(difflib.unified_diff(format_plan(plan), format_plan(plan_opt),
+                                          fromfile=f'{round_id} original', tofile=f'{round_id} optimized', lineterm=''))
+
+
+# ---------------------------------------------------------------------------
+# Optimizer
+# ---------------------------------------------------------------------------
+
+class sequenceOptimizer():
+    """ Compiles and optimizes the plan of each round of an experiment sequence (see module docstring).
+
+    Settings in the experiment config:
+        optimize: true                        # or a dictionary with the settings below
+        optimize:
+            hoist: true                       # hoist round-invariant moves into pauses
+            move_time: 10                     # estimated duration (s) of a buffer selection
+    """
+
+    def __init__(self, sequence, valve_out_positions=None, hoist=True, move_time=10, logger=None):
+        """__init__ _summary_
+
+        Args:
+            sequence (list): sequence of the experiment config.
+            valve_out_positions (list, optional): positions of the outlet valve. Defaults to None.
+            hoist (bool, optional): hoist round-invariant moves into pauses. Defaults to True.
+            move_time (float, optional): estimated duration (s) of a buffer selection. Defaults to 10.
+            logger (logging.Logger, optional): logger. Defaults to None.
+        """
+        if isinstance(logger, type(None)):
+            self.logger = logging.getLogger('AUTOMATOR-Optimizer')
+            self.logger.setLevel(100)
+        else:
+            self.logger = logger
+
+        self.sequence = sequence
+        self.valve_out_positions = valve_out_positions
+        self.hoist = hoist
+        self.move_time = move_time
+
+    def plan(self, round_id):
+        """ Original plan of a round.
+        """
+        return flatten(self.sequence, round_id)
+
+    def optimize(self, round_id):
+        """ Optimized plan of a round. The original plan is returned if the verification fails.
+
+        Returns:
+            tuple: (plan, notes)
+        """
+        plan = self.plan(round_id)
+
+        plan_opt, notes = merge_pauses(plan)
+        plan_opt, notes_pass = drop_redundant(plan_opt, round_id, self.valve_out_positions)
+        notes += notes_pass
+        if self.hoist:
+            plan_opt, notes_pass = hoist_moves(plan_opt)
+            notes += notes_pass
+
+        differences = verify(plan, plan_opt, round_id, self.valve_out_positions)
+        if differences:
+            self.logger.error(f'Optimized plan of round {round_id} is not equivalent, using original plan: {differences}')
+            return plan, []
+
+        return plan_opt, notes
+
+    def report(self, round_id):
+        """ Critical path before and after the optimization, applied passes, and dry-run diff.
+
+        Returns:
+            str: report.
+        """
+        plan = self.plan(round_id)
+        plan_opt, notes = self.optimize(round_id)
+        path = critical_path(plan, self.move_time)
+        path_opt = critical_path(plan_opt, self.move_time)
+
+        lines = [f'Round {round_id}: {len(plan)} steps -> {len(plan_opt)} steps']
+        for key in ('total', 'pump', 'pause', 'moves'):
+            lines.append(f'  {key:<6}: {path[key]:>6.0f} s -> {path_opt[key]:>6.0f} s')
+        lines += [f'  - {note}' for note in notes]
+        lines.append(diff(plan, plan_opt, round_id) or '  (no changes)')
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import sys
+    import yaml
+
+    with open(sys.argv[1]) as file:
+        config = yaml.load(file, Loader=yaml.FullLoader)
+    optimizer = sequenceOptimizer(config['sequence'], config.get('valve_out', {}).get('positions'))
+    for round_id in sys.argv[2:]:
+        print(optimizer.report(round_id))
@@ -0,0 +1,362 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import itertools
+import json
+import logging
+import queue
+import time
+from pathlib import Path
+from threading import Condition, Lock, Thread
+
+import numpy as np
+
+from autofish.metrics import METRICS
+
+
+# ---------------------------------------------------------------------------
+# Metrics of one image tile
+# ---------------------------------------------------------------------------
+
+def _gaussian_kernel(sigma):
+    radius = max(1, int(3 * sigma + 0.5))
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-x**2 / (2 * sigma**2))
+    return kernel / kernel.sum()
+
+
+def _smooth(image, sigma):
+    """ Separable Gaussian filter (one shifted slice per kernel tap, no scipy needed).
+    """
+    kernel = _gaussian_kernel(sigma).astype(image.dtype)
+    r = len(kernel) // 2
+    ny, nx = image.shape
+
+    padded = np.pad(image, ((r, r), (0, 0)), mode='reflect')
+    rows = np.zeros_like(image)
+    for i, k in enumerate(kernel):
+        rows += k * padded[i:i + ny, :]
+
+    padded = np.pad(rows, ((0, 0), (r, r)), mode='reflect')
+    smoothed = np.zeros_like(image)
+    for i, k in enumerate(kernel):
+        smoothed += k * padded[:, i:i + nx]
+    return smoothed
+
+
+def _laplace(image):
+    """ Laplacian (4-neighbors) of the interior of the image.
+    """
+    return (image[:-2, 1:-1] + image[2:, 1:-1] + image[1:-1, :-2] + image[1:-1, 2:] - 4 * image[1:-1, 1:-1])
+
+
+def count_spots(image, sigma=1.5, k_threshold=5):
+    """ Fast spot count: local maxima of the Laplacian of Gaussian (LoG) above a robust threshold.
+
+    Args:
+        image (np.ndarray): 2D image.
+        sigma (float, optional): size of spots (px). Defaults to 1.5.
+        k_threshold (float, optional): threshold in robust standard deviations (MAD) of the LoG. Defaults to 5.
+
+    Returns:
+        int: number of spots.
+    """
+    log = -_laplace(_smooth(image.astype(np.float32), sigma)) * sigma**2
+    median = np.median(log)
+    threshold = median + k_threshold * 1.4826 * np.median(np.abs(log - median))
+
+    # Local maxima in 3x3 neighborhood (interior pixels)
+    center = log[1:-1, 1:-1]
+    is_max = center > threshold
+    for dy in (0, 1, 2):
+        for dx in (0, 1, 2):
+            if (dy, dx) != (1, 1):
+                is_max &= center >= log[dy:dy + center.shape[0], dx:dx + center.shape[1]]
+    return int(is_max.sum())
+
+
+def tile_metrics(image, spot_sigma=1.5, k_threshold=5, saturation=None):
+    """ Quality metrics of one image tile.
+
+    Args:
+        image (np.ndarray): 2D image.
+        spot_sigma (float, optional): size of spots (px). Defaults to 1.5.
+        k_threshold (float, optional): threshold of spot detection (see count_spots). Defaults to 5.
+        saturation (float, optional): saturated intensity. Defaults to maximum of the integer type.
+
+    Returns:
+        dict: focus (variance of Laplacian, normalized by the squared mean), background (10th percentile),
+              saturation (fraction of saturated pixels), spots (number of spots).
+    """
+    image = np.asarray(image)
+    if saturation is None:
+        saturation = np.iinfo(image.dtype).max if np.issubdtype(image.dtype, np.integer) else np.inf
+
+    image_float = image.astype(np.float32)
+    mean = float(image_float.mean())
+    flat = image_float.ravel()
+    k = int(0.1 * (flat.size - 1))
+
+    return {'focus': float(_laplace(image_float).var() / (mean**2 + 1e-9)),
+            'background': float(np.partition(flat, k)[k]),
+            'saturation': float((image >= saturation).mean()),
+            'spots': count_spots(image, spot_sigma, k_threshold)}
+
+
+# ---------------------------------------------------------------------------
+# QC of rounds
+# ---------------------------------------------------------------------------
+
+class imageQC():
+    """ Online quality control of acquired images, with a pool of worker threads.
+
+    image_process_fn is used as pycromanager image hook: it only puts the image in a bounded queue
+    (images are dropped when the workers are behind) and returns, so the acquisition is not slowed down.
+    The workers compute the metrics of each tile (see tile_metrics). When all tiles of a round are
+    processed, the metrics are aggregated per channel (median over tiles), compared to the previous
+    rounds, saved (qc_rounds.jsonl in the folder of the data), and passed to on_result.
+
+    Settings in the microscope config:
+        qc:
+            workers: 2
+            queue: 64                  # maximum number of queued images
+            channels: ['Cy3']          # channels to analyze. Default: all
+            spot_sigma: 1.5            # size of spots (px)
+            action: 'requeue'          # when thresholds are violated: 'requeue' (redo round) or 'alert'
+            max_redo: 1                # maximum number of times a round is requeued
+            timeout: 600               # s, maximum wait for the QC of the last round (see wait_idle)
+            thresholds:
+                focus_rel_min: 0.5         # relative to median of previous rounds
+                spots_rel_min: 0.5
+                background_rel_max: 2
+                saturation_max: 0.01       # fraction of saturated pixels
+                spots_min: 5               # spots per tile
+    """
+
+    def __init__(self, workers=2, queue_size=64, channels=None, spot_sigma=1.5, k_threshold=5, saturation=None,
+                 thresholds=None, action='alert', max_redo=1, timeout=600, on_result=None, logger=None):
+        """__init__ _summary_
+
+        Args:
+            workers (int, optional): number of worker threads. Defaults to 2.
+            queue_size (int, optional): maximum number of queued images. Defaults to 64.
+            channels (list, optional): channels to analyze. Defaults to None (all).
+            spot_sigma (float, optional): size of spots (px). Defaults to 1.5.
+            k_threshold (float, optional): threshold of spot detection. Defaults to 5.
+            saturation (float, optional): saturated intensity. Defaults to None (maximum of type).
+            thresholds (dict, optional): see class docstring. Defaults to None.
+            action (str, optional): 'requeue' or 'alert'. Defaults to 'alert'.
+            max_redo (int, optional): maximum number of times a round is requeued. Defaults to 1.
+            timeout (float, optional): maximum wait (s) in wait_idle. Defaults to 600.
+            on_result (callable, optional): called with round id and result. Defaults to None.
+            logger (logging.Logger, optional): logger. Defaults to None.
+        """
+        if isinstance(logger, type(None)):
+            self.logger = logging.getLogger('AUTOMATOR-QC')
+            self.logger.setLevel(100)
+        else:
+            self.logger = logger
+
+        if action not in ('requeue', 'alert'):
+            raise ValueError(f'QC action has to be "requeue" or "alert", not {action}')
+
+        self.channels = channels
+        self.spot_sigma = spot_sigma
+        self.k_threshold = k_threshold
+        self.saturation = saturation
+        self.thresholds = thresholds or {}
+        self.action = action
+        self.max_redo = max_redo
+        self.timeout = timeout
+        self.on_result = on_result
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = Lock()
+        self.idle = Condition(self.lock)  # Notified when an evaluation is done
+        self.n_evaluating = 0
+        self.acquisitions = {}     # (round_id, n): {'tiles': {channel: [metrics]}, 'pending', 'ended', 'discard', 'dropped', 'dir_save'}
+        self.current = None        # key of running acquisition
+        self.ids = itertools.count()
+        self.history = []          # results of previous rounds that passed QC
+
+        self.workers = [Thread(target=self._work, name=f'qc-{i}', daemon=True) for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    @classmethod
+    def from_config(cls, config, logger=None):
+        config = dict(config)
+        if 'queue' in config:
+            config['queue_size'] = config.pop('queue')
+        return cls(logger=logger, **config)
+
+    # >>> Acquisition
+    def start_round(self, round_id, dir_save=None):
+        """ Acquisition of a round starts (a repeated acquisition replaces the previous one).
+        """
+        with self.lock:
+            self.current = (round_id, next(self.ids))
+            self.acquisitions[self.current] = {'tiles': {}, 'pending': 0, 'ended': False, 'discard': False,
+                                               'dropped': 0, 'dir_save': dir_save}
+
+    def image_process_fn(self, image, metadata):
+        """ Image hook for pycromanager: queue the image for the workers, returns the image unchanged.
+        """
+        channel = metadata.get('Axes', {}).get('channel', 0)
+        key = self.current
+        if key is None or (self.channels is not None and channel not in self.channels):
+            return image, metadata
+
+        with self.lock:
+            self.acquisitions[key]['pending'] += 1
+        try:
+            self.queue.put_nowait((key, channel, image))
+        except queue.Full:
+            METRICS.increment('qc_images_dropped')
+            with self.lock:
+                self.acquisitions[key]['pending'] -= 1
+                self.acquisitions[key]['dropped'] += 1
+        return image, metadata
+
+    def end_round(self, discard=False):
+        """ All images of the round are acquired. The round is evaluated when the workers processed them.
+
+        Args:
+            discard (bool, optional): do not evaluate the round, e.g. acquisition was cancelled. Defaults to False.
+        """
+        with self.lock:
+            key, self.current = self.current, None
+            if key is None:
+                return
+            self.acquisitions[key]['ended'] = True
+            self.acquisitions[key]['discard'] = discard
+            ready = self.acquisitions[key]['pending'] == 0
+        if ready:
+            self._evaluate(key)
+
+    def wait_idle(self, timeout=None):
+        """ Wait until all ended acquisitions are evaluated (and on_result returned), e.g. before
+        the run ends, since the QC of the last round can requeue it.
+
+        Args:
+            timeout (float, optional): maximum waiting time in seconds. Defaults to the timeout setting.
+
+        Returns:
+            bool: True if idle, False after the timeout.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        with self.idle:
+            return self.idle.wait_for(lambda: self.n_evaluating == 0 and
+                                      not any(state['ended'] for state in self.acquisitions.values()), timeout)
+
+    def close(self):
+        """ Stop the workers (after the queued images).
+        """
+        for _ in self.workers:
+            self.queue.put(None)
+
+    # >>> Workers
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            # A failing image or evaluation must not stop the worker
+            try:
+                self._process(*item)
+            except Exception:
+                self.logger.exception('QC worker: processing of image failed.')
+
+    def _process(self, key, channel, image):
+        try:
+            with METRICS.span('qc_tile', 'qc'):
+                metrics = tile_metrics(image, self.spot_sigma, self.k_threshold, self.saturation)
+        except Exception as e:
+            self.logger.error(f'QC of image failed: {e}')
+            metrics = None
+
+        with self.lock:
+            state = self.acquisitions[key]
+            if metrics is not None:
+                state['tiles'].setdefault(channel, []).append(metrics)
+            state['pending'] -= 1
+            ready = state['ended'] and state['pending'] == 0
+        if ready:
+            self._evaluate(key)
+
+    # >>> Evaluation
+    def _evaluate(self, key):
+        with self.lock:
+            state = self.acquisitions.pop(key, None)
+            self.n_evaluating += 1
+        try:
+            self._evaluate_state(key, state)
+        except Exception:
+            self.logger.exception(f'QC of round {key[0]}: evaluation failed.')
+        finally:
+            with self.idle:
+                self.n_evaluating -= 1
+                self.idle.notify_all()
+
+    def _evaluate_state(self, key, state):
+        if state is None or state['discard']:
+            return
+
+        round_id = key[0]
+        if not state['tiles']:
+            self.logger.warning(f'QC of round {round_id}: no images analyzed.')
+            return
+
+        channels = {channel: {key: float(np.median([tile[key] for tile in tiles])) for key in tiles[0]}
+                    for channel, tiles in state['tiles'].items()}
+        result = {'round': round_id,
+                  'time': round(time.time(), 3),
+                  'n_tiles': {channel: len(tiles) for channel, tiles in state['tiles'].items()},
+                  'n_dropped': state['dropped'],
+                  'channels': channels,
+                  'violations': self.check(channels),
+                  'action': self.action}
+
+        if not result['violations']:
+            self.history.append(result)
+
+        for violation in result['violations']:
+            self.logger.error(f'QC of round {round_id}: {violation}')
+        self.logger.info(f'QC of round {round_id}: {channels}')
+
+        if state['dir_save'] is not None:
+            with open(Path(state['dir_save'], 'qc_rounds.jsonl'), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(result) + '\n')
+
+        if self.on_result is not None:
+            self.on_result(round_id, result)
+
+    def check(self, channels):
+        """ Compare metrics of a round with the thresholds, relative thresholds are compared to the
+        median of the previous rounds that passed QC.
+
+        Returns:
+            list: violated thresholds (str).
+        """
+        t = self.thresholds
+        violations = []
+        for channel, metrics in channels.items():
+            previous = [result['channels'][channel] for result in self.history if channel in result['channels']]
+            reference = {key: float(np.median([m[key] for m in previous])) for key in metrics} if previous else None
+
+            if metrics['saturation'] > t.get('saturation_max', np.inf):
+                violations.append(f'{channel}: saturation {metrics["saturation"]:.4f} > {t["saturation_max"]}')
+            if metrics['spots'] < t.get('spots_min', -np.inf):
+                violations.append(f'{channel}: {metrics["spots"]} spots < {t["spots_min"]}')
+
+            if reference is None:
+                continue
+            for key, limit, is_min in (('focus', 'focus_rel_min', True), ('spots', 'spots_rel_min', True),
+                                       ('background', 'background_rel_max', False)):
+                if limit not in t or reference[key] == 0:
+                    continue
+                ratio = metrics[key] / reference[key]
+                if (is_min and ratio < t[limit]) or (not is_min and ratio > t[limit]):
+                    violations.append(f'{channel}: {key} is {ratio:.2f} x previous rounds (limit {t[limit]})')
+        return violations
@@ -0,0 +1,473 @@
+'''
+Acquisition in a separate worker process.
+
+The acquisition stack (pycromanager with its Java bridge, or other acquisition software) runs in a
+worker process that serves acquisitions over a local TCP socket. A hang or crash of the acquisition
+then does not stop the fluidics, and the worker can be restarted without restarting the robot.
+
+Protocol: one JSON object per line, in both directions.
+    client -> worker : {"cmd": "acquire", "id": 1, "dir_save": "D:/data", "name_base": "r1"}
+                       {"cmd": "cancel", "id": 1}
+                       {"cmd": "ping"}
+                       {"cmd": "shutdown"}
+    worker -> client : {"msg": "hello", "microscope": "pycroManager"}
+                       {"msg": "started", "id": 1}
+                       {"msg": "done", "id": 1, "ok": true, "cancelled": false, "error": null}
+                       {"msg": "heartbeat", "busy": 1, "images": 120, "time": 1700000000.0}
+                           (busy: id of running acquisition, or null; images: number of acquired images, shows progress)
+                       {"msg": "pong"}
+                       {"msg": "error", "error": "..."}                          (invalid command)
+
+Worker with pycromanager, or a stand-in that only waits (for tests without microscope):
+
+    python -m autofish.remote --microscope microscope_config.yaml --positions positions.pos --port 6001
+    python -m autofish.remote --stand-in 5 --port 6001 [--stand-in-mode hang]
+'''
+
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import argparse
+import json
+import logging
+import socket
+import subprocess
+import sys
+import time
+from threading import Event, Lock, Thread
+
+from autofish.imager import Microscope
+
+
+def _send(stream, lock, message):
+    with lock:
+        stream.write(json.dumps(message) + '\n')
+        stream.flush()
+
+
+# ---------------------------------------------------------------------------
+# Worker
+# ---------------------------------------------------------------------------
+
+class standInMicroscope(Microscope):
+    """ Microscope without hardware for tests of the remote acquisition: an acquisition waits for
+    duration seconds (can be cancelled) and acquires an image every interval seconds. With hang, the
+    acquisition never returns and acquires no image (hung acquisition software), with fail it raises an error.
+    """
+
+    def __init__(self, duration=2, hang=False, fail=False, interval=0.2, **kargs):
+        super().__init__(**kargs)
+        self.duration = duration
+        self.hang = hang
+        self.fail = fail
+        self.interval = interval
+
+    def acquire_images(self, dir_save=None, name_base='test'):
+        self.log_msg('info', f'Stand-in acquisition {name_base} ({self.duration}s).')
+        if self.hang:
+            Event().wait()
+        t_end = time.monotonic() + self.duration
+        while (t_remaining := t_end - time.monotonic()) > 0:
+            if self.stop.wait(min(self.interval, t_remaining)):
+                self.log_msg('info', 'Stand-in acquisition cancelled.')
+                return
+            self.n_images += 1
+        if self.fail:
+            raise RuntimeError('Stand-in acquisition failed')
+
+
+class acquisitionServer():
+    """ Serves acquisitions of a microscope to one client at a time (see module docstring).
+
+    Only one acquisition runs at a time, also across connections: an acquisition of a lost client is
+    cancelled, and new acquisitions are refused until it actually finished (e.g. a hung acquisition
+    until the worker is restarted).
+    """
+
+    def __init__(self, microscope, host='127.0.0.1', port=6001, heartbeat=1, logger=None):
+        """__init__ _summary_
+
+        Args:
+            microscope (Microscope): microscope running the acquisitions, e.g. pycroManager.
+            host (str, optional): host to listen on. Defaults to '127.0.0.1'.
+            port (int, optional): port, 0 to pick a free port. Defaults to 6001.
+            heartbeat (float, optional): interval of heartbeats in seconds. Defaults to 1.
+            logger (logging.Logger, optional): logger. Defaults to None.
+        """
+        if isinstance(logger, type(None)):
+            self.logger = logging.getLogger('AUTOMATOR-Worker')
+            self.logger.setLevel(100)
+        else:
+            self.logger = logger
+
+        self.microscope = microscope
+        self.heartbeat = heartbeat
+        self.shutdown = Event()
+        self.lock = Lock()
+        self.current = None    # (id, acquisitionHandle) of the last started acquisition
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+
+    def serve_forever(self):
+        self.logger.info(f'Acquisition worker ({self.microscope._type()}) listening on port {self.port}.')
+        while not self.shutdown.is_set():
+            conn, _ = self.sock.accept()
+            self.logger.info('Client connected.')
+            try:
+                self._serve(conn)
+            except (OSError, ValueError) as e:
+                self.logger.warning(f'Connection lost ({e}).')
+            finally:
+                conn.close()
+        self.sock.close()
+
+    def running(self):
+        """ Id and handle of the running acquisition, (None, None) if no acquisition is running.
+        """
+        with self.lock:
+            if self.current is None or self.current[1].poll():
+                return None, None
+            return self.current
+
+    def _serve(self, conn):
+        reader = conn.makefile('r', encoding='utf-8')
+        writer = conn.makefile('w', encoding='utf-8')
+        lock = Lock()
+        closed = Event()
+
+        def heartbeats():
+            while not closed.wait(self.heartbeat):
+                busy, _ = self.running()
+                try:
+                    _send(writer, lock, {'msg': 'heartbeat', 'busy': busy, 'images': self.microscope.n_images,
+                                         'time': time.time()})
+                except (OSError, ValueError):
+                    return
+
+        def report(acq_id, handle):
+            handle.wait()
+            if closed.is_set():
+                return
+            error = repr(handle.exception) if handle.exception is not None else None
+            try:
+                _send(writer, lock, {'msg': 'done', 'id': acq_id, 'ok': error is None and not handle.cancelled,
+                                     'cancelled': handle.cancelled, 'error': error})
+            except (OSError, ValueError):
+                pass
+
+        Thread(target=heartbeats, daemon=True).start()
+        _send(writer, lock, {'msg': 'hello', 'microscope': self.microscope._type()})
+
+        try:
+            for line in reader:
+                try:
+                    command = json.loads(line)
+                    cmd = command['cmd']
+                except (ValueError, KeyError, TypeError):
+                    _send(writer, lock, {'msg': 'error', 'error': f'Invalid command: {line.strip()}'})
+                    continue
+
+                if cmd == 'acquire':
+                    with self.lock:
+                        if self.current is not None and not self.current[1].poll():
+                            handle = None
+                        else:
+                            handle = self.microscope.start_acquisition(dir_save=command.get('dir_save'),
+                                                                       name_base=command.get('name_base', 'test'))
+                            self.current = (command.get('id'), handle)
+                    if handle is None:
+                        _send(writer, lock, {'msg': 'done', 'id': command.get('id'), 'ok': False, 'cancelled': False,
+                                             'error': 'Acquisition already running'})
+                        continue
+                    _send(writer, lock, {'msg': 'started', 'id': command.get('id')})
+                    Thread(target=report, args=(command.get('id'), handle), daemon=True).start()
+
+                elif cmd == 'cancel':
+                    acq_id, handle = self.running()
+                    if handle is not None and acq_id == command.get('id'):
+                        handle.cancel()
+
+                elif cmd == 'ping':
+                    _send(writer, lock, {'msg': 'pong'})
+
+                elif cmd == 'shutdown':
+                    _, handle = self.running()
+                    if handle is not None:
+                        handle.cancel()
+                    self.shutdown.set()
+                    break
+
+                else:
+                    _send(writer, lock, {'msg': 'error', 'error': f'Unknown command: {cmd}'})
+        finally:
+            closed.set()
+            # Acquisition of a lost client is cancelled, the next client can start one when it finished
+            _, handle = self.running()
+            if handle is not None:
+                handle.cancel()
+
+
+# ---------------------------------------------------------------------------
+# Client
+# ---------------------------------------------------------------------------
+
+class remoteMicroscope(Microscope):
+    """ Microscope that runs its acquisitions in a worker process (see module docstring).
+
+    An acquisition fails (exception, the controller then asks whether to repeat it) when the worker
+    does not answer, sends no heartbeat within heartbeat_timeout, acquires no image within progress_timeout
+    (hung acquisition, the heartbeats come from another thread of the worker), or the acquisition takes
+    longer than acquisition_timeout. With worker_cmd, the worker is started by this class and restarted
+    after such a failure.
+    """
+
+    def __init__(self, host='127.0.0.1', port=6001, worker_cmd=None, heartbeat_timeout=10, progress_timeout=300,
+                 acquisition_timeout=None, connect_timeout=60, logger=None, logger_short=None):
+        """__init__ _summary_
+
+        Args:
+            host (str, optional): host of the worker. Defaults to '127.0.0.1'.
+            port (int, optional): port of the worker. Defaults to 6001.
+            worker_cmd (list, optional): command to start the worker process. Defaults to None (worker is started separately).
+            heartbeat_timeout (float, optional): maximum time without message from the worker (s). Defaults to 10.
+            progress_timeout (float, optional): maximum time without new image during an acquisition (s). Defaults to 300.
+            acquisition_timeout (float, optional): maximum duration of an acquisition (s). Defaults to None (no limit).
+            connect_timeout (float, optional): maximum time to connect to the worker (s), e.g. while it starts. Defaults to 60.
+            logger (logging.Logger, optional): logger. Defaults to None.
+            logger_short (logging.Logger, optional): short logger. Defaults to None.
+        """
+        super().__init__(logger, logger_short)
+
+        self.address = (host, port)
+        self.worker_cmd = worker_cmd
+        self.heartbeat_timeout = heartbeat_timeout
+        self.progress_timeout = progress_timeout
+        self.acquisition_timeout = acquisition_timeout
+        self.connect_timeout = connect_timeout
+
+        self.process = None
+        self.sock = None
+        self.writer = None
+        self.lock = Lock()
+        self.ids = 0
+        self.last_message = 0
+        self.images = None      # Number of images acquired by the worker, from the heartbeats
+        self.last_progress = 0
+        self.results = {}       # id: done message
+        self.received = Event()
+        self.n_restarts = 0
+
+    def _type(self):
+        return 'remoteMicroscope'
+
+    # >>> Worker process and connection
+    def start_worker(self):
+        if self.worker_cmd is not None:
+            self.log_msg('info', f'Starting acquisition worker: {" ".join(map(str, self.worker_cmd))}')
+            self.process = subprocess.Popen(self.worker_cmd)
+
+    def stop_worker(self, timeout=5):
+        self.disconnect()
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+    def restart_worker(self):
+        """ Kill the worker (it may be hung) and start a new one.
+        """
+        self.log_msg('warning', 'Restarting acquisition worker.')
+        self.stop_worker()
+        self.start_worker()
+        self.n_restarts += 1
+        self.connect()
+
+    def connect(self):
+        """ Connect to the worker, starts the worker first when worker_cmd is given and it is not running.
+
+        Returns:
+            bool: True if connected.
+        """
+        if self.sock is not None:
+            return True
+        if self.worker_cmd is not None and (self.process is None or self.process.poll() is not None):
+            self.start_worker()
+
+        t_start = time.monotonic()
+        while time.monotonic() - t_start < self.connect_timeout:
+            try:
+                sock = socket.create_connection(self.address, timeout=5)
+                break
+            except OSError:
+                if self.process is not None and self.process.poll() is not None:
+                    self.log_msg('error', f'Acquisition worker exited with code {self.process.returncode}.')
+                    return False
+                time.sleep(0.5)
+        else:
+            self.log_msg('error', f'Could not connect to acquisition worker on {self.address}.')
+            return False
+
+        sock.settimeout(None)
+        self.sock = sock
+        self.writer = sock.makefile('w', encoding='utf-8')
+        self.last_message = time.monotonic()
+        Thread(target=self._read, args=(sock,), daemon=True).start()
+        self.log_msg('info', f'Connected to acquisition worker on {self.address}.')
+        return True
+
+    def disconnect(self):
+        sock, self.sock, self.writer = self.sock, None, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def _read(self, sock):
+        try:
+            for line in sock.makefile('r', encoding='utf-8'):
+                self.last_message = time.monotonic()
+                message = json.loads(line)
+                if message.get('msg') == 'heartbeat':
+                    # Workers that do not report the number of images are not checked for progress
+                    if message.get('images') is None or message['images'] != self.images:
+                        self.images = message.get('images')
+                        self.last_progress = self.last_message
+                elif message.get('msg') == 'done':
+                    self.results[message.get('id')] = message
+                    self.received.set()
+                elif message.get('msg') == 'error':
+                    self.log_msg('error', f'Acquisition worker: {message.get("error")}')
+        except (OSError, ValueError):
+            pass
+        if self.sock is sock:
+            self.log_msg('error', 'Connection to acquisition worker lost.')
+            self.disconnect()
+        self.received.set()
+
+    def _send(self, message):
+        if self.writer is None:
+            raise ConnectionError('Not connected to acquisition worker')
+        _send(self.writer, self.lock, message)
+
+    # >>> Acquisition
+    def acquire_images(self, dir_save=None, name_base='test'):
+        """ Run an acquisition in the worker, returns when it is done.
+
+        Raises:
+            ConnectionError: worker not reachable, connection lost or no heartbeat.
+            TimeoutError: no progress within progress_timeout, or acquisition took longer than acquisition_timeout.
+            RuntimeError: acquisition failed in the worker.
+        """
+        if not self.connect():
+            raise ConnectionError('Acquisition worker not reachable')
+
+        self.ids += 1
+        acq_id = self.ids
+        self.received.clear()
+        self._send({'cmd': 'acquire', 'id': acq_id, 'dir_save': str(dir_save) if dir_save else None,
+                    'name_base': name_base})
+
+        t_start = time.monotonic()
+        self.last_progress = t_start
+        cancel_sent = False
+        while acq_id not in self.results:
+            self.received.wait(0.5)
+            self.received.clear()
+            if acq_id in self.results:
+                break
+
+            if self.stop.is_set() and not cancel_sent:
+                self._send({'cmd': 'cancel', 'id': acq_id})
+                cancel_sent = True
+
+            problem, error = None, ConnectionError
+            if self.sock is None:
+                problem = 'connection to acquisition worker lost'
+            elif time.monotonic() - self.last_message > self.heartbeat_timeout:
+                problem = f'no heartbeat from acquisition worker for {self.heartbeat_timeout}s'
+            elif self.progress_timeout is not None and time.monotonic() - self.last_progress > self.progress_timeout:
+                problem, error = f'no image acquired for {self.progress_timeout}s, acquisition is hung', TimeoutError
+            elif self.acquisition_timeout is not None and time.monotonic() - t_start > self.acquisition_timeout:
+                problem, error = f'acquisition did not finish within {self.acquisition_timeout}s', TimeoutError
+
+            if problem is not None:
+                self.log_msg('error', f'Acquisition {name_base}: {problem}.')
+                if self.worker_cmd is not None:
+                    self.restart_worker()
+                else:
+                    self.disconnect()
+                raise error(problem)
+
+        result = self.results.pop(acq_id)
+        if result.get('error'):
+            raise RuntimeError(f'Acquisition failed in worker: {result["error"]}')
+        self.log_msg('info', f'Acquisition {name_base} done in worker.', round=name_base,
+                     duration=round(time.monotonic() - t_start, 3))
+
+    def close(self):
+        """ Stop the worker (if started by this class) and close the connection.
+        """
+        sock, writer = self.sock, self.writer
+        self.sock, self.writer = None, None    # closing is not a lost connection for the reader
+        try:
+            if writer is not None:
+                _send(writer, self.lock, {'cmd': 'shutdown'})
+        except (OSError, ValueError):
+            pass
+        if sock is not None:
+            sock.close()
+        self.stop_worker()
+
+
+# ---------------------------------------------------------------------------
+# Worker process
+# ---------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Acquisition worker of autofish.')
+    parser.add_argument('--microscope', help='pycromanager microscope config (yaml)')
+    parser.add_argument('--positions', help='position list')
+    parser.add_argument('--mm-headless', action='store_true', help='start micromanager headless')
+    parser.add_argument('--stand-in', type=float, metavar='SECONDS', help='stand-in microscope without hardware')
+    parser.add_argument('--stand-in-mode', choices=('ok', 'hang', 'fail'), default='ok', help='behavior of stand-in acquisitions')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6001)
+    parser.add_argument('--heartbeat', type=float, default=1, help='interval of heartbeats (s)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s WORKER %(levelname)s %(message)s')
+    logger = logging.getLogger('AUTOMATOR-Worker')
+
+    if args.stand_in is not None:
+        M = standInMicroscope(duration=args.stand_in, hang=args.stand_in_mode == 'hang', fail=args.stand_in_mode == 'fail',
+                              logger=logger, logger_short=logger)
+    else:
+        from autofish.imager import pycroManager
+        M = pycroManager(logger=logger, logger_short=logger)
+        M.load_config_file(args.microscope)
+        M.load_position_list(file_pos=args.positions)
+        M.mm_connect(args.mm_headless)
+        M.create_acquisition_event()
+        if not M.status['acquisition_event']:
+            return 1
+
+    try:
+        acquisitionServer(M, host=args.host, port=args.port, heartbeat=args.heartbeat, logger=logger).serve_forever()
+    finally:
+        M.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
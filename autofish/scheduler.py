@@ -0,0 +1,208 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import heapq
+import itertools
+from threading import RLock
+
+
+# ---------------------------------------------------------------------------
+# Scheduler of rounds
+# ---------------------------------------------------------------------------
+
+class roundScheduler():
+    """ Rounds of an experiment with their state and priority.
+
+    States:
+        pending  : not run yet.
+        running  : fluidics of the round is running.
+        done     : all steps of the round are done.
+        failed   : round stopped with an error.
+        requeued : round will be run (again), e.g. a failed round.
+        skipped  : round will not be run.
+
+    Pending and requeued rounds are runnable, the next round is the runnable round with the
+    lowest priority (then the order in which rounds were added). By default, the priority is the
+    position in the buffer list. State changes are O(1), changes of the queue O(log n): the queue is
+    a heap where outdated entries are removed when they reach the top.
+    """
+
+    STATES = ('pending', 'running', 'done', 'failed', 'requeued', 'skipped')
+    RUNNABLE = ('pending', 'requeued')
+
+    def __init__(self, rounds=()):
+        """__init__ _summary_
+
+        Args:
+            rounds (list, optional): round ids, in the order they should be run. Defaults to ().
+        """
+        self.lock = RLock()
+        self.entries = {}    # round_id: {'state', 'priority', 'seq', 'attempts'}
+        self.heap = []       # (priority, seq, round_id)
+        self.seq = itertools.count()
+        self.n_runnable = 0
+        self.priority_max = -1
+
+        for round_id in rounds:
+            self.add(round_id)
+
+    # >>> Queue
+    def _push(self, round_id, priority):
+        entry = self.entries[round_id]
+        entry['priority'] = priority
+        entry['seq'] = next(self.seq)
+        self.priority_max = max(self.priority_max, priority)
+        heapq.heappush(self.heap, (priority, entry['seq'], round_id))
+
+    def _set_state(self, round_id, state):
+        entry = self.entries[round_id]
+        self.n_runnable += (state in self.RUNNABLE) - (entry['state'] in self.RUNNABLE)
+        entry['state'] = state
+
+    def _top(self):
+        """ Remove outdated entries from the top of the heap, and return the top entry.
+        """
+        while self.heap:
+            priority, seq, round_id = self.heap[0]
+            entry = self.entries.get(round_id)
+            if entry is not None and entry['seq'] == seq and entry['state'] in self.RUNNABLE:
+                return round_id
+            heapq.heappop(self.heap)
+        return None
+
+    def add(self, round_id, priority=None):
+        """ Add a round (also while the experiment is running). A known round is requeued.
+
+        Args:
+            round_id (str): round id.
+            priority (float, optional): lower runs first. Defaults to after all rounds.
+        """
+        with self.lock:
+            if round_id in self.entries:
+                self.requeue(round_id, priority)
+                return
+            self.entries[round_id] = {'state': 'pending', 'priority': None, 'seq': None, 'attempts': 0}
+            self.n_runnable += 1
+            self._push(round_id, priority if priority is not None else self.priority_max + 1)
+
+    def _priority_first(self):
+        round_id = self._top()
+        return self.entries[round_id]['priority'] if round_id is not None else 0
+
+    def next(self):
+        """ Next round to run, None if no round is runnable.
+        """
+        with self.lock:
+            return self._top()
+
+    def set_priority(self, round_id, priority):
+        with self.lock:
+            self._push(round_id, priority)
+
+    def reorder(self, round_ids):
+        """ Custom ordering: the specified rounds are run first, in this order.
+        """
+        with self.lock:
+            priority = self._priority_first() - len(round_ids)
+            for i, round_id in enumerate(round_ids):
+                self._push(round_id, priority + i)
+
+    # >>> States
+    def start(self, round_id):
+        """ Round starts running (added if unknown, e.g. started from the user interface). A round
+        that is not runnable (e.g. skipped after it was returned by next()) is not started.
+
+        Returns:
+            bool: True if the round was started.
+        """
+        with self.lock:
+            if round_id not in self.entries:
+                self.add(round_id)
+            if self.entries[round_id]['state'] not in self.RUNNABLE:
+                return False
+            self._set_state(round_id, 'running')
+            self.entries[round_id]['attempts'] += 1
+            return True
+
+    def done(self, round_id):
+        with self.lock:
+            self._set_state(round_id, 'done')
+
+    def fail(self, round_id):
+        with self.lock:
+            self._set_state(round_id, 'failed')
+
+    def release(self, round_id):
+        """ Round was interrupted (e.g. run stopped), it stays first in the queue.
+        """
+        with self.lock:
+            self._set_state(round_id, 'requeued' if self.entries[round_id]['attempts'] > 1 else 'pending')
+            self._push(round_id, self.entries[round_id]['priority'])
+
+    def requeue(self, round_id, priority=None):
+        """ Run a round (again), e.g. a failed round.
+
+        Args:
+            round_id (str): round id.
+            priority (float, optional): lower runs first. Defaults to before all runnable rounds.
+        """
+        with self.lock:
+            if self.entries[round_id]['state'] == 'running':
+                raise ValueError(f'Round {round_id} is running')
+            if priority is None:
+                priority = self._priority_first() - 1
+            self._set_state(round_id, 'requeued')
+            self._push(round_id, priority)
+
+    def skip(self, round_id):
+        with self.lock:
+            if self.entries[round_id]['state'] == 'running':
+                raise ValueError(f'Round {round_id} is running')
+            self._set_state(round_id, 'skipped')
+
+    # >>> Queries
+    def state(self, round_id):
+        with self.lock:
+            entry = self.entries.get(round_id)
+            return entry['state'] if entry is not None else None
+
+    def attempts(self, round_id):
+        """ Number of times the round was started.
+        """
+        with self.lock:
+            entry = self.entries.get(round_id)
+            return entry['attempts'] if entry is not None else 0
+
+    def runnable(self):
+        """ Runnable rounds in the order they will be run.
+        """
+        with self.lock:
+            entries = [(entry['priority'], entry['seq'], round_id) for round_id, entry in self.entries.items()
+                       if entry['state'] in self.RUNNABLE]
+        return [round_id for _, _, round_id in sorted(entries)]
+
+    def rounds(self, state=None):
+        """ Round ids (in the order they were added), optionally only with the specified state.
+        """
+        with self.lock:
+            return [round_id for round_id, entry in self.entries.items() if state is None or entry['state'] == state]
+
+    def summary(self):
+        """ Number of rounds per state.
+        """
+        with self.lock:
+            counts = dict.fromkeys(self.STATES, 0)
+            for entry in self.entries.values():
+                counts[entry['state']] += 1
+            return counts
+
+    def __len__(self):
+        """ Number of runnable rounds.
+        """
+        return self.n_runnable
+
+    def __contains__(self, round_id):
+        """ True if round is runnable.
+        """
+        return self.state(round_id) in self.RUNNABLE
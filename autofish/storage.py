@@ -0,0 +1,194 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import logging
+from pathlib import Path
+from threading import Lock
+
+
+# ---------------------------------------------------------------------------
+# Multi-round OME-Zarr store
+# ---------------------------------------------------------------------------
+
+# Axes of each image (one image per position), at most 5 axes in OME-NGFF 0.4
+AXES = [{'name': 'round', 'type': 'time'},
+        {'name': 'channel', 'type': 'channel'},
+        {'name': 'z', 'type': 'space', 'unit': 'micrometer'},
+        {'name': 'y', 'type': 'space', 'unit': 'micrometer'},
+        {'name': 'x', 'type': 'space', 'unit': 'micrometer'}]
+
+
+class omeZarrStore():
+    """ Stores all rounds of an experiment in one chunked OME-Zarr hierarchy.
+
+    Each position is one OME-NGFF image (group named by the position index, layout of
+    bioformats2raw) with the axes round/channel/z/y/x. Each image plane is one chunk
+    (compressed with Blosc/Zstd), which allows to read any subset of the experiment
+    without opening one dataset per round. Multiscale levels are downsampled by a factor
+    of 2 per level and written together with the full resolution plane.
+
+    Arrays grow along all non-spatial axes when new rounds, channels or z-planes arrive.
+    Rounds are indexed in the order in which they are acquired, the mapping between round
+    ids and index is stored in the attributes of the root ('autofish').
+    """
+
+    def __init__(self, path_store, channels=None, n_levels=3, clevel=5, logger=None):
+        """__init__ _summary_
+
+        Args:
+            path_store (str): folder of the zarr hierarchy, e.g. 'D:/data/experiment.ome.zarr'.
+            channels (list, optional): channel names, defines the channel index. Defaults to None.
+            n_levels (int, optional): number of multiscale levels (incl. full resolution). Defaults to 3.
+            clevel (int, optional): compression level of Zstd. Defaults to 5.
+            logger (logging.Logger, optional): logger. Defaults to None.
+        """
+        if isinstance(logger, type(None)):
+            self.logger = logging.getLogger('AUTOMATOR-Storage')
+            self.logger.setLevel(100)
+        else:
+            self.logger = logger
+
+        try:
+            import zarr
+            from numcodecs import Blosc
+        except ImportError as e:
+            raise ImportError('zarr is not installed, please install if required (pip install zarr)!') from e
+        self.zarr = zarr
+
+        self.path_store = Path(path_store)
+        self.n_levels = n_levels
+        self.compressor = Blosc(cname='zstd', clevel=clevel, shuffle=Blosc.BITSHUFFLE)
+        self.lock = Lock()
+
+        self.root = self.zarr.open_group(str(self.path_store), mode='a')
+        self.root.attrs['bioformats2raw.layout'] = 3
+        attrs = self.root.attrs.get('autofish', {'rounds': [], 'channels': []})
+        self.rounds = attrs['rounds']
+        self.channels = attrs['channels']
+        for channel in (channels or []):
+            if channel not in self.channels:
+                self.channels.append(channel)
+
+        self.current_round = None
+        self.logger.info(f'OME-Zarr store opened: {self.path_store}')
+
+    def start_round(self, round_id):
+        """ Set round to which the following images will be written.
+        Repeating a round overwrites the images of the same round index.
+
+        Args:
+            round_id (str): round id.
+        """
+        round_id = str(round_id)
+        with self.lock:
+            if round_id not in self.rounds:
+                self.rounds.append(round_id)
+            self.current_round = round_id
+            self._write_attrs()
+        self.logger.info(f'OME-Zarr store: round {round_id} has index {self.rounds.index(round_id)}')
+
+    def end_round(self):
+        """ Consolidate metadata, so that downstream loaders need only a single read.
+        """
+        with self.lock:
+            self.zarr.consolidate_metadata(str(self.path_store))
+
+    def write_frame(self, image, position, channel, z, round_id=None):
+        """ Write one image plane (and its downsampled versions) to the store.
+
+        Args:
+            image (np.ndarray): 2D image.
+            position (int): position index.
+            channel (str or int): channel name or index.
+            z (int): index of z-plane.
+            round_id (str, optional): round id. Defaults to round set by start_round.
+        """
+        if round_id is not None and str(round_id) != self.current_round:
+            self.start_round(round_id)
+
+        with self.lock:
+            if isinstance(channel, str):
+                if channel not in self.channels:
+                    self.channels.append(channel)
+                    self._write_attrs()
+                channel = self.channels.index(channel)
+
+            index = (self.rounds.index(self.current_round), int(channel), int(z))
+            for level in range(self.n_levels):
+                plane = self._downsample(image, level)
+                array = self._get_array(int(position), level, plane)
+                self._resize(array, index)
+                array[index] = plane
+
+    def image_process_fn(self, image, metadata):
+        """ Image processing function for pycromanager. Writes the image into the
+        store and returns None, so pycromanager does not write an additional dataset.
+
+        Args:
+            image (np.ndarray): 2D image.
+            metadata (dict): pycromanager metadata (with 'Axes').
+        """
+        axes = metadata['Axes']
+        self.write_frame(image,
+                         position=axes.get('position', 0),
+                         channel=axes.get('channel', 0),
+                         z=axes.get('z', 0))
+        return None
+
+    def _downsample(self, image, level):
+        """ Downsample image by 2**level with a block average.
+        """
+        if level == 0:
+            return image
+
+        f = 2**level
+        ny, nx = (image.shape[0] // f) * f, (image.shape[1] // f) * f
+        blocks = image[:ny, :nx].reshape(ny // f, f, nx // f, f)
+        return blocks.mean(axis=(1, 3)).astype(image.dtype)
+
+    def _get_array(self, position, level, plane):
+        """ Get array of multiscale level of a position, created when the first plane arrives.
+        """
+        name = f'{position}/{level}'
+        if name in self.root:
+            return self.root[name]
+
+        image = self.root.require_group(str(position))
+        array = image.zeros(str(level),
+                            shape=(1, 1, 1) + plane.shape,
+                            chunks=(1, 1, 1) + plane.shape,
+                            dtype=plane.dtype,
+                            compressor=self.compressor,
+                            dimension_separator='/')
+
+        if level == self.n_levels - 1:
+            self._write_multiscales(image, position)
+        return array
+
+    def _resize(self, array, index):
+        """ Grow array along round/channel/z if index is outside.
+        """
+        shape = tuple(max(s, i + 1) for s, i in zip(array.shape[:3], index)) + array.shape[3:]
+        if shape != array.shape:
+            array.resize(shape)
+
+    def _write_multiscales(self, image, position):
+        """ OME-NGFF multiscales metadata of the image of a position.
+        """
+        datasets = [{'path': str(level),
+                     'coordinateTransformations': [{'type': 'scale',
+                                                    'scale': [1, 1, 1, 2**level, 2**level]}]}
+                    for level in range(self.n_levels)]
+
+        image.attrs['multiscales'] = [{'version': '0.4',
+                                       'name': f'{self.path_store.stem}_position{position}',
+                                       'axes': AXES,
+                                       'datasets': datasets,
+                                       'type': 'mean'}]
+
+    def _write_attrs(self):
+        """ Store round ids and channel names.
+        """
+        self.root.attrs['autofish'] = {'rounds': self.rounds,
+                                       'channels': self.channels}
@@ -0,0 +1,96 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import itertools
+import time
+from threading import Condition
+
+
+# ---------------------------------------------------------------------------
+# Questions to the operator
+# ---------------------------------------------------------------------------
+
+class consoleOperator():
+    """ Asks the operator at the console (input()). Default of Robot and Controller.
+    """
+
+    def ask(self, message, options=('continue',), stop=None):
+        """ Ask a question and wait for the answer.
+
+        Args:
+            message (str): question.
+            options (tuple, optional): possible answers, the first one is the default (Enter). Defaults to ('continue',).
+            stop (threading.Event, optional): not used at the console. Defaults to None.
+
+        Returns:
+            str: answer, one of options.
+        """
+        answer = input(f'{message} [{"/".join(options)}, Enter: {options[0]}]\n').strip()
+        return answer if answer in options else options[0]
+
+
+class remoteOperator():
+    """ Questions are answered remotely, e.g. with the control API (autofish.api).
+
+    The question is kept as pending prompt until answer() is called. When the stop event of the
+    run is set while waiting, the answer is 'stop'.
+    """
+
+    def __init__(self, on_prompt=None):
+        """__init__ _summary_
+
+        Args:
+            on_prompt (callable, optional): called with the prompt (dict) when a question is asked. Defaults to None.
+        """
+        self.on_prompt = on_prompt
+        self.condition = Condition()
+        self.prompt = None
+        self.answers = {}
+        self.ids = itertools.count(1)
+
+    def ask(self, message, options=('continue',), stop=None):
+        """ Ask a question and wait for the answer (see consoleOperator.ask).
+        """
+        with self.condition:
+            prompt_id = next(self.ids)
+            prompt = {'id': prompt_id, 'message': message, 'options': list(options), 'time': time.time()}
+            self.prompt = prompt
+
+        if self.on_prompt is not None:
+            self.on_prompt(dict(prompt))
+
+        with self.condition:
+            while prompt_id not in self.answers:
+                if stop is not None and stop.is_set():
+                    self.answers[prompt_id] = 'stop'
+                    break
+                self.condition.wait(timeout=0.5)
+            if self.prompt is not None and self.prompt['id'] == prompt_id:
+                self.prompt = None
+            return self.answers.pop(prompt_id)
+
+    def pending(self):
+        """ Returns the pending prompt, None if no question is asked.
+        """
+        with self.condition:
+            return dict(self.prompt) if self.prompt is not None else None
+
+    def answer(self, answer, prompt_id=None):
+        """ Answer the pending prompt.
+
+        Args:
+            answer (str): answer, has to be one of the options of the prompt.
+            prompt_id (int, optional): id of the prompt, to avoid answering a newer prompt. Defaults to None.
+
+        Returns:
+            bool: True if a pending prompt was answered.
+        """
+        with self.condition:
+            if self.prompt is None or answer not in self.prompt['options']:
+                return False
+            if prompt_id is not None and prompt_id != self.prompt['id']:
+                return False
+            self.answers[self.prompt['id']] = answer
+            self.condition.notify_all()
+            return True
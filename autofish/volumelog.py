@@ -0,0 +1,87 @@
+# ---------------------------------------------------------------------------
+# Imports
+# ---------------------------------------------------------------------------
+
+import csv
+import os
+from threading import Lock, Timer
+
+
+# ---------------------------------------------------------------------------
+# Log of volume measurements
+# ---------------------------------------------------------------------------
+
+class volumeLog():
+    """ Append-only CSV log of volume measurements, one row per pump step.
+
+    Each row is written when it is measured and flushed to the operating system (survives a
+    crash of Python). To keep the cost of a row constant, the file is only fsync'd (survives a
+    crash of the PC) every n_sync rows, and on sync() / close(). Rows that are not fsync'd are
+    written to disk by a timer after at most sync_interval seconds, also when no row follows
+    (e.g. during a long pause).
+    """
+
+    COLUMNS = ['Time', 'round', 'step', 'buffer', 'duration', 'pump_duration_raw',
+               'vol_expected', 'vol_measured', 'flow_mean', 'flow_std', 'flow_min', 'flow_max']
+
+    def __init__(self, file_log, n_sync=10, sync_interval=60):
+        """__init__ _summary_
+
+        Args:
+            file_log (str): csv file, new rows are appended.
+            n_sync (int, optional): number of rows between two fsync. Defaults to 10.
+            sync_interval (float, optional): maximum time (s) until a row is fsync'd. Defaults to 60.
+        """
+        self.file_log = str(file_log)
+        self.n_sync = n_sync
+        self.sync_interval = sync_interval
+        self.lock = Lock()
+
+        new_file = not os.path.isfile(self.file_log) or os.path.getsize(self.file_log) == 0
+        self.file = open(self.file_log, 'a', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(self.COLUMNS)
+
+        self.n_unsynced = 0
+        self.timer = None
+
+    def write(self, **data):
+        """ Append a row, columns that are not provided are left empty.
+
+        Args:
+            data: values of the columns (see COLUMNS).
+        """
+        row = ['' if data.get(column) is None else data[column] for column in self.COLUMNS]
+        with self.lock:
+            self.writer.writerow(row)
+            self.file.flush()
+            self.n_unsynced += 1
+            if self.n_unsynced >= self.n_sync:
+                self._sync()
+            elif self.timer is None:
+                self.timer = Timer(self.sync_interval, self.sync)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.n_unsynced = 0
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def sync(self):
+        """ Write all rows to disk.
+        """
+        with self.lock:
+            if self.n_unsynced and not self.file.closed:
+                self.file.flush()
+                self._sync()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+                self._sync()
+                self.file.close()
@@ -0,0 +1,66 @@
+# %% BENCHMARK of acquisition time per position
+#  Acquires the positions of a microscope config with each acquisition order and hardware sequencing
+#  option, and reports the time per position. Images are counted and discarded (no saving).
+#  Requires Micro-Manager (started with the config of the microscope config file, or --headless).
+#
+#  Usage: python benchmarks/acquisition_time.py [--config demo/microscope_config__MM-demo.yaml] [--repeat 3]
+
+# %% Imports
+import argparse
+import statistics
+import time
+from pathlib import Path
+
+from autofish.imager import pycroManager, _pycromanager
+
+VARIANTS = [('cz', None), ('zc', None), ('cz', 'z'), ('zc', 'channels'), ('cz', ['z', 'channels'])]
+
+
+def acquisition_time(M):
+    """ Acquire the current acquisition event once.
+
+    Returns:
+        tuple: duration of the acquisition (s), number of images.
+    """
+    n_images = 0
+
+    def image_process_fn(image, metadata):
+        nonlocal n_images
+        n_images += 1
+        return None
+
+    t_start = time.perf_counter()
+    with _pycromanager().Acquisition(directory=None, name='benchmark', image_process_fn=image_process_fn,
+                                     show_display=False, timeout=M.timeout) as acq:
+        acq.acquire(M.event)
+    return time.perf_counter() - t_start, n_images
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Acquisition time per position.')
+    parser.add_argument('--config', default=str(Path(__file__).parents[1] / 'demo' / 'microscope_config__MM-demo.yaml'))
+    parser.add_argument('--positions', default=None, help='position list (not needed for the demo config)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of acquisitions per variant')
+    parser.add_argument('--headless', action='store_true', help='start Micro-Manager headless')
+    args = parser.parse_args()
+
+    M = pycroManager()
+    M.load_config_file(args.config)
+    M.load_position_list(file_pos=args.positions)
+    M.mm_connect(args.headless)
+    n_positions = len(M.positions)
+
+    print(f'{"order":<7}{"sequencing":<20}{"support":<28}{"images":>7}{"per position [ms]":>19}')
+    for order, sequencing in VARIANTS:
+        M.config['order'] = order
+        M.config['sequencing'] = sequencing
+        M.create_acquisition_event()
+        support = M.sequencing_support() if sequencing else '-'
+
+        results = [acquisition_time(M) for _ in range(args.repeat)]
+        t_acq = statistics.median(r[0] for r in results)
+        print(f'{order:<7}{str(sequencing):<20}{str(support):<28}{results[0][1]:>7}{1000*t_acq/n_positions:>19.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# %% BENCHMARK of import times
+#  Measures the time to import the autofish modules in a fresh Python process (python -X importtime),
+#  and checks which heavy optional dependencies are loaded by the import.
+#
+#  Usage: python benchmarks/import_time.py [--repeat 5] [modules ...]
+
+# %% Imports
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = ['autofish.logs', 'autofish.automator', 'autofish.coordinator', 'autofish.imager',
+           'autofish.autofish_gui', 'autofish.__main__']
+
+HEAVY = ['numpy', 'pycromanager', 'PySimpleGUI', 'zarr', 'serial', 'yaml']
+
+
+def import_time(module):
+    """ Import module in a new process.
+
+    Returns:
+        tuple: wall time of the process (s), cumulative import time of the module (s),
+               heavy packages that were imported. None if the import failed.
+    """
+    t_start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          capture_output=True, text=True)
+    t_wall = time.perf_counter() - t_start
+    if proc.returncode != 0:
+        return None
+
+    # Lines: "import time: self [us] | cumulative | imported package"
+    t_module = 0
+    imported = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        name = name.strip()
+        if name in HEAVY:
+            imported.add(name)
+        if name == module:
+            t_module = int(cumulative) / 1e6
+
+    return t_wall, t_module, sorted(imported)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import times of autofish modules.')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=5, help='number of measurements per module')
+    args = parser.parse_args()
+
+    print(f'{"module":<26}{"wall [ms]":>11}{"import [ms]":>13}  heavy dependencies')
+    for module in args.modules:
+        results = [import_time(module) for _ in range(args.repeat)]
+        if None in results:
+            print(f'{module:<26}{"import failed":>24}')
+            continue
+        t_wall = statistics.median(r[0] for r in results)
+        t_module = statistics.median(r[1] for r in results)
+        print(f'{module:<26}{1000*t_wall:>11.1f}{1000*t_module:>13.1f}  {", ".join(results[0][2]) or "-"}')
+
+
+if __name__ == '__main__':
+    main()
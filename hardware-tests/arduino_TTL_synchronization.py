@@ -4,16 +4,63 @@
 #   12: TTL OUT: signal that imaging can be started
 #   10: TTL IN: signal that imaging is done
 #    7: set to high - can be used to imititate TTL that signals finished acquisition
+#
+#  The Arduino answers with frames @<seq>,<event>,<micros>*<checksum>, see Arduino_TTL_sync.ino
+#  Frames are read in a dedicated thread, the main thread waits for the FIN frame.
 
 # %%Importing Libraries
 import serial
 import time
+from threading import Thread, Event
 
-arduino = serial.Serial(port='COM10', baudrate=9600, timeout=1)
+arduino = serial.Serial(port='COM10', baudrate=9600, timeout=0.5)
 
+stop = Event()
+finished = Event()
+edges = []
 
-# %% Connect to arduino and run a while loop 
-# arduino = serial.Serial(port='COM10', baudrate=9600, timeout=1)
+
+def parse_frame(txt_frame):
+    """ Returns (seq, event, micros) of a valid frame, otherwise None. """
+    if not (txt_frame.startswith('@') and '*' in txt_frame):
+        return None
+    payload, checksum = txt_frame[1:].rsplit('*', 1)
+    checksum_calc = 0
+    for c in payload:
+        checksum_calc ^= ord(c)
+    if int(checksum, 16) != checksum_calc:
+        return None
+    seq, event, micros = payload.split(',')
+    return int(seq), event, int(micros)
+
+
+def read_serial():
+    seq_last = None
+    while not stop.is_set():
+        txt_serial = arduino.readline().decode('ascii', errors='replace').rstrip()
+        if not txt_serial:
+            continue
+
+        t_host = time.perf_counter()
+        frame = parse_frame(txt_serial)
+        if frame is None:
+            print(f'Not a valid frame: {txt_serial}')
+            continue
+
+        seq, event, micros = frame
+        if seq_last is not None and seq != (seq_last + 1) % 256:
+            print(f'Frames lost: sequence {seq_last} -> {seq}')
+        seq_last = seq
+
+        print(f'Received {event} (seq {seq}, device time {micros} us)')
+        edges.append((event, micros, t_host))
+        if event == 'FIN':
+            finished.set()
+
+
+# %% Connect to arduino and run a while loop
+reader = Thread(target=read_serial, daemon=True)
+reader.start()
 
 while True:
     i = input("start / exit:")
@@ -23,27 +70,25 @@ while True:
         print('finished program')
         break
 
+    finished.clear()
+    n_edges = len(edges)
+    t_start = time.perf_counter()
     arduino.write((i + '\n').encode())
-    time.sleep(0.25)
 
     if i == 'start':
         print('Will wait for acquitision to be done.')
+        finished.wait()
 
-        imaging = True
-        while imaging:
-
-            # Read from serial
-            txt_serial = arduino.readline().decode('ascii').rstrip()
-            print(f'Received serial txt: {txt_serial}')
-
-            if txt_serial == 'finished':
-                print('Acqusition seems to be terminated')
-                imaging = False
-            else:
-                print('No termination command received')
-
-            time.sleep(0.5)
+        edges_acq = edges[n_edges:]
+        t_trig = [micros for event, micros, _ in edges_acq if event == 'TRIG']
+        _, t_fin, t_fin_host = edges_acq[-1]
+        print('Acqusition seems to be terminated')
+        print(f'Trigger to finished: {t_fin_host - t_start:.3f} s (host)')
+        if t_trig:
+            print(f'Trigger to finished: {((t_fin - t_trig[-1]) % 2**32) / 1e6:.6f} s (device)')
 
+stop.set()
+reader.join()
 arduino.close()
 
 
@@ -0,0 +1,179 @@
+# Control API (autofish.api), driven through localClient with the demo configs, without hardware.
+
+import json
+import socket
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from autofish.api import controlAPI, localClient
+from autofish.automator import Robot
+from autofish.devicestate import stateCache
+
+DEMO = Path(__file__).parents[1] / 'demo'
+
+
+class fakePlate():
+    def __init__(self):
+        self.state = stateCache('plate')
+        self.moves = []
+
+    def move_stage(self, pos):
+        self.moves.append(pos)
+
+
+class fakeValve():
+    def __init__(self):
+        self.state = stateCache('valve')
+        self.moves = []
+
+    def move(self, port):
+        self.moves.append(port)
+
+
+@pytest.fixture
+def robot():
+    R = Robot(str(DEMO / 'system_config__demo.json'))
+    R.load_config_experiment(str(DEMO / 'experiment_config__demo.yaml'))
+    R.plate, R.valve_in = fakePlate(), fakeValve()
+    return R
+
+
+@pytest.fixture
+def client(robot):
+    api = controlAPI(robot, port=0).attach()
+    return localClient(api)
+
+
+def test_status(robot, client):
+    status = client.status()
+    assert status['busy'] is False
+    assert status['rounds_available'] == robot.rounds_available
+    assert status['prompt'] is None
+
+
+def test_move_to_buffer_without_run(robot, client):
+    ok, message = client.command('move_to_buffer', buffer='w_r1')
+    assert ok, message
+    assert robot.current_buffer == 'w_r1'
+    assert robot.valve_in.moves == [6]
+    assert robot.plate.moves
+
+
+def test_move_to_buffer_during_run(robot, client):
+    running, done = threading.Event(), threading.Event()
+
+    def run():
+        with robot.run_lock:
+            running.set()
+            done.wait(5)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    running.wait(5)
+    try:
+        ok, message = client.command('move_to_buffer', buffer='w_r1')
+        assert not ok and message == 'Robot is busy'
+        assert client.status()['busy'] is True
+        assert robot.current_buffer is None
+        assert robot.valve_in.moves == []
+    finally:
+        done.set()
+        thread.join(5)
+
+    assert client.status()['busy'] is False
+    assert client.command('move_to_buffer', buffer='w_r1')[0]
+
+
+def test_move_to_unknown_buffer(client):
+    ok, message = client.command('move_to_buffer', buffer='missing')
+    assert not ok and 'Unknown buffer' in message
+
+
+def test_skip_and_requeue_round(robot, client):
+    assert client.command('skip_round', round='r2')[0]
+    assert 'r2' not in robot.rounds_available
+    assert client.command('requeue_round', round='r2')[0]
+    assert 'r2' in robot.rounds_available
+    assert not client.command('skip_round', round='r9')[0]
+
+
+def test_skip_round_before_start(robot, client):
+    # Round skipped after the run picked it (scheduler.next) is not run
+    round_id = robot.scheduler.next()
+    assert client.command('skip_round', round=round_id)[0]
+    robot.run_single_round(round_id)
+    assert robot.scheduler.state(round_id) == 'skipped'
+    assert robot.status['launch_acquisition'] is False
+    assert robot.scheduler.next() != round_id
+
+
+def test_answer_prompt(robot, client):
+    answers = []
+    thread = threading.Thread(target=lambda: answers.append(robot.operator.ask('Continue?', options=('continue', 'stop'))))
+    thread.start()
+    for _ in range(100):
+        if client.status()['prompt'] is not None:
+            break
+        threading.Event().wait(0.01)
+
+    assert client.status()['prompt']['message'] == 'Continue?'
+    assert client.command('continue')[0]
+    thread.join(5)
+    assert answers == ['continue']
+    assert [event['event'] for event in client.timeline()] == ['prompt', 'command']
+
+
+def test_stop(robot, client):
+    assert client.command('stop')[0]
+    assert robot.stop.is_set()
+    assert client.status()['stop_requested'] is True
+
+
+def test_unknown_command(client):
+    ok, message = client.command('reboot')
+    assert not ok and 'Unknown command' in message
+
+
+def websocket_connect(api):
+    sock = socket.create_connection(('127.0.0.1', api.port))
+    sock.sendall(b'GET /events HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                 b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n')
+    response = b''
+    while b'\r\n\r\n' not in response:
+        response += sock.recv(1024)
+    assert b'101' in response.split(b'\r\n')[0]
+    for _ in range(100):
+        if api.websockets:
+            break
+        time.sleep(0.01)
+    return sock
+
+
+def test_websocket_events(robot):
+    api = controlAPI(robot, port=0).attach().start()
+    sock = websocket_connect(api)
+    try:
+        api.publish('progress', step='pump')
+        header = sock.recv(2)
+        payload = sock.recv(header[1] & 0x7F)
+        assert json.loads(payload)['step'] == 'pump'
+    finally:
+        sock.close()
+        api.close()
+
+
+def test_stalled_websocket_does_not_block(robot):
+    api = controlAPI(robot, port=0).attach().start()
+    sock = websocket_connect(api)   # Never reads
+    try:
+        t_start = time.monotonic()
+        for _ in range(2000):
+            api.publish('progress', data='x' * 10000)
+        assert time.monotonic() - t_start < 5
+        assert api.websockets == []
+    finally:
+        sock.close()
+        api.close()
@@ -0,0 +1,138 @@
+# Acquisitions in a worker process (autofish.remote), with the stand-in microscope.
+
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+from autofish.remote import acquisitionServer, remoteMicroscope, standInMicroscope
+
+
+def serve(**kargs):
+    """ Worker with a stand-in microscope, served in a thread.
+    """
+    M = standInMicroscope(**kargs)
+    server = acquisitionServer(M, port=0, heartbeat=0.1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return M, server
+
+
+def client(server, **kargs):
+    kargs = {'heartbeat_timeout': 2, 'progress_timeout': 1, 'connect_timeout': 5, **kargs}
+    return remoteMicroscope(port=server.port, **kargs)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_acquisition_ok():
+    M, server = serve(duration=0.5, interval=0.1)
+    R = client(server)
+    try:
+        R.acquire_images(name_base='r1')
+        assert M.n_images > 0
+        assert R.images is not None
+        R.acquire_images(name_base='r2')
+    finally:
+        R.close()
+
+
+def test_acquisition_hang():
+    _, server = serve(duration=0.5, hang=True)
+    R = client(server)
+    try:
+        with pytest.raises(TimeoutError, match='hung'):
+            R.acquire_images(name_base='r1')
+        assert R.sock is None
+    finally:
+        R.close()
+
+
+def test_no_second_acquisition_while_hung():
+    _, server = serve(duration=0.5, hang=True)
+    R = client(server)
+    try:
+        with pytest.raises(TimeoutError, match='hung'):
+            R.acquire_images(name_base='r1')
+
+        # Reconnects, the hung acquisition of the lost connection is still running in the worker
+        with pytest.raises(RuntimeError, match='already running'):
+            R.acquire_images(name_base='r2')
+        assert server.running()[0] == 1
+    finally:
+        R.close()
+
+
+def test_acquisition_after_cancelled_acquisition_of_lost_client():
+    _, server = serve(duration=30, interval=0.1)
+    R = client(server)
+    try:
+        handle = R.start_acquisition(name_base='r1')
+        for _ in range(50):
+            if server.running()[1] is not None:
+                break
+            time.sleep(0.1)
+        R.disconnect()
+        assert handle.wait(5) and isinstance(handle.exception, ConnectionError)
+
+        # Cancelled by the worker when the connection is lost, the next acquisition is accepted
+        for _ in range(50):
+            if server.running()[1] is None:
+                break
+            time.sleep(0.1)
+        server.microscope.duration = 0.2
+        R.acquire_images(name_base='r2')
+    finally:
+        R.close()
+
+
+def test_acquisition_fail():
+    _, server = serve(duration=0.2, interval=0.1, fail=True)
+    R = client(server)
+    try:
+        with pytest.raises(RuntimeError, match='Stand-in acquisition failed'):
+            R.acquire_images(name_base='r1')
+    finally:
+        R.close()
+
+
+def test_acquisition_slow_but_progressing():
+    _, server = serve(duration=2, interval=0.2)
+    R = client(server, progress_timeout=0.5)
+    try:
+        R.acquire_images(name_base='r1')
+    finally:
+        R.close()
+
+
+def test_acquisition_cancel():
+    _, server = serve(duration=30, interval=0.1)
+    R = client(server)
+    try:
+        handle = R.start_acquisition(name_base='r1')
+        assert not handle.wait(0.5)
+        handle.cancel()
+        assert handle.wait(5)
+        assert handle.exception is None
+    finally:
+        R.close()
+
+
+def test_hung_worker_is_restarted():
+    port = free_port()
+    worker_cmd = [sys.executable, '-m', 'autofish.remote', '--stand-in', '1', '--stand-in-mode', 'hang',
+                  '--port', str(port), '--heartbeat', '0.1']
+    R = remoteMicroscope(port=port, worker_cmd=worker_cmd, heartbeat_timeout=5, progress_timeout=1, connect_timeout=30)
+    try:
+        with pytest.raises(TimeoutError, match='hung'):
+            R.acquire_images(name_base='r1')
+        assert R.n_restarts == 1
+        assert R.process is not None and R.process.poll() is None
+    finally:
+        R.close()
+    assert R.process is None
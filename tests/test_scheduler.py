@@ -0,0 +1,112 @@
+# Scheduler of rounds (autofish.scheduler): order, states and the lazy heap.
+
+import pytest
+
+from autofish.scheduler import roundScheduler
+
+
+def run(scheduler):
+    """ Run all rounds in the order of the scheduler, return the order.
+    """
+    order = []
+    while (round_id := scheduler.next()) is not None:
+        assert scheduler.start(round_id)
+        scheduler.done(round_id)
+        order.append(round_id)
+    return order
+
+
+def test_order_of_rounds():
+    scheduler = roundScheduler(['r1', 'r2', 'r3'])
+    scheduler.add('r4')
+    assert len(scheduler) == 4
+    assert scheduler.runnable() == ['r1', 'r2', 'r3', 'r4']
+    assert run(scheduler) == ['r1', 'r2', 'r3', 'r4']
+    assert len(scheduler) == 0
+    assert scheduler.summary()['done'] == 4
+
+
+def test_requeue():
+    scheduler = roundScheduler(['r1', 'r2', 'r3'])
+    scheduler.start('r1')
+    scheduler.fail('r1')
+    assert 'r1' not in scheduler
+
+    # Requeued round runs before all runnable rounds
+    scheduler.requeue('r1')
+    assert scheduler.state('r1') == 'requeued'
+    assert run(scheduler) == ['r1', 'r2', 'r3']
+    assert scheduler.attempts('r1') == 2
+
+    # Done round can be requeued with a priority, a known round added again is requeued
+    scheduler.requeue('r2', priority=10)
+    scheduler.add('r3')
+    assert scheduler.runnable() == ['r3', 'r2']
+
+
+def test_requeue_running_round():
+    scheduler = roundScheduler(['r1'])
+    scheduler.start('r1')
+    with pytest.raises(ValueError):
+        scheduler.requeue('r1')
+    with pytest.raises(ValueError):
+        scheduler.skip('r1')
+
+
+def test_skip():
+    scheduler = roundScheduler(['r1', 'r2', 'r3'])
+    scheduler.skip('r2')
+    assert 'r2' not in scheduler
+    assert scheduler.rounds('skipped') == ['r2']
+    assert run(scheduler) == ['r1', 'r3']
+
+
+def test_skip_after_next():
+    # Round skipped between next() and start() is not started, next() then returns the next round
+    scheduler = roundScheduler(['r1', 'r2'])
+    assert scheduler.next() == 'r1'
+    scheduler.skip('r1')
+    assert not scheduler.start('r1')
+    assert scheduler.state('r1') == 'skipped'
+    assert scheduler.attempts('r1') == 0
+    assert scheduler.next() == 'r2'
+
+
+def test_start_unknown_round():
+    scheduler = roundScheduler(['r1'])
+    assert scheduler.start('r5')
+    assert scheduler.state('r5') == 'running'
+    assert not scheduler.start('r5')
+
+
+def test_release():
+    scheduler = roundScheduler(['r1', 'r2'])
+    scheduler.start('r1')
+    scheduler.release('r1')
+    assert scheduler.state('r1') == 'pending'
+    assert scheduler.next() == 'r1'
+
+
+def test_reorder():
+    scheduler = roundScheduler(['r1', 'r2', 'r3', 'r4'])
+    scheduler.reorder(['r4', 'r3'])
+    assert scheduler.runnable() == ['r4', 'r3', 'r1', 'r2']
+    scheduler.set_priority('r4', 100)
+    assert run(scheduler) == ['r3', 'r1', 'r2', 'r4']
+
+
+def test_lazy_heap():
+    scheduler = roundScheduler(['r1', 'r2', 'r3'])
+
+    # Each change of priority pushes a new entry, outdated entries stay in the heap
+    for priority in (5, 4, 3, 7):
+        scheduler.set_priority('r1', priority)
+    scheduler.skip('r2')
+    assert len(scheduler.heap) == 7
+
+    # Outdated entries are removed when they reach the top
+    assert scheduler.next() == 'r3'
+    assert scheduler.heap[0][2] == 'r3'
+    assert run(scheduler) == ['r3', 'r1']
+    assert scheduler.heap == []
+    assert len(scheduler) == 0